@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+Benchmarks parsing the output of the connection resolution commands (netstat,
+ss, lsof, and sockstat). Each is timed over a recorded output, parsed both by
+the streaming parser connection resolution uses and the approach it replaced
+(buffering all of the output, then filtering and splitting each line).
+Outputs are provided by cat rather than the commands themselves, so this only
+measures our parsing.
+
+Recordings can be made with...
+  netstat -np > netstat.txt
+  ss -nptu > ss.txt
+  lsof -wnPi > lsof.txt
+  sockstat > sockstat.txt
+
+... and given with '--recordings <directory>'. Otherwise this generates an
+output with 100,000 lines for each of the commands. This exits with a status
+of one if the streaming parser processes fewer lines per second than
+'--min-rate', or is well behind the old approach.
+
+The streaming parser's regexes are stricter than the old substring filters,
+so for netstat and ss (whose old filters were correct) it's roughly as fast.
+It's faster for lsof and sockstat, and unlike the old approach doesn't hold
+the whole output in memory or drop IPv6 connections.
+"""
+
+import os
+import re
+import sys
+import time
+import getopt
+import random
+import shutil
+import tempfile
+import subprocess
+
+from util import connections
+
+OPT = "r:l:m:n:p:h"
+OPT_EXPANDED = ["recordings=", "lines=", "min-rate=", "name=", "pid=", "help"]
+
+HELP_MSG = """Usage benchmarkResolvers.py [OPTION]
+Benchmarks parsing the output of connection resolution commands.
+
+  -r, --recordings DIRECTORY      directory with recorded netstat.txt, ss.txt,
+                                    lsof.txt, and/or sockstat.txt outputs
+  -l, --lines NUM                 lines in generated outputs (default: %i)
+  -m, --min-rate NUM              fails if fewer lines per second are parsed
+  -n, --name NAME                 process the recordings are for (default: %s)
+  -p, --pid PID                   pid the recordings are for (default: %s)
+  -h, --help                      presents this help
+"""
+
+DEFAULT_LINES = 100000
+DEFAULT_NAME = "tor"
+DEFAULT_PID = "9912"
+RUNS = 3             # times each parser is ran, taking the fastest
+SLOWDOWN_LIMIT = 0.6 # fails if the streaming parser's rate is below this portion of the legacy one
+
+BENCHMARKED_RESOLVERS = (connections.Resolver.NETSTAT, connections.Resolver.SS,
+                         connections.Resolver.LSOF, connections.Resolver.SOCKSTAT)
+
+# Formats for generated output lines, with the process name, pid, local
+# address, foreign address, and state. These match the examples given for the
+# commands in util.connections.
+LINE_FORMATS = {
+  connections.Resolver.NETSTAT: "tcp        0      0 %(local)-23s %(foreign)-23s %(state)-11s %(pid)s/%(name)s\n",
+  connections.Resolver.SS: "tcp    %(state)-6s 0      0      %(local)-22s %(foreign)-22s users:((\"%(name)s\",pid=%(pid)s,fd=20))\n",
+  connections.Resolver.LSOF: "%(name)-8s %(pid)-5s atagar   45u  IPv4  40994      0t0  TCP %(local)s->%(foreign)s (%(state)s)\n",
+  connections.Resolver.SOCKSTAT: "atagar   %(name)-10s %(pid)-5s tcp4   %(local)-21s %(foreign)-21s %(state)s\n",
+}
+
+# Legacy filters, as they were prior to the streaming parser. The lsof and
+# sockstat filters are corrected to match against the line (sockstat's
+# with a search since its lines start with the user).
+LEGACY_FILTERS = {
+  connections.Resolver.NETSTAT: lambda line, name, pid: "ESTABLISHED %s/%s" % (pid, name) in line,
+  connections.Resolver.SS: lambda line, name, pid: ("ESTAB" in line) and ("\"%s\",pid=%s" % (name, pid) in line),
+  connections.Resolver.LSOF: lambda line, name, pid: re.match("^%s *%s.*((UDP.*)|(\(ESTABLISHED\)))" % (name, pid), line),
+  connections.Resolver.SOCKSTAT: lambda line, name, pid: re.search("%s *%s.*ESTABLISHED" % (name, pid), line),
+}
+
+def generateOutput(resolver, lineCount, path):
+  """
+  Writes an output for the given command. Like a relay's, most of its lines
+  are established connections of our process (a tenth of which are IPv6).
+  Three in ten are for other processes, and one in ten are for our process but
+  aren't established.
+  
+  Arguments:
+    resolver  - command to make an output for
+    lineCount - number of lines in the output
+    path      - location the output is written to
+  """
+  
+  lineFormat = LINE_FORMATS[resolver]
+  randomAddr = lambda: "%i.%i.%i.%i" % tuple([random.randint(1, 254) for _ in range(4)])
+  
+  outputFile = open(path, "w")
+  
+  for i in range(lineCount):
+    name, pid, state = DEFAULT_NAME, DEFAULT_PID, "ESTABLISHED"
+    
+    if i % 10 in (1, 4, 7): name, pid = "firefox", "3271"
+    elif i % 10 == 9: state = "TIME_WAIT"
+    
+    if resolver == connections.Resolver.SS and state == "ESTABLISHED": state = "ESTAB"
+    
+    if i % 20 == 0:
+      local = "[2001:db8::%x]:%i" % (random.randint(1, 0xffff), random.randint(1025, 65535))
+      foreign = "[2001:db8:1::%x]:%i" % (random.randint(1, 0xffff), random.choice((443, 9001)))
+    else:
+      local = "%s:%i" % (randomAddr(), random.randint(1025, 65535))
+      foreign = "%s:%i" % (randomAddr(), random.choice((443, 9001)))
+    
+    outputFile.write(lineFormat % {"name": name, "pid": pid, "local": local, "foreign": foreign, "state": state})
+  
+  outputFile.close()
+
+def parseStreaming(resolver, path, processName, processPid):
+  """
+  Parses an output with the streaming parser used for connection resolution.
+  
+  Arguments:
+    resolver    - command the output belongs to
+    path        - location of the output
+    processName - name of the process to provide connections for
+    processPid  - pid of the process to provide connections for
+  """
+  
+  cmdLiteral, cmdMatcher = connections.getResolverCommand(resolver, processName, processPid)[1:]
+  return list(connections._streamConnections("cat %s" % path, cmdLiteral, cmdMatcher))
+
+def parseLegacy(resolver, path, processName, processPid):
+  """
+  Parses an output the way connection resolution did prior to the streaming
+  parser. Lines that can't be parsed (such as IPv6 addresses) are skipped.
+  
+  Arguments:
+    resolver    - command the output belongs to
+    path        - location of the output
+    processName - name of the process to provide connections for
+    processPid  - pid of the process to provide connections for
+  """
+  
+  process = subprocess.Popen(["cat", path], stdout = subprocess.PIPE)
+  results = process.communicate()[0].splitlines()
+  
+  lineFilter = LEGACY_FILTERS[resolver]
+  results = [line for line in results if lineFilter(line, processName, processPid)]
+  
+  conn = []
+  for line in results:
+    if resolver == connections.Resolver.LSOF:
+      comp = line.replace("(ESTABLISHED)", "").strip().split()
+    else: comp = line.split()
+    
+    try:
+      if resolver == connections.Resolver.NETSTAT:
+        localIp, localPort = comp[3].split(":")
+        foreignIp, foreignPort = comp[4].split(":")
+      elif resolver == connections.Resolver.SS:
+        localIp, localPort = comp[4].split(":")
+        foreignIp, foreignPort = comp[5].split(":")
+      elif resolver == connections.Resolver.LSOF:
+        local, foreign = comp[-1].split("->")
+        localIp, localPort = local.split(":")
+        foreignIp, foreignPort = foreign.split(":")
+      elif resolver == connections.Resolver.SOCKSTAT:
+        localIp, localPort = comp[4].split(":")
+        foreignIp, foreignPort = comp[5].split(":")
+    except ValueError:
+      continue
+    
+    conn.append((localIp, localPort, foreignIp, foreignPort))
+  
+  return conn
+
+def timeParser(parser, resolver, path, processName, processPid):
+  """
+  Provides the fastest runtime and cpu time of a parser over RUNS attempts,
+  with the connections it found.
+  
+  Arguments:
+    parser      - parseStreaming or parseLegacy
+    resolver    - command the output belongs to
+    path        - location of the output
+    processName - name of the process to provide connections for
+    processPid  - pid of the process to provide connections for
+  """
+  
+  bestRuntime, bestCpuTime, results = None, None, []
+  
+  for _ in range(RUNS):
+    startTime, startCpu = time.time(), sum(os.times()[:2])
+    results = parser(resolver, path, processName, processPid)
+    runtime, cpuTime = time.time() - startTime, sum(os.times()[:2]) - startCpu
+    
+    if bestRuntime is None or runtime < bestRuntime:
+      bestRuntime, bestCpuTime = runtime, cpuTime
+  
+  return (bestRuntime, bestCpuTime, results)
+
+def main():
+  recordingDir, lineCount, minRate = None, DEFAULT_LINES, 0
+  processName, processPid = DEFAULT_NAME, DEFAULT_PID
+  
+  try:
+    opts, _ = getopt.getopt(sys.argv[1:], OPT, OPT_EXPANDED)
+  except getopt.GetoptError, exc:
+    print str(exc) + " (for usage provide --help)"
+    sys.exit(1)
+  
+  try:
+    for opt, arg in opts:
+      if opt in ("-r", "--recordings"): recordingDir = arg
+      elif opt in ("-l", "--lines"): lineCount = int(arg)
+      elif opt in ("-m", "--min-rate"): minRate = float(arg)
+      elif opt in ("-n", "--name"): processName = arg
+      elif opt in ("-p", "--pid"): processPid = arg
+      elif opt in ("-h", "--help"):
+        print HELP_MSG % (DEFAULT_LINES, DEFAULT_NAME, DEFAULT_PID)
+        sys.exit()
+  except ValueError, exc:
+    print "Invalid argument: %s" % exc
+    sys.exit(1)
+  
+  outputs = {}
+  tempDir = None
+  
+  if recordingDir:
+    for resolver in BENCHMARKED_RESOLVERS:
+      path = os.path.join(recordingDir, "%s.txt" % resolver)
+      if os.path.exists(path): outputs[resolver] = path
+    
+    if not outputs:
+      print "No recordings found in %s" % recordingDir
+      sys.exit(1)
+  else:
+    tempDir = tempfile.mkdtemp()
+    
+    for resolver in BENCHMARKED_RESOLVERS:
+      outputs[resolver] = os.path.join(tempDir, "%s.txt" % resolver)
+      generateOutput(resolver, lineCount, outputs[resolver])
+  
+  isFailed = False
+  print "%-10s %9s %12s %12s %9s %13s" % ("command", "lines", "streaming", "legacy", "speedup", "connections")
+  
+  try:
+    for resolver in BENCHMARKED_RESOLVERS:
+      if not resolver in outputs: continue
+      
+      outputFile = open(outputs[resolver])
+      outputLines = sum([1 for _ in outputFile])
+      outputFile.close()
+      
+      streamTime, streamCpu, streamResults = timeParser(parseStreaming, resolver, outputs[resolver], processName, processPid)
+      legacyTime, legacyCpu, legacyResults = timeParser(parseLegacy, resolver, outputs[resolver], processName, processPid)
+      
+      streamRate = outputLines / max(streamTime, 0.000001)
+      legacyRate = outputLines / max(legacyTime, 0.000001)
+      
+      print "%-10s %9i %9i/s %9i/s %8.1fx %6i/%-6i" % (resolver, outputLines, streamRate, legacyRate, streamRate / legacyRate, len(streamResults), len(legacyResults))
+      print "%-10s %9s %10.0f ms %9.0f ms cpu" % ("", "", streamCpu * 1000, legacyCpu * 1000)
+      
+      if streamRate < SLOWDOWN_LIMIT * legacyRate:
+        print "  streaming parser is well behind the legacy one"
+        isFailed = True
+      
+      if streamRate < minRate:
+        print "  streaming parser is below the minimum of %i lines per second" % minRate
+        isFailed = True
+  finally:
+    if tempDir: shutil.rmtree(tempDir)
+  
+  sys.exit(1 if isFailed else 0)
+
+if __name__ == '__main__':
+  main()
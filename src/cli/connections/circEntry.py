@@ -8,6 +8,7 @@ followed by an entry for each hop in the circuit. For instance:
 +- 217.172.182.26 (de)          5CFA9EA136C0EA0AC096E5CEA7EB674F1207CF86    3 / Exit
 """
 
+import time
 import curses
 
 from cli.connections import entries, connEntry
@@ -29,7 +30,7 @@ class CircEntry(connEntry.ConnectionEntry):
     # Overwrites attributes of the initial line to make it more fitting as the
     # header for our listing.
     
-    self.lines[0].baseType = connEntry.Category.CIRCUIT
+    self.lines[0].setBaseType(connEntry.Category.CIRCUIT)
     
     self.update(status, path)
   
@@ -81,9 +82,11 @@ class CircHeaderLine(connEntry.ConnectionLine):
     self.isBuilt = False
   
   def setExit(self, exitIpAddr, exitPort, exitFingerprint):
-    connEntry.ConnectionLine.__init__(self, "127.0.0.1", "0", exitIpAddr, exitPort, False, False)
+    connEntry.CONNECTION_TABLE.setForeign(self.getRow(), exitIpAddr, exitPort)
+    connEntry.CONNECTION_TABLE.setStartTime(self.getRow(), time.time())
+    self.resetDisplay()
     self.isBuilt = True
-    self.foreign.fingerprintOverwrite = exitFingerprint
+    self.foreign.setFingerprintOverwrite(exitFingerprint)
   
   def getType(self):
     return connEntry.Category.CIRCUIT
@@ -122,9 +125,9 @@ class CircLine(connEntry.ConnectionLine):
   
   def __init__(self, fIpAddr, fPort, fFingerprint, placementLabel):
     connEntry.ConnectionLine.__init__(self, "127.0.0.1", "0", fIpAddr, fPort)
-    self.foreign.fingerprintOverwrite = fFingerprint
+    self.foreign.setFingerprintOverwrite(fFingerprint)
     self.placementLabel = placementLabel
-    self.includePort = False
+    self.setPortIncluded(False)
     
     # determines the sort of left hand bracketing we use
     self.isLast = False
@@ -178,7 +181,7 @@ class CircLine(connEntry.ConnectionLine):
       # min space for the hostname is 40 characters
       etc = self.getEtcContent(width - baselineSpace - 40, listingType)
       dstLayout = "%%-%is" % (width - baselineSpace - len(etc))
-      dst = dstLayout % self.foreign.getHostname(self.foreign.getIpAddr())
+      dst = dstLayout % self.foreign.getHostname(self.foreign.getIpAddr(), True)
     elif listingType == entries.ListingType.FINGERPRINT:
       # dst width is derived as:
       # src (9) + dst (40) + divider (7) + right gap (2) - bracket (3) = 55 char
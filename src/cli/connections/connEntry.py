@@ -6,7 +6,7 @@ Connection panel entries related to actual connections to or from the system
 import time
 import curses
 
-from util import connections, torTools, uiTools
+from util import connections, connTable, hostnames, torTools, uiTools
 from cli.connections import entries
 
 from stem.util import conf, enum, str_tools
@@ -32,8 +32,12 @@ CATEGORY_COLOR = {Category.INBOUND: "green",      Category.OUTBOUND: "blue",
 LABEL_FORMAT = "%s  -->  %s  %s%s"
 LABEL_MIN_PADDING = 2 # min space between listing label and following data
 
-# sort value for scrubbed ip addresses
-SCRUBBED_IP_VAL = 255 ** 4
+# sort value for scrubbed ip addresses (after any address)
+SCRUBBED_IP_VAL = 2 ** 129
+
+# addresses, ports, categories, and start times of our connection lines
+CONNECTION_TABLE = connTable.ConnectionTable()
+CATEGORIES = list(Category)
 
 CONFIG = conf.config_dict("arm", {
   "features.connection.markInitialConnections": True,
@@ -45,60 +49,89 @@ CONFIG = conf.config_dict("arm", {
   "features.connection.showColumn.expandedIp": True,
 })
 
-class Endpoint:
+class Endpoint(object):
   """
   Collection of attributes associated with a connection endpoint. This is a
   thin wrapper for torUtil functions, making use of its caching for
-  performance.
+  performance. This is a view of our connection's row in the CONNECTION_TABLE,
+  which has the endpoint's attributes.
   """
   
-  def __init__(self, ipAddr, port):
-    self.ipAddr = ipAddr
-    self.port = port
-    
-    # if true, we treat the port as an definitely not being an ORPort when
-    # searching for matching fingerprints (otherwise we use it to possably
-    # narrow results when unknown)
-    self.isNotORPort = True
-    
-    # if set then this overwrites fingerprint lookups
-    self.fingerprintOverwrite = None
+  __slots__ = ("_row", "_isLocal")
+  
+  def __init__(self, row, isLocal):
+    self._row = row
+    self._isLocal = isLocal
   
   def getIpAddr(self):
     """
     Provides the IP address of the endpoint.
     """
     
-    return self.ipAddr
+    return CONNECTION_TABLE.getAddress(self._row, self._isLocal)
   
   def getPort(self):
     """
     Provides the port of the endpoint.
     """
     
-    return self.port
+    return str(CONNECTION_TABLE.getPort(self._row, self._isLocal))
+  
+  def isNotORPort(self):
+    """
+    True if we treat the port as definitely not being an ORPort when searching
+    for matching fingerprints (otherwise we use it to possibly narrow results
+    when unknown).
+    """
+    
+    flag = connTable.ROW_LOCAL_NOT_ORPORT if self._isLocal else connTable.ROW_FOREIGN_NOT_ORPORT
+    return CONNECTION_TABLE.isFlagSet(self._row, flag)
+  
+  def setNotORPort(self, isNotORPort):
+    """
+    Sets if the port is definitely not an ORPort.
+    
+    Arguments:
+      isNotORPort - true if the port isn't an ORPort, false otherwise
+    """
+    
+    flag = connTable.ROW_LOCAL_NOT_ORPORT if self._isLocal else connTable.ROW_FOREIGN_NOT_ORPORT
+    CONNECTION_TABLE.setFlag(self._row, flag, isNotORPort)
   
-  def getHostname(self, default = None):
+  def setFingerprintOverwrite(self, fingerprint):
+    """
+    Sets the fingerprint of the endpoint, overwriting our lookups.
+    
+    Arguments:
+      fingerprint - fingerprint of the relay, None to look it up
+    """
+    
+    CONNECTION_TABLE.setFingerprint(self._row, self._isLocal, fingerprint)
+  
+  def getHostname(self, default = None, isVisible = False):
     """
     Provides the hostname associated with the relay's address. This is a
     non-blocking call and returns None if the address either can't be resolved
     or hasn't been resolved yet.
     
     Arguments:
-      default - return value if no hostname is available
+      default   - return value if no hostname is available
+      isVisible - resolves the address ahead of others if it's being displayed
     """
     
-    # TODO: skipping all hostname resolution to be safe for now
-    #try:
-    #  myHostname = hostnames.resolve(self.ipAddr)
-    #except:
-    #  # either a ValueError or IOError depending on the source of the lookup failure
-    #  myHostname = None
-    #
-    #if not myHostname: return default
-    #else: return myHostname
+    # Lookups are only made when tor does them for us. Otherwise they'd go to
+    # the system's nameservers, leaking who we're connected to.
+    if not hostnames.isPrivate(): return default
     
-    return default
+    try:
+      priority = hostnames.PRIORITY_VISIBLE if isVisible else hostnames.PRIORITY_BACKGROUND
+      myHostname = hostnames.resolve(self.getIpAddr(), priority = priority)
+    except ValueError:
+      # address is unresolvable
+      myHostname = None
+    
+    if not myHostname: return default
+    else: return myHostname
   
   def getLocale(self, default=None):
     """
@@ -109,7 +142,7 @@ class Endpoint:
     """
     
     conn = torTools.getConn()
-    return conn.getInfo("ip-to-country/%s" % self.ipAddr, default)
+    return conn.getInfo("ip-to-country/%s" % self.getIpAddr(), default)
   
   def getFingerprint(self):
     """
@@ -117,16 +150,23 @@ class Endpoint:
     determined.
     """
     
-    if self.fingerprintOverwrite:
-      return self.fingerprintOverwrite
-    
     conn = torTools.getConn()
-    myFingerprint = conn.getRelayFingerprint(self.ipAddr)
+    
+    # local endpoints are us unless we've been told otherwise
+    fingerprintOverwrite = CONNECTION_TABLE.getFingerprint(self._row, self._isLocal)
+    if not fingerprintOverwrite and self._isLocal:
+      fingerprintOverwrite = conn.getSnapshot("fingerprint")
+    
+    if fingerprintOverwrite:
+      return fingerprintOverwrite
+    
+    myIpAddr = self.getIpAddr()
+    myFingerprint = conn.getRelayFingerprint(myIpAddr)
     
     # If there were multiple matches and our port is likely the ORPort then
     # try again with that to narrow the results.
-    if not myFingerprint and not self.isNotORPort:
-      myFingerprint = conn.getRelayFingerprint(self.ipAddr, self.port)
+    if not myFingerprint and not self.isNotORPort():
+      myFingerprint = conn.getRelayFingerprint(myIpAddr, self.getPort())
     
     if myFingerprint: return myFingerprint
     else: return "UNKNOWN"
@@ -154,6 +194,8 @@ class ConnectionEntry(entries.ConnectionPanelEntry):
   application, and controller categories.
   """
   
+  __slots__ = ()
+  
   def __init__(self, lIpAddr, lPort, fIpAddr, fPort):
     entries.ConnectionPanelEntry.__init__(self)
     self.lines = [ConnectionLine(lIpAddr, lPort, fIpAddr, fPort)]
@@ -166,9 +208,9 @@ class ConnectionEntry(entries.ConnectionPanelEntry):
     connLine = self.lines[0]
     if attr == entries.SortAttr.IP_ADDRESS:
       if connLine.isPrivate(): return SCRUBBED_IP_VAL # orders at the end
-      return connLine.sortIpAddr
+      return CONNECTION_TABLE.getAddressInt(connLine.getRow(), False)
     elif attr == entries.SortAttr.PORT:
-      return connLine.sortPort
+      return CONNECTION_TABLE.getPort(connLine.getRow(), False)
     elif attr == entries.SortAttr.HOSTNAME:
       if connLine.isPrivate(): return ""
       return connLine.foreign.getHostname("")
@@ -181,7 +223,7 @@ class ConnectionEntry(entries.ConnectionPanelEntry):
     elif attr == entries.SortAttr.CATEGORY:
       return Category.index_of(connLine.getType())
     elif attr == entries.SortAttr.UPTIME:
-      return connLine.startTime
+      return connLine.getStartTime()
     elif attr == entries.SortAttr.COUNTRY:
       if connections.isIpAddressPrivate(self.lines[0].foreign.getIpAddr()): return ""
       else: return connLine.foreign.getLocale("")
@@ -190,69 +232,171 @@ class ConnectionEntry(entries.ConnectionPanelEntry):
 
 class ConnectionLine(entries.ConnectionPanelLine):
   """
-  Display component of the ConnectionEntry.
+  Display component of the ConnectionEntry. This is a view of its row in the
+  CONNECTION_TABLE, which has its attributes.
   """
   
+  __slots__ = ("_row",)
+  
   def __init__(self, lIpAddr, lPort, fIpAddr, fPort, includePort=True, includeExpandedIpAddr=True):
     entries.ConnectionPanelLine.__init__(self)
     
-    self.local = Endpoint(lIpAddr, lPort)
-    self.foreign = Endpoint(fIpAddr, fPort)
-    self.startTime = time.time()
-    self.isInitialConnection = False
-    
-    # overwrite the local fingerprint with ours
-    conn = torTools.getConn()
-    self.local.fingerprintOverwrite = conn.getInfo("fingerprint", None)
-    
     # True if the connection has matched the properties of a client/directory
     # connection every time we've checked. The criteria we check is...
     #   client    - first hop in an established circuit
     #   directory - matches an established single-hop circuit (probably a
     #               directory mirror)
+    #
+    # Both ports are presumed to not be ORPorts unless our category says
+    # otherwise.
     
-    self._possibleClient = True
-    self._possibleDirectory = True
+    flags = connTable.ROW_POSSIBLE_CLIENT | connTable.ROW_POSSIBLE_DIRECTORY
+    flags |= connTable.ROW_LOCAL_NOT_ORPORT | connTable.ROW_FOREIGN_NOT_ORPORT
+    
+    # includes the port or expanded ip address field when displaying listing
+    # information if true
+    if includePort: flags |= connTable.ROW_INCLUDE_PORT
+    if includeExpandedIpAddr: flags |= connTable.ROW_INCLUDE_EXPANDED_IP
     
-    # attributes for SOCKS, HIDDEN, and CONTROL connections
-    self.appName = None
-    self.appPid = None
-    self.isAppResolving = False
+    # our attributes in the CONNECTION_TABLE, released when we're collected
+    self._row = CONNECTION_TABLE.add(lIpAddr, lPort, fIpAddr, fPort, startTime = time.time(), flags = flags)
     
-    myOrPort = conn.getOption("ORPort", None)
-    myDirPort = conn.getOption("DirPort", None)
-    mySocksPort = conn.getOption("SocksPort", "9050")
-    myCtlPort = conn.getOption("ControlPort", None)
+    conn = torTools.getConn()
+    myOrPort = conn.getSnapshot("ORPort")
+    myDirPort = conn.getSnapshot("DirPort")
+    mySocksPort = conn.getSnapshot("SocksPort", "9050")
+    myCtlPort = conn.getSnapshot("ControlPort")
     myHiddenServicePorts = conn.getHiddenServicePorts()
     
     # the ORListenAddress can overwrite the ORPort
-    listenAddr = conn.getOption("ORListenAddress", None)
+    listenAddr = conn.getSnapshot("ORListenAddress")
     if listenAddr and ":" in listenAddr:
       myOrPort = listenAddr[listenAddr.find(":") + 1:]
     
     if lPort in (myOrPort, myDirPort):
-      self.baseType = Category.INBOUND
-      self.local.isNotORPort = False
+      self.setBaseType(Category.INBOUND)
+      self.local.setNotORPort(False)
     elif lPort == mySocksPort:
-      self.baseType = Category.SOCKS
+      self.setBaseType(Category.SOCKS)
     elif fPort in myHiddenServicePorts:
-      self.baseType = Category.HIDDEN
+      self.setBaseType(Category.HIDDEN)
     elif lPort == myCtlPort:
-      self.baseType = Category.CONTROL
+      self.setBaseType(Category.CONTROL)
     else:
-      self.baseType = Category.OUTBOUND
-      self.foreign.isNotORPort = False
+      self.setBaseType(Category.OUTBOUND)
+      self.foreign.setNotORPort(False)
+  
+  def __del__(self):
+    # the row isn't assigned if our addresses were malformed
+    if hasattr(self, "_row"): CONNECTION_TABLE.release(self._row)
+  
+  # Endpoints are views of our row, so they're made when asked for rather than
+  # held by each line.
+  local = property(lambda self: Endpoint(self._row, True), doc = "local endpoint of the connection")
+  foreign = property(lambda self: Endpoint(self._row, False), doc = "foreign endpoint of the connection")
+  
+  def getRow(self):
+    """
+    Provides our row in the CONNECTION_TABLE.
+    """
     
-    self.cachedType = None
+    return self._row
+  
+  def getStartTime(self):
+    """
+    Provides the unix time when the connection was first seen.
+    """
     
-    # includes the port or expanded ip address field when displaying listing
-    # information if true
-    self.includePort = includePort
-    self.includeExpandedIpAddr = includeExpandedIpAddr
+    return CONNECTION_TABLE.getStartTime(self._row)
+  
+  def getBaseType(self):
+    """
+    Provides the category of the connection based on its ports alone.
+    """
+    
+    return CATEGORIES[CONNECTION_TABLE.getCategory(self._row)]
+  
+  def setBaseType(self, baseType):
+    """
+    Sets the category of the connection based on its ports alone.
+    
+    Arguments:
+      baseType - Category for the connection
+    """
     
-    # cached immutable values used for sorting
-    self.sortIpAddr = connections.ipToInt(self.foreign.getIpAddr())
-    self.sortPort = int(self.foreign.getPort())
+    CONNECTION_TABLE.setCategory(self._row, Category.index_of(baseType))
+  
+  def isInitialConnection(self):
+    """
+    True if the connection existed when we started, so its uptime is only an
+    estimate.
+    """
+    
+    return CONNECTION_TABLE.isFlagSet(self._row, connTable.ROW_INITIAL)
+  
+  def setInitialConnection(self, isInitial):
+    """
+    Sets if the connection existed when we started.
+    
+    Arguments:
+      isInitial - true if the connection predates us, false otherwise
+    """
+    
+    CONNECTION_TABLE.setFlag(self._row, connTable.ROW_INITIAL, isInitial)
+  
+  def isPortIncluded(self):
+    """
+    True if our listing includes the port.
+    """
+    
+    return CONNECTION_TABLE.isFlagSet(self._row, connTable.ROW_INCLUDE_PORT)
+  
+  def setPortIncluded(self, includePort):
+    """
+    Sets if our listing includes the port.
+    
+    Arguments:
+      includePort - true if the port should be shown, false otherwise
+    """
+    
+    CONNECTION_TABLE.setFlag(self._row, connTable.ROW_INCLUDE_PORT, includePort)
+  
+  def getApp(self):
+    """
+    Provides the (command, pid) tuple for the application of SOCKS, HIDDEN, and
+    CONTROL connections. These are None if it's unknown.
+    """
+    
+    return CONNECTION_TABLE.getApp(self._row)
+  
+  def setApp(self, appName, appPid):
+    """
+    Sets the application this connection belongs to.
+    
+    Arguments:
+      appName - command of the application
+      appPid  - pid of the application
+    """
+    
+    CONNECTION_TABLE.setApp(self._row, appName, appPid)
+    self.setAppResolving(False)
+  
+  def isAppResolving(self):
+    """
+    True if there's a lookup in progress for our application.
+    """
+    
+    return CONNECTION_TABLE.isFlagSet(self._row, connTable.ROW_APP_RESOLVING)
+  
+  def setAppResolving(self, isResolving):
+    """
+    Sets if there's a lookup in progress for our application.
+    
+    Arguments:
+      isResolving - true if our application's being looked up
+    """
+    
+    CONNECTION_TABLE.setFlag(self._row, connTable.ROW_APP_RESOLVING, isResolving)
   
   def getListingEntry(self, width, currentTime, listingType):
     """
@@ -292,10 +436,10 @@ class ConnectionLine(entries.ConnectionPanelLine):
     
     # fill in the current uptime and return the results
     if CONFIG["features.connection.markInitialConnections"]:
-      timePrefix = "+" if self.isInitialConnection else " "
+      timePrefix = "+" if self.isInitialConnection() else " "
     else: timePrefix = ""
     
-    timeLabel = timePrefix + "%5s" % str_tools.get_time_label(currentTime - self.startTime, 1)
+    timeLabel = timePrefix + "%5s" % str_tools.get_time_label(currentTime - self.getStartTime(), 1)
     myListing[2] = (timeLabel, myListing[2][1])
     
     return myListing
@@ -305,7 +449,7 @@ class ConnectionLine(entries.ConnectionPanelLine):
     True if our display uses application information that hasn't yet been resolved.
     """
     
-    return self.appName == None and self.getType() in (Category.SOCKS, Category.HIDDEN, Category.CONTROL)
+    return self.getApp()[0] == None and self.getType() in (Category.SOCKS, Category.HIDDEN, Category.CONTROL)
   
   def _getListingEntry(self, width, currentTime, listingType):
     entryType = self.getType()
@@ -343,7 +487,7 @@ class ConnectionLine(entries.ConnectionPanelLine):
   
   def resetDisplay(self):
     entries.ConnectionPanelLine.resetDisplay(self)
-    self.cachedType = None
+    CONNECTION_TABLE.setType(self._row, -1)
   
   def isPrivate(self):
     """
@@ -389,60 +533,67 @@ class ConnectionLine(entries.ConnectionPanelLine):
     
     # caches both to simplify the calls and to keep the type consistent until
     # we want to reflect changes
-    if not self.cachedType:
-      if self.baseType == Category.OUTBOUND:
-        # Currently the only non-static categories are OUTBOUND vs...
-        # - EXIT since this depends on the current consensus
-        # - CIRCUIT if this is likely to belong to our guard usage
-        # - DIRECTORY if this is a single-hop circuit (directory mirror?)
-        # 
-        # The exitability, circuits, and fingerprints are all cached by the
-        # torTools util keeping this a quick lookup.
+    typeIndex = CONNECTION_TABLE.getType(self._row)
+    if typeIndex != -1: return CATEGORIES[typeIndex]
+    
+    cachedType = None
+    baseType = self.getBaseType()
+    
+    if baseType == Category.OUTBOUND:
+      # Currently the only non-static categories are OUTBOUND vs...
+      # - EXIT since this depends on the current consensus
+      # - CIRCUIT if this is likely to belong to our guard usage
+      # - DIRECTORY if this is a single-hop circuit (directory mirror?)
+      # 
+      # The exitability, circuits, and fingerprints are all cached by the
+      # torTools util keeping this a quick lookup.
+      
+      conn = torTools.getConn()
+      foreign = self.foreign
+      destFingerprint = foreign.getFingerprint()
+      
+      if destFingerprint == "UNKNOWN":
+        # Not a known relay. This might be an exit connection.
         
-        conn = torTools.getConn()
-        destFingerprint = self.foreign.getFingerprint()
+        if conn.isExitingAllowed(foreign.getIpAddr(), foreign.getPort()):
+          cachedType = Category.EXIT
+      elif CONNECTION_TABLE.isFlagSet(self._row, connTable.ROW_POSSIBLE_CLIENT | connTable.ROW_POSSIBLE_DIRECTORY):
+        # This belongs to a known relay. If we haven't eliminated ourselves as
+        # a possible client or directory connection then check if it still
+        # holds true.
+        
+        myCircuits = conn.getCircuits()
         
-        if destFingerprint == "UNKNOWN":
-          # Not a known relay. This might be an exit connection.
+        if CONNECTION_TABLE.isFlagSet(self._row, connTable.ROW_POSSIBLE_CLIENT):
+          # Checks that this belongs to the first hop in a circuit that's
+          # either unestablished or longer than a single hop (ie, anything but
+          # a built 1-hop connection since those are most likely a directory
+          # mirror).
           
-          if conn.isExitingAllowed(self.foreign.getIpAddr(), self.foreign.getPort()):
-            self.cachedType = Category.EXIT
-        elif self._possibleClient or self._possibleDirectory:
-          # This belongs to a known relay. If we haven't eliminated ourselves as
-          # a possible client or directory connection then check if it still
-          # holds true.
+          for _, status, _, path in myCircuits:
+            if path[0] == destFingerprint and (status != "BUILT" or len(path) > 1):
+              cachedType = Category.CIRCUIT # matched a probable guard connection
           
-          myCircuits = conn.getCircuits()
+          # if we fell through, we can eliminate ourselves as a guard in the future
+          if not cachedType:
+            CONNECTION_TABLE.setFlag(self._row, connTable.ROW_POSSIBLE_CLIENT, False)
+        
+        if CONNECTION_TABLE.isFlagSet(self._row, connTable.ROW_POSSIBLE_DIRECTORY):
+          # Checks if we match a built, single hop circuit.
           
-          if self._possibleClient:
-            # Checks that this belongs to the first hop in a circuit that's
-            # either unestablished or longer than a single hop (ie, anything but
-            # a built 1-hop connection since those are most likely a directory
-            # mirror).
-            
-            for _, status, _, path in myCircuits:
-              if path[0] == destFingerprint and (status != "BUILT" or len(path) > 1):
-                self.cachedType = Category.CIRCUIT # matched a probable guard connection
-            
-            # if we fell through, we can eliminate ourselves as a guard in the future
-            if not self.cachedType:
-              self._possibleClient = False
+          for _, status, _, path in myCircuits:
+            if path[0] == destFingerprint and status == "BUILT" and len(path) == 1:
+              cachedType = Category.DIRECTORY
           
-          if self._possibleDirectory:
-            # Checks if we match a built, single hop circuit.
-            
-            for _, status, _, path in myCircuits:
-              if path[0] == destFingerprint and status == "BUILT" and len(path) == 1:
-                self.cachedType = Category.DIRECTORY
-            
-            # if we fell through, eliminate ourselves as a directory connection
-            if not self.cachedType:
-              self._possibleDirectory = False
-      
-      if not self.cachedType:
-        self.cachedType = self.baseType
+          # if we fell through, eliminate ourselves as a directory connection
+          if not cachedType:
+            CONNECTION_TABLE.setFlag(self._row, connTable.ROW_POSSIBLE_DIRECTORY, False)
+    
+    if not cachedType:
+      cachedType = baseType
     
-    return self.cachedType
+    CONNECTION_TABLE.setType(self._row, Category.index_of(cachedType))
+    return cachedType
   
   def getEtcContent(self, width, listingType):
     """
@@ -456,11 +607,12 @@ class ConnectionLine(entries.ConnectionPanelLine):
     # for applications show the command/pid
     if self.getType() in (Category.SOCKS, Category.HIDDEN, Category.CONTROL):
       displayLabel = ""
+      appName, appPid = self.getApp()
       
-      if self.appName:
-        if self.appPid: displayLabel = "%s (%s)" % (self.appName, self.appPid)
-        else: displayLabel = self.appName
-      elif self.isAppResolving:
+      if appName:
+        if appPid: displayLabel = "%s (%s)" % (appName, appPid)
+        else: displayLabel = appName
+      elif self.isAppResolving():
         displayLabel = "resolving..."
       else: displayLabel = "UNKNOWN"
       
@@ -551,11 +703,11 @@ class ConnectionLine(entries.ConnectionPanelLine):
     # - that extra field plus any previous
     
     usedSpace = len(LABEL_FORMAT % tuple([""] * 4)) + LABEL_MIN_PADDING
-    localPort = ":%s" % self.local.getPort() if self.includePort else ""
+    localPort = ":%s" % self.local.getPort() if self.isPortIncluded() else ""
     
     src, dst, etc = "", "", ""
     if listingType == entries.ListingType.IP_ADDRESS:
-      myExternalIpAddr = conn.getInfo("address", self.local.getIpAddr())
+      myExternalIpAddr = conn.getSnapshot("address", self.local.getIpAddr())
       addrDiffer = myExternalIpAddr != self.local.getIpAddr()
       
       # Expanding doesn't make sense, if the connection isn't actually
@@ -593,7 +745,7 @@ class ConnectionLine(entries.ConnectionPanelLine):
       if isExpandedAddrVisible and CONFIG["features.connection.showColumn.fingerprint"]:
         isExpandedAddrVisible = width < usedSpace + 42 or width > usedSpace + 70
       
-      if addrDiffer and isExpansionType and isExpandedAddrVisible and self.includeExpandedIpAddr and CONFIG["features.connection.showColumn.expandedIp"]:
+      if addrDiffer and isExpansionType and isExpandedAddrVisible and CONNECTION_TABLE.isFlagSet(self._row, connTable.ROW_INCLUDE_EXPANDED_IP) and CONFIG["features.connection.showColumn.expandedIp"]:
         # include the internal address in the src (extra 28 characters)
         internalAddress = self.local.getIpAddr() + localPort
         
@@ -624,8 +776,8 @@ class ConnectionLine(entries.ConnectionPanelLine):
       if self.isPrivate():
         dst = ("%%-%is" % hostnameSpace) % "<scrubbed>"
       else:
-        hostname = self.foreign.getHostname(self.foreign.getIpAddr())
-        portLabel = ":%-5s" % self.foreign.getPort() if self.includePort else ""
+        hostname = self.foreign.getHostname(self.foreign.getIpAddr(), True)
+        portLabel = ":%-5s" % self.foreign.getPort() if self.isPortIncluded() else ""
         
         # truncates long hostnames and sets dst to <hostname>:<port>
         hostname = uiTools.cropStr(hostname, hostnameSpace, 0)
@@ -796,7 +948,7 @@ class ConnectionLine(entries.ConnectionPanelLine):
     """
     
     # the port and port derived data can be hidden by config or without includePort
-    includePort = self.includePort and (CONFIG["features.connection.showExitPort"] or self.getType() != Category.EXIT)
+    includePort = self.isPortIncluded() and (CONFIG["features.connection.showExitPort"] or self.getType() != Category.EXIT)
     
     # destination of the connection
     ipLabel = "<scrubbed>" if self.isPrivate() else self.foreign.getIpAddr()
@@ -831,7 +983,7 @@ class ConnectionLine(entries.ConnectionPanelLine):
           spaceAvailable -= len(foreignLocale) + 2
         
         if includeHostname:
-          dstHostname = self.foreign.getHostname()
+          dstHostname = self.foreign.getHostname(isVisible = True)
           
           if dstHostname:
             # determines the full space available, taking into account the ", "
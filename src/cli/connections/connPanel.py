@@ -10,7 +10,7 @@ import threading
 import cli.popups
 
 from cli.connections import countPopup, descriptorPopup, entries, connEntry, circEntry
-from util import connections, panel, torTools, uiTools
+from util import connections, connTable, hostnames, panel, torTools, uiTools
 
 from stem.control import State
 from stem.util import conf, enum
@@ -104,6 +104,13 @@ class ConnectionPanel(panel.Panel, threading.Thread):
     # it changes.
     self._lastResourceFetch = -1
     
+    # Entries for the connections we know about, keyed by the resolver's packed
+    # form of their connection (see connTable.packConnection), and the
+    # resolver generation they're current as of. This lets updates only
+    # process the changes.
+    self._connEntries = {}
+    self._connGeneration = -1
+    
     # resolver for the command/pid associated with SOCKS, HIDDEN, and CONTROL connections
     self._appResolver = connections.AppResolver("arm")
     
@@ -113,7 +120,7 @@ class ConnectionPanel(panel.Panel, threading.Thread):
     # mark the initially exitsing connection uptimes as being estimates
     for entry in self._entries:
       if isinstance(entry, connEntry.ConnectionEntry):
-        entry.getLines()[0].isInitialConnection = True
+        entry.getLines()[0].setInitialConnection(True)
     
     # listens for when tor stops so we know to stop reflecting changes
     conn.addStatusListener(self.torStateListener)
@@ -197,14 +204,14 @@ class ConnectionPanel(panel.Panel, threading.Thread):
     """
     
     conn = torTools.getConn()
-    return "Guard" in conn.getMyFlags([]) or conn.getOption("BridgeRelay", None) == "1"
+    return "Guard" in conn.getMyFlags([]) or conn.getSnapshot("BridgeRelay") == "1"
   
   def isExitsAllowed(self):
     """
     True if exit connections are permissable, false otherwise.
     """
     
-    if not torTools.getConn().getOption("ORPort", None):
+    if not torTools.getConn().getSnapshot("ORPort"):
       return False # no ORPort
     
     policy = torTools.getConn().getExitPolicy()
@@ -240,26 +247,25 @@ class ConnectionPanel(panel.Panel, threading.Thread):
     elif key == ord('u') or key == ord('U'):
       # provides a menu to pick the connection resolver
       title = "Resolver Util:"
-      options = ["auto"] + list(connections.Resolver)
+      options = [None] + list(connections.Resolver)
       connResolver = connections.getResolver("tor")
       
-      currentOverwrite = connResolver.overwriteResolver
-      if currentOverwrite == None: oldSelection = 0
-      else: oldSelection = options.index(currentOverwrite)
+      oldSelection = options.index(connResolver.overwriteResolver)
+      optionLabels = [connResolver.getResolverLabel(option) for option in options]
       
-      selection = cli.popups.showMenu(title, options, oldSelection)
+      selection = cli.popups.showMenu(title, optionLabels, oldSelection)
       
       # applies new setting
       if selection != -1:
-        selectedOption = options[selection] if selection != 0 else None
-        connResolver.overwriteResolver = selectedOption
+        connResolver.overwriteResolver = options[selection]
     elif key == ord('l') or key == ord('L'):
       # provides a menu to pick the primary information we list connections by
       title = "List By:"
       options = list(entries.ListingType)
       
-      # dropping the HOSTNAME listing type until we support displaying that content
-      options.remove(cli.connections.entries.ListingType.HOSTNAME)
+      # hostnames are only available when they can be resolved through tor
+      if not hostnames.isPrivate():
+        options.remove(cli.connections.entries.ListingType.HOSTNAME)
       
       oldSelection = options.index(self.getListingType())
       selection = cli.popups.showMenu(title, options, oldSelection)
@@ -417,6 +423,8 @@ class ConnectionPanel(panel.Panel, threading.Thread):
     self._halt = True
     self._cond.notifyAll()
     self._cond.release()
+    
+    self._appResolver.stop()
   
   def _update(self):
     """
@@ -436,22 +444,25 @@ class ConnectionPanel(panel.Panel, threading.Thread):
     newEntries = [] # the new results we'll display
     
     # Fetches new connections and client circuits...
-    # newConnections  [(local ip, local port, foreign ip, foreign port)...]
-    # newCircuits     {circuitID => (status, purpose, path)...}
+    # addedConns, removedConns  {packed connection...}
+    # newCircuits               {circuitID => (status, purpose, path)...}
     
-    newConnections = connResolver.getConnections()
+    generation, addedConns, removedConns = connResolver.getChanges(self._connGeneration)
     newCircuits = {}
     
+    if removedConns == None:
+      # resolver can't provide the changes, so diff against its full results
+      removedConns = [connKey for connKey in self._connEntries if not connKey in addedConns]
+    
     for circuitID, status, purpose, path in torTools.getConn().getCircuits():
       # Skips established single-hop circuits (these are for directory
       # fetches, not client circuits)
       if not (status == "BUILT" and len(path) == 1):
         newCircuits[circuitID] = (status, purpose, path)
     
-    # Populates newEntries with any of our old entries that still exist.
+    # Populates newEntries with any of our old circuits that still exist.
     # This is both for performance and to keep from resetting the uptime
-    # attributes. Note that CircEntries are a ConnectionEntry subclass so
-    # we need to check for them first.
+    # attributes.
     
     for oldEntry in self._entries:
       if isinstance(oldEntry, circEntry.CircEntry):
@@ -461,26 +472,23 @@ class ConnectionPanel(panel.Panel, threading.Thread):
           oldEntry.update(newEntry[0], newEntry[2])
           newEntries.append(oldEntry)
           del newCircuits[oldEntry.circuitID]
-      elif isinstance(oldEntry, connEntry.ConnectionEntry):
-        connLine = oldEntry.getLines()[0]
-        connAttr = (connLine.local.getIpAddr(), connLine.local.getPort(),
-                    connLine.foreign.getIpAddr(), connLine.foreign.getPort())
-        
-        if connAttr in newConnections:
-          newEntries.append(oldEntry)
-          newConnections.remove(connAttr)
+    
+    for connKey in removedConns:
+      self._connEntries.pop(connKey, None)
     
     # Reset any display attributes for the entries we're keeping
     for entry in newEntries: entry.resetDisplay()
+    for entry in self._connEntries.values(): entry.resetDisplay()
     
     # Adds any new connection and circuit entries.
-    for lIp, lPort, fIp, fPort in newConnections:
-      newConnEntry = connEntry.ConnectionEntry(lIp, lPort, fIp, fPort)
+    for connKey in addedConns:
+      if connKey in self._connEntries: continue
+      
+      newConnEntry = connEntry.ConnectionEntry(*connTable.unpackConnection(connKey))
       newConnLine = newConnEntry.getLines()[0]
+      self._connEntries[connKey] = newConnEntry
       
       if newConnLine.getType() != connEntry.Category.CIRCUIT:
-        newEntries.append(newConnEntry)
-        
         # updates exit port and client locale usage information
         if newConnLine.isPrivate():
           if newConnLine.getType() == connEntry.Category.INBOUND:
@@ -493,6 +501,11 @@ class ConnectionPanel(panel.Panel, threading.Thread):
             exitPort = newConnLine.foreign.getPort()
             self._exitPortUsage[exitPort] = self._exitPortUsage.get(exitPort, 0) + 1
     
+    # Connections to our guards are shown through their circuits instead.
+    for entry in self._connEntries.values():
+      if entry.getLines()[0].getType() != connEntry.Category.CIRCUIT:
+        newEntries.append(entry)
+    
     for circuitID in newCircuits:
       status, purpose, path = newCircuits[circuitID]
       newEntries.append(circEntry.CircEntry(circuitID, status, purpose, path))
@@ -527,6 +540,7 @@ class ConnectionPanel(panel.Panel, threading.Thread):
       self._entryLines += entry.getLines()
     
     self.setSortOrder()
+    self._connGeneration = generation
     self._lastResourceFetch = currentResolutionCount
     self.valsLock.release()
   
@@ -576,11 +590,9 @@ class ConnectionPanel(panel.Panel, threading.Thread):
           appPort = outboundPort if isLocal else inboundPort
           
           if linePort == appPort:
-            line.appName = cmd
-            line.appPid = pid
-            line.isAppResolving = False
+            line.setApp(cmd, pid)
       else:
-        line.isAppResolving = self._appResolver.isResolving
+        line.setAppResolving(self._appResolver.isResolving)
     
     if flagQuery:
       self.appResolveSinceUpdate = True
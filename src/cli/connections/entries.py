@@ -21,13 +21,18 @@ SORT_COLORS = {SortAttr.CATEGORY: "red",      SortAttr.UPTIME: "yellow",
 # maximum number of ports a system can have
 PORT_COUNT = 65536
 
-class ConnectionPanelEntry:
+# placeholder for display results that haven't been cached
+NO_CACHE = (None, None)
+
+class ConnectionPanelEntry(object):
   """
   Common parent for connection panel entries. This consists of a list of lines
   in the panel listing. This caches results until the display indicates that
   they should be flushed.
   """
   
+  __slots__ = ("lines", "flushCache")
+  
   def __init__(self):
     self.lines = []
     self.flushCache = True
@@ -96,21 +101,18 @@ class ConnectionPanelEntry:
     
     self.flushCache = True
 
-class ConnectionPanelLine:
+class ConnectionPanelLine(object):
   """
-  Individual line in the connection panel listing.
+  Individual line in the connection panel listing. Subclasses for connections
+  define __slots__, so lines don't have a per-instance dictionary.
   """
   
+  __slots__ = ("_listingCache", "_detailsCache")
+  
   def __init__(self):
-    # cache for displayed information
-    self._listingCache = None
-    self._listingCacheArgs = (None, None)
-    
-    self._detailsCache = None
-    self._detailsCacheArgs = None
-    
-    self._descriptorCache = None
-    self._descriptorCacheArgs = None
+    # cache for displayed information, as (arguments, results) tuples
+    self._listingCache = NO_CACHE
+    self._detailsCache = NO_CACHE
   
   def getListingPrefix(self):
     """
@@ -132,11 +134,10 @@ class ConnectionPanelLine:
                     to be displayed
     """
     
-    if self._listingCacheArgs != (width, listingType):
-      self._listingCache = self._getListingEntry(width, currentTime, listingType)
-      self._listingCacheArgs = (width, listingType)
+    if self._listingCache[0] != (width, listingType):
+      self._listingCache = ((width, listingType), self._getListingEntry(width, currentTime, listingType))
     
-    return self._listingCache
+    return self._listingCache[1]
   
   def _getListingEntry(self, width, currentTime, listingType):
     # implementation of getListingEntry
@@ -151,11 +152,10 @@ class ConnectionPanelLine:
       width - available space to display in
     """
     
-    if self._detailsCacheArgs != width:
-      self._detailsCache = self._getDetails(width)
-      self._detailsCacheArgs = width
+    if self._detailsCache[0] != width:
+      self._detailsCache = (width, self._getDetails(width))
     
-    return self._detailsCache
+    return self._detailsCache[1]
   
   def _getDetails(self, width):
     # implementation of getDetails
@@ -166,6 +166,6 @@ class ConnectionPanelLine:
     Flushes cached display results.
     """
     
-    self._listingCacheArgs = (None, None)
-    self._detailsCacheArgs = None
+    self._listingCache = NO_CACHE
+    self._detailsCache = NO_CACHE
 
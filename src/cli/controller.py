@@ -6,6 +6,7 @@ user input to the proper panels.
 import os
 import time
 import curses
+import calendar
 import threading
 
 import cli.menu.menu
@@ -20,11 +21,11 @@ import cli.graphing.connStats
 import cli.graphing.resourceStats
 import cli.connections.connPanel
 
-from stem.control import State, Controller
+from stem.control import State, Controller, EventType
 
 from util import connections, hostnames, panel, sysTools, torConfig, torTools
 
-from stem.util import conf, enum, log
+from stem.util import conf, enum, log, proc
 
 ARM_CONTROLLER = None
 
@@ -50,10 +51,11 @@ CONFIG = conf.config_dict("arm", {
   "features.graph.bw.prepopulate": True,
 }, conf_handler)
 
-GraphStat = enum.Enum("BANDWIDTH", "CONNECTIONS", "SYSTEM_RESOURCES")
+GraphStat = enum.Enum("BANDWIDTH", "CONNECTIONS", "SYSTEM_RESOURCES", "THREADS", "DISK_IO", "CONTEXT_SWITCHES")
 
 # maps 'features.graph.type' config values to the initial types
-GRAPH_INIT_STATS = {1: GraphStat.BANDWIDTH, 2: GraphStat.CONNECTIONS, 3: GraphStat.SYSTEM_RESOURCES}
+GRAPH_INIT_STATS = {1: GraphStat.BANDWIDTH, 2: GraphStat.CONNECTIONS, 3: GraphStat.SYSTEM_RESOURCES,
+                    4: GraphStat.THREADS, 5: GraphStat.DISK_IO, 6: GraphStat.CONTEXT_SWITCHES}
 
 def getController():
   """
@@ -110,6 +112,13 @@ def initController(stdscr, startTime):
     bwStats = cli.graphing.bandwidthStats.BandwidthStats()
     graphPanel.addStats(GraphStat.BANDWIDTH, bwStats)
     graphPanel.addStats(GraphStat.SYSTEM_RESOURCES, cli.graphing.resourceStats.ResourceStats())
+    
+    # extended resource usage is read from proc
+    if proc.is_available():
+      graphPanel.addStats(GraphStat.THREADS, cli.graphing.resourceStats.ThreadStats())
+      graphPanel.addStats(GraphStat.DISK_IO, cli.graphing.resourceStats.IoStats())
+      graphPanel.addStats(GraphStat.CONTEXT_SWITCHES, cli.graphing.resourceStats.ContextSwitchStats())
+    
     if not CONFIG["startup.blindModeEnabled"]:
       graphPanel.addStats(GraphStat.CONNECTIONS, cli.graphing.connStats.ConnStats())
     
@@ -453,11 +462,11 @@ def shutdownDaemons():
   # joins on utility daemon threads - this might take a moment since the
   # internal threadpools being joined might be sleeping
   hostnames.stop()
-  resourceTrackers = sysTools.RESOURCE_TRACKERS.values()
+  resourceSampler = sysTools.RESOURCE_SAMPLER
   resolver = connections.getResolver("tor") if connections.isResolverAlive("tor") else None
-  for tracker in resourceTrackers: tracker.stop()
+  if resourceSampler: resourceSampler.stop()
   if resolver: resolver.stop()  # sets halt flag (returning immediately)
-  for tracker in resourceTrackers: tracker.join()
+  if resourceSampler: resourceSampler.join()
   if resolver: resolver.join()  # joins on halted resolver
 
 def heartbeatCheck(isUnresponsive):
@@ -504,6 +513,35 @@ def connResetListener(controller, eventType, _):
       if torPid and torPid != resolver.getPid():
         resolver.setPid(torPid)
 
+def orconnListener(event):
+  """
+  Passes tor's relay connection changes to our connection resolver, so these
+  are reflected without waiting for its next lookup.
+  """
+  
+  if connections.isResolverAlive("tor"):
+    ipAddr, port = event.endpoint_address, event.endpoint_port
+    
+    # relays are usually identified by their fingerprint instead
+    if not ipAddr and event.endpoint_fingerprint:
+      ipAddr, port = torTools.getConn().getRelayAddress(event.endpoint_fingerprint, (None, None))
+    
+    if port: port = str(port)
+    connections.getResolver("tor").handleOrConnStatus(event.status, ipAddr, port)
+
+def addrmapListener(event):
+  """
+  Passes the results of hostname lookups that tor has made for us to the
+  hostname resolver.
+  """
+  
+  ttl = None
+  
+  if event.utc_expiry:
+    ttl = max(0, calendar.timegm(event.utc_expiry.timetuple()) - time.time())
+  
+  hostnames.handleAddrMap(event.hostname, event.destination, event.error, ttl)
+
 def startTorMonitor(startTime):
   """
   Initializes the interface and starts the main draw loop.
@@ -536,6 +574,10 @@ def startTorMonitor(startTime):
       connections.getResolver("tor").setPaused(True)
     else:
       torTools.REQ_EVENTS["CIRC"] = "may cause issues in identifying client connections"
+      torTools.REQ_EVENTS["ORCONN"] = "connections will only be updated by polling"
+      
+      if hostnames.isPrivate():
+        torTools.REQ_EVENTS["ADDRMAP"] = "hostnames won't be resolved"
       
       # Configures connection resoultions. This is paused/unpaused according to
       # if Tor's connected or not.
@@ -550,6 +592,13 @@ def startTorMonitor(startTime):
         # it to be paused
         connections.getResolver("tor").setPaused(not conn.isAlive())
       
+      # applies relay connection changes as tor reports them
+      conn.addEventListener(orconnListener, EventType.ORCONN)
+      
+      # provides the hostname lookups we have tor make
+      if hostnames.isPrivate():
+        conn.addEventListener(addrmapListener, EventType.ADDRMAP)
+      
       # hack to display a better (arm specific) notice if all resolvers fail
       connections.RESOLVER_FINAL_FAILURE_MSG = "We were unable to use any of your system's resolvers to get tor's connections. This is fine, but means that the connections page will be empty. This is usually permissions related so if you would like to fix this then run arm with the same user as tor (ie, \"sudo -u <tor user> arm\")."
   
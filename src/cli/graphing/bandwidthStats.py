@@ -9,10 +9,10 @@ import curses
 import cli.controller
 
 from cli.graphing import graphPanel
-from util import torTools, uiTools
+from util import sysTools, torTools, uiTools
 
 from stem.control import State
-from stem.util import conf, log, str_tools, system
+from stem.util import conf, log, str_tools
 
 def conf_handler(key, value):
   if key == "features.graph.bw.accounting.rate":
@@ -129,7 +129,7 @@ class BandwidthStats(graphPanel.GraphStats):
     if queryPid:
       queryParam = ["%cpu", "rss", "%mem", "etime"]
       queryCmd = "ps -p %s -o %s" % (queryPid, ",".join(queryParam))
-      psCall = system.call(queryCmd, None)
+      psCall = sysTools.call(queryCmd, None, "bandwidth state")
       
       if psCall and len(psCall) == 2:
         stats = psCall[1].strip().split()
@@ -390,10 +390,13 @@ class BandwidthStats(graphPanel.GraphStats):
     
     conn = torTools.getConn()
     queried = dict([(arg, "") for arg in ACCOUNTING_ARGS])
-    queried["status"] = conn.getInfo("accounting/hibernating", None)
+    
+    accountingParams = ("accounting/hibernating", "accounting/interval-end", "accounting/bytes", "accounting/bytes-left")
+    accountingVals = conn.getInfoMany(accountingParams, dict.fromkeys(accountingParams))
+    queried["status"] = accountingVals["accounting/hibernating"]
     
     # provides a nicely formatted reset time
-    endInterval = conn.getInfo("accounting/interval-end", None)
+    endInterval = accountingVals["accounting/interval-end"]
     if endInterval:
       # converts from gmt to local with respect to DST
       if time.localtime()[8]: tz_offset = time.altzone
@@ -412,8 +415,8 @@ class BandwidthStats(graphPanel.GraphStats):
         queried["resetTime"] = "%i:%02i:%02i:%02i" % (days, hours, minutes, sec)
     
     # number of bytes used and in total for the accounting period
-    used = conn.getInfo("accounting/bytes", None)
-    left = conn.getInfo("accounting/bytes-left", None)
+    used = accountingVals["accounting/bytes"]
+    left = accountingVals["accounting/bytes-left"]
     
     if used and left:
       usedComp, leftComp = used.split(" "), left.split(" ")
@@ -3,7 +3,7 @@ Tracks stats concerning tor's current connections.
 """
 
 from cli.graphing import graphPanel
-from util import connections, torTools
+from util import connections, connTable, torTools
 
 from stem.control import State
 
@@ -16,6 +16,11 @@ class ConnStats(graphPanel.GraphStats):
   def __init__(self):
     graphPanel.GraphStats.__init__(self)
     
+    # Running connection counts, revised with the resolver's changes since the
+    # generation we last saw.
+    self._inboundCount, self._outboundCount = 0, 0
+    self._connGeneration = -1
+    
     # listens for tor reload (sighup) events which can reset the ports tor uses
     conn = torTools.getConn()
     self.orPort, self.dirPort, self.controlPort = "0", "0", "0"
@@ -31,21 +36,39 @@ class ConnStats(graphPanel.GraphStats):
       self.orPort = controller.get_conf("ORPort", "0")
       self.dirPort = controller.get_conf("DirPort", "0")
       self.controlPort = controller.get_conf("ControlPort", "0")
+      self._connGeneration = -1 # ports might have changed so recount
   
   def eventTick(self):
     """
     Fetches connection stats from cached information.
     """
     
-    inboundCount, outboundCount = 0, 0
+    generation, added, removed = connections.getResolver("tor").getChanges(self._connGeneration)
+    
+    if removed == None:
+      # full listing of the current connections, so count from scratch
+      self._inboundCount, self._outboundCount = 0, 0
+      removed = ()
     
-    for entry in connections.getResolver("tor").getConnections():
-      localPort = entry[1]
-      if localPort in (self.orPort, self.dirPort): inboundCount += 1
-      elif localPort == self.controlPort: pass # control connection
-      else: outboundCount += 1
+    for entry in added: self._countConnection(entry, 1)
+    for entry in removed: self._countConnection(entry, -1)
+    
+    self._connGeneration = generation
+    self._processEvent(self._inboundCount, self._outboundCount)
+  
+  def _countConnection(self, entry, delta):
+    """
+    Adjusts our inbound or outbound count for the given connection.
+    
+    Arguments:
+      entry - packed connection from the resolver
+      delta - amount to adjust the count by
+    """
     
-    self._processEvent(inboundCount, outboundCount)
+    localPort = connTable.unpackConnection(entry)[1]
+    if localPort in (self.orPort, self.dirPort): self._inboundCount += delta
+    elif localPort == self.controlPort: pass # control connection
+    else: self._outboundCount += delta
   
   def getTitle(self, width):
     return "Connection Count:"
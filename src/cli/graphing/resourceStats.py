@@ -1,5 +1,6 @@
 """
-Tracks the system resource usage (cpu and memory) of the tor process.
+Tracks the system resource usage (cpu and memory, and with proc also per-thread
+cpu, disk io, and context switches) of the tor process.
 """
 
 from cli.graphing import graphPanel
@@ -51,3 +52,115 @@ class ResourceStats(graphPanel.GraphStats):
     
     self._processEvent(primary, secondary)
 
+
+class ExtendedResourceStats(graphPanel.GraphStats):
+  """
+  Base for graphs of the extended resource usage sampled by the
+  ResourceTracker, which is only available when proc is.
+  """
+  
+  def __init__(self):
+    graphPanel.GraphStats.__init__(self)
+    self.queryPid = torTools.getConn().getMyPid()
+  
+  def eventTick(self):
+    """
+    Fetch the cached measurement of extended usage from the ResourceTracker.
+    """
+    
+    primary, secondary = 0, 0
+    if self.queryPid:
+      resourceTracker = sysTools.getResourceTracker(self.queryPid, True)
+      
+      if resourceTracker and not resourceTracker.lastQueryFailed():
+        usage = resourceTracker.getExtendedUsage()
+        if usage: primary, secondary = self._getValues(usage)
+    
+    self._processEvent(primary, secondary)
+  
+  def _getValues(self, usage):
+    """
+    Provides the (primary, secondary) values to be graphed.
+    
+    Arguments:
+      usage - extended usage, as provided by the ResourceTracker
+    """
+    
+    return (0, 0)
+
+class ThreadStats(ExtendedResourceStats):
+  """
+  Cpu usage of tor's main thread versus its others (such as cpuworkers), to
+  show when the main thread is the bottleneck.
+  """
+  
+  def __init__(self):
+    ExtendedResourceStats.__init__(self)
+    self.threadCount = 0
+  
+  def clone(self, newCopy=None):
+    if not newCopy: newCopy = ThreadStats()
+    newCopy.threadCount = self.threadCount
+    return graphPanel.GraphStats.clone(self, newCopy)
+  
+  def getTitle(self, width):
+    return "Thread CPU Usage (%i threads):" % self.threadCount
+  
+  def getHeaderLabel(self, width, isPrimary):
+    avg = (self.primaryTotal if isPrimary else self.secondaryTotal) / max(1, self.tick)
+    lastAmount = self.lastPrimary if isPrimary else self.lastSecondary
+    label = "Main Thread" if isPrimary else "Other Threads"
+    return "%s (%0.1f%%, avg: %0.1f%%):" % (label, lastAmount, avg)
+  
+  def _getValues(self, usage):
+    self.threadCount = len(usage["threads"])
+    return (usage["mainThreadCpu"] * 100, usage["otherThreadCpu"] * 100)
+
+class IoStats(ExtendedResourceStats):
+  """
+  Rate that tor reads from and writes to storage.
+  """
+  
+  def clone(self, newCopy=None):
+    if not newCopy: newCopy = IoStats()
+    return graphPanel.GraphStats.clone(self, newCopy)
+  
+  def getTitle(self, width):
+    return "Disk I/O:"
+  
+  def getHeaderLabel(self, width, isPrimary):
+    avg = (self.primaryTotal if isPrimary else self.secondaryTotal) / max(1, self.tick)
+    lastAmount = self.lastPrimary if isPrimary else self.lastSecondary
+    label = "Read" if isPrimary else "Written"
+    
+    # rates are converted from KB to B before generating labels
+    rateLabel = str_tools.get_size_label(lastAmount * 1024, 1)
+    avgLabel = str_tools.get_size_label(avg * 1024, 1)
+    return "%s (%s/sec, avg: %s/sec):" % (label, rateLabel, avgLabel)
+  
+  def _getValues(self, usage):
+    # translate rates to KB so axis labels are short
+    ioRead, ioWrite = usage["ioRead"] or 0, usage["ioWrite"] or 0
+    return (ioRead / 1024, ioWrite / 1024)
+
+class ContextSwitchStats(ExtendedResourceStats):
+  """
+  Rate of voluntary context switches (waiting on io or locks) and involuntary
+  ones (preempted by the scheduler).
+  """
+  
+  def clone(self, newCopy=None):
+    if not newCopy: newCopy = ContextSwitchStats()
+    return graphPanel.GraphStats.clone(self, newCopy)
+  
+  def getTitle(self, width):
+    return "Context Switches:"
+  
+  def getHeaderLabel(self, width, isPrimary):
+    avg = (self.primaryTotal if isPrimary else self.secondaryTotal) / max(1, self.tick)
+    lastAmount = self.lastPrimary if isPrimary else self.lastSecondary
+    label = "Voluntary" if isPrimary else "Involuntary"
+    return "%s (%0.1f/sec, avg: %0.1f/sec):" % (label, lastAmount, avg)
+  
+  def _getValues(self, usage):
+    return (usage["ctxVoluntary"], usage["ctxInvoluntary"])
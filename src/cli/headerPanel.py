@@ -45,6 +45,13 @@ FLAG_COLORS = {"Authority": "white",  "BadExit": "red",     "BadDirectory": "red
 VERSION_STATUS_COLORS = {"new": "blue", "new in series": "blue", "obsolete": "red", "recommended": "green",  
                          "old": "red",  "unrecommended": "red",  "unknown": "cyan"}
 
+# GETINFO and GETCONF parameters fetched when resetting static values, mapped
+# to their defaults
+STATIC_INFO = {"version": "Unknown", "status/version/current": "Unknown"}
+STATIC_OPTIONS = {"Nickname": "", "ORPort": "0", "DirPort": "0", "ControlPort": "0",
+                  "ControlSocket": "", "HashedControlPassword": None,
+                  "CookieAuthentication": None, "ORListenAddress": None}
+
 CONFIG = conf.config_dict("arm", {
   "startup.interface.ipAddress": "127.0.0.1",
   "startup.interface.port": 9051,
@@ -92,7 +99,7 @@ class HeaderPanel(panel.Panel, threading.Thread):
     # give smoother results (staying in the same ballpark as the second
     # sampling) so fudging the numbers this way for now.
     
-    self._armCpuSampling = (sum(os.times()[:3]), startTime)
+    self._armCpuSampling = (sum(os.times()[:4]), startTime)
     
     # Last sampling received from the ResourceTracker, used to detect when it
     # changes.
@@ -474,22 +481,26 @@ class HeaderPanel(panel.Panel, threading.Thread):
     if setStatic:
       # version is truncated to first part, for instance:
       # 0.2.2.13-alpha (git-feb8c1b5f67f2c6f) -> 0.2.2.13-alpha
-      self.vals["tor/version"] = conn.getInfo("version", "Unknown").split()[0]
-      self.vals["tor/versionStatus"] = conn.getInfo("status/version/current", "Unknown")
-      self.vals["tor/nickname"] = conn.getOption("Nickname", "")
-      self.vals["tor/orPort"] = conn.getOption("ORPort", "0")
-      self.vals["tor/dirPort"] = conn.getOption("DirPort", "0")
-      self.vals["tor/controlPort"] = conn.getOption("ControlPort", "0")
-      self.vals["tor/socketPath"] = conn.getOption("ControlSocket", "")
-      self.vals["tor/isAuthPassword"] = conn.getOption("HashedControlPassword", None) != None
-      self.vals["tor/isAuthCookie"] = conn.getOption("CookieAuthentication", None) == "1"
+      # static values are fetched with a single GETINFO and GETCONF request
+      infoVals = conn.getInfoMany(STATIC_INFO.keys(), STATIC_INFO)
+      optionVals = conn.getOptionMany(STATIC_OPTIONS.keys(), STATIC_OPTIONS)
+      
+      self.vals["tor/version"] = infoVals["version"].split()[0]
+      self.vals["tor/versionStatus"] = infoVals["status/version/current"]
+      self.vals["tor/nickname"] = optionVals["Nickname"]
+      self.vals["tor/orPort"] = optionVals["ORPort"]
+      self.vals["tor/dirPort"] = optionVals["DirPort"]
+      self.vals["tor/controlPort"] = optionVals["ControlPort"]
+      self.vals["tor/socketPath"] = optionVals["ControlSocket"]
+      self.vals["tor/isAuthPassword"] = optionVals["HashedControlPassword"] != None
+      self.vals["tor/isAuthCookie"] = optionVals["CookieAuthentication"] == "1"
       
       # orport is reported as zero if unset
       if self.vals["tor/orPort"] == "0": self.vals["tor/orPort"] = ""
       
       # overwrite address if ORListenAddress is set (and possibly orPort too)
       self.vals["tor/orListenAddr"] = ""
-      listenAddr = conn.getOption("ORListenAddress", None)
+      listenAddr = optionVals["ORListenAddress"]
       if listenAddr:
         if ":" in listenAddr:
           # both ip and port overwritten
@@ -576,14 +587,14 @@ class HeaderPanel(panel.Panel, threading.Thread):
         self.vals["stat/%mem"] = "%0.1f" % (100 * memUsagePercent)
     
     # determines the cpu time for the arm process (including user and system
-    # time of both the primary and child processes)
+    # time of both the primary and child processes). Child times cover every
+    # system call we've made and waited on, which is the same figure that
+    # sysTools breaks down by caller, so it isn't added a second time.
     
-    totalArmCpuTime, currentTime = sum(os.times()[:3]), time.time()
+    totalArmCpuTime, currentTime = sum(os.times()[:4]), time.time()
     armCpuDelta = totalArmCpuTime - self._armCpuSampling[0]
     armTimeDelta = currentTime - self._armCpuSampling[1]
-    pythonCpuTime = armCpuDelta / armTimeDelta
-    sysCallCpuTime = sysTools.getSysCpuUsage()
-    self.vals["stat/%armCpu"] = "%0.1f" % (100 * (pythonCpuTime + sysCallCpuTime))
+    self.vals["stat/%armCpu"] = "%0.1f" % (100 * armCpuDelta / armTimeDelta)
     self._armCpuSampling = (totalArmCpuTime, currentTime)
     
     self._lastUpdate = currentTime
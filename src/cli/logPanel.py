@@ -14,7 +14,7 @@ import threading
 import stem
 from stem.control import State
 from stem.response import events
-from stem.util import conf, log, system
+from stem.util import conf, log
 
 import popups
 from version import VERSION
@@ -247,7 +247,7 @@ def getLogFileEntries(runlevels, readLimit = None, addLimit = None):
   lines = []
   try:
     if readLimit:
-      lines = system.call("tail -n %i %s" % (readLimit, loggingLocation))
+      lines = sysTools.call("tail -n %i %s" % (readLimit, loggingLocation), caller = "log prepopulation")
       if not lines: raise IOError()
     else:
       logFile = open(loggingLocation, "r")
@@ -9,7 +9,7 @@ import cli.controller
 import cli.menu.item
 import cli.graphing.graphPanel
 
-from util import connections, torTools, uiTools
+from util import connections, hostnames, torTools, uiTools
 
 from stem.util import conf, str_tools
 
@@ -111,11 +111,13 @@ def makeHelpMenu():
   """
   Submenu consisting of...
     Hotkeys
+    System Calls
     About
   """
   
   helpMenu = cli.menu.item.Submenu("Help")
   helpMenu.add(cli.menu.item.MenuItem("Hotkeys", cli.popups.showHelpPopup))
+  helpMenu.add(cli.menu.item.MenuItem("System Calls", cli.popups.showSysCallPopup))
   helpMenu.add(cli.menu.item.MenuItem("About", cli.popups.showAboutPopup))
   return helpMenu
 
@@ -227,7 +229,10 @@ def makeConnectionsMenu(connPanel):
   listingGroup = cli.menu.item.SelectionGroup(connPanel.setListingType, connPanel.getListingType())
   
   listingOptions = list(cli.connections.entries.ListingType)
-  listingOptions.remove(cli.connections.entries.ListingType.HOSTNAME)
+  
+  # hostnames are only available when they can be resolved through tor
+  if not hostnames.isPrivate():
+    listingOptions.remove(cli.connections.entries.ListingType.HOSTNAME)
   
   for option in listingOptions:
     connectionsMenu.add(cli.menu.item.SelectionMenuItem(option, listingGroup, option))
@@ -240,10 +245,9 @@ def makeConnectionsMenu(connPanel):
   resolverMenu = cli.menu.item.Submenu("Resolver")
   resolverGroup = cli.menu.item.SelectionGroup(connResolver.setOverwriteResolver, connResolver.getOverwriteResolver())
   
-  resolverMenu.add(cli.menu.item.SelectionMenuItem("auto", resolverGroup, None))
-  
-  for option in connections.Resolver:
-    resolverMenu.add(cli.menu.item.SelectionMenuItem(option, resolverGroup, option))
+  for option in [None] + list(connections.Resolver):
+    optionLabel = connResolver.getResolverLabel(option)
+    resolverMenu.add(cli.menu.item.SelectionMenuItem(optionLabel, resolverGroup, option))
   
   connectionsMenu.add(resolverMenu)
   
@@ -7,7 +7,9 @@ import curses
 import version
 import cli.controller
 
-from util import panel, uiTools
+from util import panel, sysTools, uiTools
+
+from stem.util import str_tools
 
 def init(height = -1, width = -1, top = 0, left = 0, belowStatic = True):
   """
@@ -180,6 +182,42 @@ def showAboutPopup():
     control.getScreen().getch()
   finally: finalize()
 
+def showSysCallPopup():
+  """
+  Presents a popup with the cost of the system calls we've made, broken down
+  by their caller.
+  """
+  
+  callStats = sysTools.getCallStats()
+  popup, _, height = init(6 + max(1, len(callStats)), 80)
+  if not popup: return
+  
+  try:
+    control = cli.controller.getController()
+    
+    popup.win.box()
+    popup.addstr(0, 0, "System Calls:", curses.A_STANDOUT)
+    popup.addstr(1, 2, "%-24s %7s %10s %10s %12s" % ("Caller", "Calls", "Runtime", "Cpu Time", "Read"), curses.A_BOLD)
+    
+    if not callStats:
+      popup.addstr(2, 2, "No system calls have been made")
+    
+    for i in range(len(callStats)):
+      if i + 2 >= height - 3: break
+      
+      caller, callCount, runtime, cpuTime, bytesRead = callStats[i]
+      readLabel = str_tools.get_size_label(bytesRead, 1)
+      popup.addstr(i + 2, 2, "%-24s %7i %9.2fs %9.2fs %12s" % (caller[:24], callCount, runtime, cpuTime, readLabel))
+    
+    recentUsage = "recent cpu usage: %0.1f%%" % (100 * sysTools.getSysCpuUsage())
+    popup.addstr(height - 3, 2, recentUsage)
+    popup.addstr(height - 2, 2, "Press any key...")
+    popup.win.refresh()
+    
+    curses.cbreak()
+    control.getScreen().getch()
+  finally: finalize()
+
 def showSortDialog(title, options, oldSelection, optionColors):
   """
   Displays a sorting dialog of the form:
@@ -0,0 +1,6 @@
+"""
+Unit tests for arm. These are ran from the src directory with...
+
+  python -m unittest discover -s test -t .
+"""
+
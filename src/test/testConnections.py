@@ -0,0 +1,156 @@
+"""
+Tests for util.connections.
+"""
+
+import os
+import time
+import socket
+import unittest
+
+from stem.util import system
+
+from util import connTable, connections
+
+def _waitForResolver(resolver, timeout = 10):
+  """
+  Blocks until an AppResolver finishes its queued lookup, failing if it takes
+  longer than the timeout.
+  
+  Arguments:
+    resolver - AppResolver that's been asked to resolve some ports
+    timeout  - maximum seconds to wait
+  """
+  
+  endTime = time.time() + timeout
+  
+  while resolver.isResolving:
+    if time.time() > endTime: raise AssertionError("application lookup didn't finish")
+    resolver.getResults(0.1)
+
+class TestAppResolver(unittest.TestCase):
+  def setUp(self):
+    self.resolver = connections.AppResolver("python")
+    self.resolver._useProc = False
+    self.sockets = []
+  
+  def tearDown(self):
+    self.resolver.stop()
+    if self.resolver._thread: self.resolver._thread.join(5)
+    for sock in self.sockets: sock.close()
+  
+  def _connect(self):
+    """
+    Provides the port of a connection we make to ourselves.
+    """
+    
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    
+    client = socket.socket()
+    client.connect(listener.getsockname())
+    self.sockets += [listener, client, listener.accept()[0]]
+    
+    return str(client.getsockname()[1])
+  
+  def test_lsofFailure(self):
+    """
+    Looks up a port without any sockets, which lsof fails on, followed by one
+    that we're connected with.
+    """
+    
+    if not system.is_available("lsof"): self.skipTest("lsof is unavailable")
+    
+    unusedSocket = socket.socket()
+    unusedSocket.bind(("127.0.0.1", 0))
+    unusedPort = str(unusedSocket.getsockname()[1])
+    unusedSocket.close()
+    
+    self.resolver.resolve([unusedPort])
+    _waitForResolver(self.resolver)
+    self.assertEqual({}, self.resolver.getResults())
+    
+    port = self._connect()
+    self.resolver.resolve([port])
+    _waitForResolver(self.resolver)
+    
+    results = self.resolver.getResults()
+    self.assertTrue(port in results)
+    self.assertTrue(str(os.getpid()) in [entry[3] for entry in results[port]])
+  
+  def test_lookupException(self):
+    """
+    Checks that our thread survives a lookup raising an unexpected exception.
+    """
+    
+    def raiseError(ports): raise OSError("lookup failed")
+    self.resolver._queryLsof = raiseError
+    
+    self.resolver.resolve(["80"])
+    _waitForResolver(self.resolver)
+    self.assertTrue(self.resolver._thread.isAlive())
+    self.assertEqual(1, self.resolver.failureCount)
+    
+    results = {"80": [("80", "4325", "firefox", "3271")]}
+    self.resolver._queryLsof = lambda ports: results
+    self.resolver.resolve(["80"])
+    _waitForResolver(self.resolver)
+    self.assertEqual(results, self.resolver.getResults())
+
+class TestConnectionResolver(unittest.TestCase):
+  def setUp(self):
+    self.resolver = connections.ConnectionResolver("tor", "1", resolveRate = 60)
+    self.resolver.overwriteResolver = connections.Resolver.PROC
+    self.lookups = []
+    
+    # each lookup takes 20 ms, so those prompted by events are two seconds apart
+    def resolve(resolver, maxAge = connections.SHARED_SCAN_MAX_AGE):
+      self.lookups.append(time.time())
+      return ([], 0.02, 0.02)
+    
+    self.resolver._resolve = resolve
+  
+  def tearDown(self):
+    self.resolver.stop()
+    if self.resolver.isAlive(): self.resolver.join(5)
+  
+  def test_connectedBurst(self):
+    """
+    Sends a steady stream of CONNECTED events for new connections, checking
+    that the early lookups they prompt back off with the lookup's runtime.
+    """
+    
+    self.resolver.start()
+    endTime = time.time() + 3
+    
+    for i in range(300):
+      if time.time() > endTime: break
+      self.resolver.handleOrConnStatus("CONNECTED", "10.0.%i.%i" % (i / 250, i % 250 + 1), "9001")
+      time.sleep(0.01)
+    
+    while time.time() < endTime: time.sleep(0.1)
+    
+    # the initial lookup and one prompted by the events, plus one if our
+    # periodic lookup happened to fall within the test
+    self.assertTrue(2 <= len(self.lookups) <= 3, "made %i lookups" % len(self.lookups))
+    
+    for lastLookup, lookup in zip(self.lookups, self.lookups[1:]):
+      self.assertTrue(lookup - lastLookup >= 1.9)
+  
+  def test_connectedKnown(self):
+    """
+    Checks that CONNECTED events for connections we already have don't prompt
+    an early lookup, while those for new connections do.
+    """
+    
+    self.resolver._connections = frozenset([connTable.packConnection("127.0.0.1", "5000", "1.2.3.4", "9001")])
+    
+    self.resolver.handleOrConnStatus("CONNECTED", "1.2.3.4", "9001")
+    self.assertEqual(None, self.resolver._refreshRequestTime)
+    
+    self.resolver.handleOrConnStatus("CONNECTED", "1.2.3.4", "443")
+    self.assertNotEqual(None, self.resolver._refreshRequestTime)
+
+if __name__ == '__main__':
+  unittest.main()
+
@@ -0,0 +1,482 @@
+"""
+Compact storage for connection attributes. Rather than holding strings and
+objects for each connection this keeps them in columns of packed values, with
+entries identified by their row:
+  local/foreign address - index into a pool of the addresses in use
+  local/foreign port    - unsigned short
+  category              - signed byte (-1 if unset)
+  type                  - signed byte, the category we've last resolved for
+                          the connection (-1 if unset)
+  flags                 - unsigned byte of ROW_* flags
+  start time            - double
+
+Addresses are pooled since most of them repeat (our local address is shared
+by nearly every connection, and relays commonly have several connections
+with us). Each pool entry has the address' string and sort value, so neither
+need to be derived when they're asked for, and is dropped when the last row
+using it is released. Attributes that only a few rows have (fingerprints we
+were told about and application information) are kept in dictionaries.
+
+Released rows are reused by later additions, so the table is only as large as
+the most connections we've held at once.
+
+Connections are keyed by packConnection's thirty six byte form rather than
+(local ip, local port, foreign ip, foreign port) tuples, which take several
+times the space.
+"""
+
+import array
+import socket
+import struct
+import threading
+
+# prefix of IPv4-mapped IPv6 addresses (::ffff:0:0/96)
+IPV4_MAPPED_PREFIX = "\x00" * 10 + "\xff\xff"
+
+# layout of packed connections (local address, local port, foreign address,
+# foreign port)
+CONNECTION_FORMAT = "!16sH16sH"
+FOREIGN_ADDR_SLICE = slice(18, 34)
+FOREIGN_PORT_SLICE = slice(34, 36)
+
+# flags of a row
+ROW_INITIAL = 1               # existed when we started
+ROW_POSSIBLE_CLIENT = 2       # might be the first hop of one of our circuits
+ROW_POSSIBLE_DIRECTORY = 4    # might be a single hop directory circuit
+ROW_INCLUDE_PORT = 8          # port is shown in the listing
+ROW_INCLUDE_EXPANDED_IP = 16  # internal address is shown in the listing
+ROW_APP_RESOLVING = 32        # application lookup is in progress
+ROW_LOCAL_NOT_ORPORT = 64     # local port is definitely not an ORPort
+ROW_FOREIGN_NOT_ORPORT = 128  # foreign port is definitely not an ORPort
+
+def packAddress(ipAddr):
+  """
+  Provides the sixteen byte network order form of an IPv4 or IPv6 address.
+  This raises a ValueError if the address is malformed.
+  
+  Arguments:
+    ipAddr - address to be packed
+  """
+  
+  try:
+    if ":" in ipAddr: return socket.inet_pton(socket.AF_INET6, ipAddr)
+    else: return IPV4_MAPPED_PREFIX + socket.inet_aton(ipAddr)
+  except socket.error:
+    raise ValueError("'%s' isn't a valid ip address" % ipAddr)
+
+def unpackAddress(packedAddr):
+  """
+  Provides the string form of an address from packAddress.
+  
+  Arguments:
+    packedAddr - sixteen byte address to be converted
+  """
+  
+  if packedAddr.startswith(IPV4_MAPPED_PREFIX):
+    return socket.inet_ntoa(packedAddr[12:])
+  else: return socket.inet_ntop(socket.AF_INET6, packedAddr)
+
+def addressToInt(packedAddr):
+  """
+  Provides the integer value of an address from packAddress. These order IPv4
+  addresses numerically, followed by IPv6.
+  
+  Arguments:
+    packedAddr - sixteen byte address to be converted
+  """
+  
+  high, low = struct.unpack("!QQ", packedAddr)
+  
+  # moves IPv4-mapped addresses ahead of everything else
+  if packedAddr.startswith(IPV4_MAPPED_PREFIX): return low & 0xffffffff
+  else: return (high << 64) + low + 0x100000000
+
+def packConnection(lIpAddr, lPort, fIpAddr, fPort):
+  """
+  Provides the thirty six byte form of a connection, which is hashable and
+  can be used to key it. This raises a ValueError if the addresses or ports
+  are malformed.
+  
+  Arguments:
+    lIpAddr - local ip address
+    lPort   - local port
+    fIpAddr - foreign ip address
+    fPort   - foreign port
+  """
+  
+  try:
+    return struct.pack(CONNECTION_FORMAT, packAddress(lIpAddr), int(lPort), packAddress(fIpAddr), int(fPort))
+  except struct.error:
+    raise ValueError("'%s:%s' or '%s:%s' has an invalid port" % (lIpAddr, lPort, fIpAddr, fPort))
+
+def unpackConnection(connKey):
+  """
+  Provides the (local ip, local port, foreign ip, foreign port) tuple for a
+  connection from packConnection.
+  
+  Arguments:
+    connKey - packed connection to be converted
+  """
+  
+  lPacked, lPort, fPacked, fPort = struct.unpack(CONNECTION_FORMAT, connKey)
+  return (unpackAddress(lPacked), str(lPort), unpackAddress(fPacked), str(fPort))
+
+def isForeignEndpoint(connKey, packedAddr, port = None):
+  """
+  Checks if a packed connection's foreign endpoint has the given address and,
+  if provided, port.
+  
+  Arguments:
+    connKey    - packed connection to be checked
+    packedAddr - address from packAddress
+    port       - port to match, this isn't checked if None
+  """
+  
+  if connKey[FOREIGN_ADDR_SLICE] != packedAddr: return False
+  elif port is None: return True
+  else: return connKey[FOREIGN_PORT_SLICE] == struct.pack("!H", int(port))
+
+class ConnectionTable:
+  """
+  Column oriented store of connection endpoints, categories, and start times.
+  """
+  
+  def __init__(self):
+    self._localAddr = array.array("I")
+    self._foreignAddr = array.array("I")
+    self._localPort = array.array("H")
+    self._foreignPort = array.array("H")
+    self._category = array.array("b")
+    self._type = array.array("b")
+    self._flags = array.array("B")
+    self._startTime = array.array("d")
+    
+    self._fingerprints = {}   # (row, isLocal) => fingerprint we were told
+    self._apps = {}           # row => (command, pid) of its application
+    self._freeRows = []       # released rows that can be reused
+    
+    # pool of the addresses used by our rows
+    self._addrIds = {}                # address => its id in the pool
+    self._addrStr = []                # id => address
+    self._addrInt = []                # id => sort value of the address
+    self._addrRefs = array.array("I") # id => number of endpoints using it
+    self._freeAddrIds = []            # unused ids that can be reused
+    
+    self._lock = threading.RLock()
+  
+  def add(self, lIpAddr, lPort, fIpAddr, fPort, category = -1, startTime = 0, flags = 0):
+    """
+    Stores a connection, providing the row it's been given. This raises a
+    ValueError if the addresses or ports are malformed.
+    
+    Arguments:
+      lIpAddr   - local ip address
+      lPort     - local port
+      fIpAddr   - foreign ip address
+      fPort     - foreign port
+      category  - index of the connection's category, -1 if unset
+      startTime - unix time when the connection was first seen
+      flags     - ROW_* flags of the connection
+    """
+    
+    lPacked, fPacked = packAddress(lIpAddr), packAddress(fIpAddr)
+    lPort, fPort = int(lPort), int(fPort)
+    
+    if not (0 <= lPort <= 65535 and 0 <= fPort <= 65535):
+      raise ValueError("'%s' or '%s' isn't a valid port" % (lPort, fPort))
+    
+    self._lock.acquire()
+    
+    try:
+      lAddrId, fAddrId = self._acquireAddress(lPacked), self._acquireAddress(fPacked)
+      
+      if self._freeRows:
+        row = self._freeRows.pop()
+        self._localAddr[row] = lAddrId
+        self._foreignAddr[row] = fAddrId
+        self._localPort[row] = lPort
+        self._foreignPort[row] = fPort
+        self._category[row] = category
+        self._type[row] = -1
+        self._flags[row] = flags
+        self._startTime[row] = startTime
+      else:
+        row = len(self._startTime)
+        self._localAddr.append(lAddrId)
+        self._foreignAddr.append(fAddrId)
+        self._localPort.append(lPort)
+        self._foreignPort.append(fPort)
+        self._category.append(category)
+        self._type.append(-1)
+        self._flags.append(flags)
+        self._startTime.append(startTime)
+      
+      return row
+    finally:
+      self._lock.release()
+  
+  def release(self, row):
+    """
+    Frees a row for reuse. Its contents shouldn't be accessed after this.
+    
+    Arguments:
+      row - row to be released
+    """
+    
+    self._lock.acquire()
+    
+    try:
+      self._releaseAddress(self._localAddr[row])
+      self._releaseAddress(self._foreignAddr[row])
+      
+      for key in ((row, True), (row, False)): self._fingerprints.pop(key, None)
+      self._apps.pop(row, None)
+      self._freeRows.append(row)
+    finally:
+      self._lock.release()
+  
+  def size(self):
+    """
+    Provides the number of connections currently stored.
+    """
+    
+    return len(self._startTime) - len(self._freeRows)
+  
+  def getAddress(self, row, isLocal):
+    """
+    Provides the string form of an endpoint's address.
+    
+    Arguments:
+      row     - row of the connection
+      isLocal - local endpoint if true, foreign otherwise
+    """
+    
+    column = self._localAddr if isLocal else self._foreignAddr
+    return self._addrStr[column[row]]
+  
+  def getAddressInt(self, row, isLocal):
+    """
+    Provides the integer value of an endpoint's address, for sorting.
+    
+    Arguments:
+      row     - row of the connection
+      isLocal - local endpoint if true, foreign otherwise
+    """
+    
+    column = self._localAddr if isLocal else self._foreignAddr
+    return self._addrInt[column[row]]
+  
+  def setForeign(self, row, fIpAddr, fPort):
+    """
+    Replaces the foreign endpoint of a connection.
+    
+    Arguments:
+      row     - row of the connection
+      fIpAddr - foreign ip address
+      fPort   - foreign port
+    """
+    
+    fPacked = packAddress(fIpAddr)
+    
+    self._lock.acquire()
+    
+    try:
+      self._releaseAddress(self._foreignAddr[row])
+      self._foreignAddr[row] = self._acquireAddress(fPacked)
+      self._foreignPort[row] = int(fPort)
+    finally:
+      self._lock.release()
+  
+  def getPort(self, row, isLocal):
+    """
+    Provides an endpoint's port.
+    
+    Arguments:
+      row     - row of the connection
+      isLocal - local endpoint if true, foreign otherwise
+    """
+    
+    return self._localPort[row] if isLocal else self._foreignPort[row]
+  
+  def getCategory(self, row):
+    """
+    Provides the category index of a connection, -1 if unset.
+    
+    Arguments:
+      row - row of the connection
+    """
+    
+    return self._category[row]
+  
+  def setCategory(self, row, category):
+    """
+    Sets the category index of a connection.
+    
+    Arguments:
+      row      - row of the connection
+      category - index of the connection's category, -1 if unset
+    """
+    
+    self._category[row] = category
+  
+  def getType(self, row):
+    """
+    Provides the category index we last resolved the connection to be, -1 if
+    unset.
+    
+    Arguments:
+      row - row of the connection
+    """
+    
+    return self._type[row]
+  
+  def setType(self, row, category):
+    """
+    Sets the category index we've resolved the connection to be.
+    
+    Arguments:
+      row      - row of the connection
+      category - index of the connection's category, -1 if unset
+    """
+    
+    self._type[row] = category
+  
+  def isFlagSet(self, row, flag):
+    """
+    Checks if a ROW_* flag is set for a connection.
+    
+    Arguments:
+      row  - row of the connection
+      flag - ROW_* flag to be checked
+    """
+    
+    return bool(self._flags[row] & flag)
+  
+  def setFlag(self, row, flag, isSet):
+    """
+    Sets or clears a ROW_* flag of a connection.
+    
+    Arguments:
+      row   - row of the connection
+      flag  - ROW_* flag to be changed
+      isSet - sets the flag if true, clears it otherwise
+    """
+    
+    if isSet: self._flags[row] |= flag
+    else: self._flags[row] &= ~flag & 0xff
+  
+  def getStartTime(self, row):
+    """
+    Provides the time when a connection was first seen.
+    
+    Arguments:
+      row - row of the connection
+    """
+    
+    return self._startTime[row]
+  
+  def setStartTime(self, row, startTime):
+    """
+    Sets the time when a connection was first seen.
+    
+    Arguments:
+      row       - row of the connection
+      startTime - unix time when the connection was first seen
+    """
+    
+    self._startTime[row] = startTime
+  
+  def getFingerprint(self, row, isLocal):
+    """
+    Provides the fingerprint we were told an endpoint has, None if it hasn't
+    been set.
+    
+    Arguments:
+      row     - row of the connection
+      isLocal - local endpoint if true, foreign otherwise
+    """
+    
+    return self._fingerprints.get((row, isLocal))
+  
+  def setFingerprint(self, row, isLocal, fingerprint):
+    """
+    Sets the fingerprint of an endpoint, overwriting what we'd otherwise look
+    up.
+    
+    Arguments:
+      row         - row of the connection
+      isLocal     - local endpoint if true, foreign otherwise
+      fingerprint - relay fingerprint, None to clear it
+    """
+    
+    if fingerprint: self._fingerprints[(row, isLocal)] = fingerprint
+    else: self._fingerprints.pop((row, isLocal), None)
+  
+  def getApp(self, row):
+    """
+    Provides the (command, pid) tuple of the application a connection belongs
+    to, with None values if it's unknown.
+    
+    Arguments:
+      row - row of the connection
+    """
+    
+    return self._apps.get(row, (None, None))
+  
+  def setApp(self, row, command, pid):
+    """
+    Sets the application a connection belongs to.
+    
+    Arguments:
+      row     - row of the connection
+      command - command of the application
+      pid     - pid of the application
+    """
+    
+    self._apps[row] = (command, pid)
+  
+  def _acquireAddress(self, packedAddr):
+    """
+    Provides the pool id of an address, adding it if it isn't already there.
+    Callers are expected to hold our lock and later release the id.
+    
+    Arguments:
+      packedAddr - address from packAddress
+    """
+    
+    ipAddr = unpackAddress(packedAddr)
+    addrId = self._addrIds.get(ipAddr)
+    
+    if addrId is None:
+      addrInt = addressToInt(packedAddr)
+      
+      if self._freeAddrIds:
+        addrId = self._freeAddrIds.pop()
+        self._addrStr[addrId] = ipAddr
+        self._addrInt[addrId] = addrInt
+      else:
+        addrId = len(self._addrStr)
+        self._addrStr.append(ipAddr)
+        self._addrInt.append(addrInt)
+        self._addrRefs.append(0)
+      
+      self._addrIds[ipAddr] = addrId
+    
+    self._addrRefs[addrId] += 1
+    return addrId
+  
+  def _releaseAddress(self, addrId):
+    """
+    Drops a reference to a pooled address, removing it once it's unused.
+    Callers are expected to hold our lock.
+    
+    Arguments:
+      addrId - pool id of the address
+    """
+    
+    self._addrRefs[addrId] -= 1
+    
+    if self._addrRefs[addrId] == 0:
+      del self._addrIds[self._addrStr[addrId]]
+      self._addrStr[addrId], self._addrInt[addrId] = None, None
+      self._freeAddrIds.append(addrId)
@@ -7,6 +7,10 @@ utilities:
 - lsof      lsof -wnPi | egrep "^<process> *<pid>.*((UDP.*)|(\(ESTABLISHED\)))"
 - ss        ss -nptu | grep "ESTAB.*\"<process>\",<pid>"
 
+On Linux the kernel can also be asked for the process' sockets directly via
+netlink (NETLINK_SOCK_DIAG), which avoids both forking and parsing the full
+/proc/net/tcp contents.
+
 all queries dump its stderr (directing it to /dev/null). Results include UDP
 and established TCP connections.
 
@@ -18,14 +22,21 @@ options that perform even better (thanks to Fabian Keil and Hans Schnehl):
 """
 
 import re
+import bisect
 import os
 import time
+import socket
+import struct
+import subprocess
 import threading
 
 from stem.util import conf, enum, log, proc, system
 
+from util import connTable, sysTools
+
 # enums for connection resolution utilities
-Resolver = enum.Enum(("PROC", "proc"),
+Resolver = enum.Enum(("NETLINK", "netlink"),
+                     ("PROC", "proc"),
                      ("NETSTAT", "netstat"),
                      ("SS", "ss"),
                      ("LSOF", "lsof"),
@@ -49,7 +60,8 @@ RUN_NETSTAT = "netstat -np"
 
 # n = numeric ports, p = include process, t = tcp sockets, u = udp sockets
 # output:
-# ESTAB  0  0  127.0.0.1:9051  127.0.0.1:53308  users:(("tor",9912,20))
+# tcp  ESTAB  0  0  127.0.0.1:9051  127.0.0.1:53308  users:(("tor",9912,20))
+# *note: newer versions list the process as users:(("tor",pid=9912,fd=20))
 # *note: under freebsd this command belongs to a spreadsheet program
 RUN_SS = "ss -nptu"
 
@@ -71,10 +83,83 @@ RUN_SOCKSTAT = "sockstat"
 RUN_BSD_SOCKSTAT = "sockstat -4c"
 RUN_BSD_PROCSTAT = "procstat -f %s"
 
+RESOLVER_COMMANDS = {Resolver.NETSTAT: RUN_NETSTAT, Resolver.SS: RUN_SS,
+                     Resolver.LSOF: RUN_LSOF, Resolver.SOCKSTAT: RUN_SOCKSTAT,
+                     Resolver.BSD_SOCKSTAT: RUN_BSD_SOCKSTAT}
+
+# Patterns for the lines of the above commands that belong to our process, with
+# groups for the local address, local port, foreign address, and foreign port.
+# These are filled in with the process' name and pid, and ADDRESS_PATTERN for
+# each 'address:port' entry (with IPv6 addresses either bare or in brackets),
+# then compiled and cached by _getResolverRegex.
+ADDRESS_PATTERN = r"\[?([^\s\]]+)\]?:(\d+)"
+
+RESOLVER_PATTERNS = {
+  Resolver.NETSTAT: r"^\S+\s+\S+\s+\S+\s+%(addr)s\s+%(addr)s\s+ESTABLISHED\s+%(pid)s/%(name)s(?:\s|$)",
+  Resolver.SS: r"^(?:\S+\s+)?ESTAB\s+\S+\s+\S+\s+%(addr)s\s+%(addr)s\s.*\"%(name)s\",(?:pid=)?%(pid)s,",
+  Resolver.LSOF: r"^%(name)s\s+%(pid)s\s(?=.*(?:UDP|\(ESTABLISHED\))).*\s%(addr)s->%(addr)s(?:\s+\(ESTABLISHED\))?\s*$",
+  Resolver.SOCKSTAT: r"^\S+\s+%(name)s\s+%(pid)s\s+\S+\s+%(addr)s\s+%(addr)s\s+ESTABLISHED",
+  Resolver.BSD_SOCKSTAT: r"^\S+\s+%(name)s\s+%(pid)s\s+\S+\s+\S+\s+%(addr)s\s+%(addr)s(?:\s|$)",
+  Resolver.BSD_PROCSTAT: r"^(?=.*TCP)(?!.*0\.0\.0\.0:0)(?:\S+\s+){9}%(addr)s\s+%(addr)s(?:\s|$)",
+}
+
+# Text that the above lines contain, filled in with the process' name. Lines are
+# checked for this before the pattern since it's far cheaper, and most lines of
+# other processes don't have it.
+RESOLVER_LITERALS = {
+  Resolver.NETSTAT: "/%(name)s",
+  Resolver.SS: "\"%(name)s\",",
+  Resolver.LSOF: "%(name)s",
+  Resolver.SOCKSTAT: "%(name)s",
+  Resolver.BSD_SOCKSTAT: "%(name)s",
+  Resolver.BSD_PROCSTAT: "TCP",
+}
+
+RESOLVER_REGEX_CACHE = {}           # (resolver, process name, pid) => compiled RESOLVER_PATTERNS entry
+
+# Constants for sock_diag queries, from the linux headers (netlink.h,
+# sock_diag.h, inet_diag.h, and tcp_states.h). Requests are an nlmsghdr
+# followed by an inet_diag_req_v2, and each socket in the reply is an nlmsghdr
+# followed by an inet_diag_msg...
+#
+#   inet_diag_msg: family, state, timer, retrans, sport, dport, src[16],
+#                  dst[16], if, cookie[2], expires, rqueue, wqueue, uid, inode
+#
+# Ports and addresses are in network byte order, everything else is native.
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+TCP_ESTABLISHED = 1
+
+NLMSG_HEADER = struct.Struct("=IHHII")
+INET_DIAG_REQ = struct.Struct("=BBBxI48x")
+INET_DIAG_MSG = struct.Struct("=BBBB2s2s16s16sI8sIIIII")
+
+# /proc/net contents read for proc resolution, with the width of their
+# address entries. Lines are fixed width up to the uid, for instance...
+#    0: 0100007F:BC8F 00000000:0000 0A 00000000:00000000 00:00000000 00000000 65534        0 1048 1 ...
+PROC_NET_FILES = (("/proc/net/tcp", 13), ("/proc/net/tcp6", 37),
+                  ("/proc/net/udp", 13), ("/proc/net/udp6", 37))
+
+PORT_MAX = 65535                    # highest valid port number
 RESOLVERS = []                      # connection resolvers available via the singleton constructor
 RESOLVER_FAILURE_TOLERANCE = 3      # number of subsequent failures before moving on to another resolver
+CHANGE_HISTORY_SIZE = 20            # number of resolutions we keep the added/removed connections for
+SHARED_SCAN_MAX_AGE = 1             # seconds a shared socket table scan is reused for other processes
+SHARED_SCAN_EXPIRY = 60             # seconds until processes that stop asking are dropped from shared scans
+APP_CACHE_SIZE = 500                # maximum socket owners cached by application resolvers
+APP_CACHE_TRIM_SIZE = 400           # number of socket owners kept when trimming the cache
+ORCONN_REFRESH_RATE = 1             # minimum seconds between proc or netlink lookups prompted by ORCONN events
+BENCHMARK_LOSS_MARGIN = 3           # resolvers costing this many times the cheapest aren't benchmarked again until a recheck
+BENCHMARK_LOSS_MIN = 0.005          # cpu seconds more than the cheapest a resolver must cost to be skipped
+BENCHMARK_RECHECK = 6               # benchmarks between measuring resolvers that were skipped
+BENCHMARK_AGREEMENT = 0.9           # portion of results a resolver must share with the others to be used
 RESOLVER_SERIAL_FAILURE_MSG = "Unable to query connections with %s, trying %s"
 RESOLVER_FINAL_FAILURE_MSG = "All connection resolvers failed"
+RESOLVER_BENCHMARK_MSG = "Switching connection resolution from %s to %s (%0.1f ms vs %0.1f ms of cpu per lookup)"
 
 def conf_handler(key, value):
   if key.startswith("port.label."):
@@ -95,17 +180,25 @@ def conf_handler(key, value):
         maxPort = int(portEntry[divIndex + 1:])
         if minPort > maxPort: raise ValueError()
         
-        for port in range(minPort, maxPort + 1):
-          PORT_USAGE[str(port)] = value
+        PORT_RANGES.append((minPort, maxPort, value))
+        PORT_RANGE_TABLE[:] = []  # rebuilt on our next lookup
       except ValueError:
         msg = "Unable to parse port range for entry: %s" % key
         log.notice(msg)
 
 CONFIG = conf.config_dict("arm", {
   "queries.connections.minRate": 5,
+  "queries.connections.benchmarkRate": 600,
+  "queries.connections.reconcileRate": 30,
 }, conf_handler)
 
-PORT_USAGE = {}
+PORT_USAGE = {}                     # port => label for single port entries
+PORT_RANGES = []                    # (min port, max port, label) for range entries, in config order
+
+# Non-overlapping (start, end, label) intervals for the PORT_RANGES, sorted by
+# their start. Later ranges take precedence where they overlap. This is built
+# when first needed, and emptied when a range is added.
+PORT_RANGE_TABLE = []
 
 def isValidIpAddress(ipStr):
   """
@@ -149,15 +242,20 @@ def isIpAddressPrivate(ipAddr):
 def ipToInt(ipAddr):
   """
   Provides an integer representation of the ip address, suitable for sorting.
+  This accepts both IPv4 and IPv6 addresses.
   
   Arguments:
     ipAddr - ip address to be converted
   """
   
+  if ":" in ipAddr:
+    high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, ipAddr))
+    return (high << 64) + low
+  
   total = 0
   
   for comp in ipAddr.split("."):
-    total *= 255
+    total *= 256
     total += int(comp)
   
   return total
@@ -165,19 +263,69 @@ def ipToInt(ipAddr):
 def getPortUsage(port):
   """
   Provides the common use of a given port. If no useage is known then this
-  provides None.
+  provides None. Labels for a single port take precedence over ranges.
   
   Arguments:
     port - port number to look up
   """
   
-  return PORT_USAGE.get(port)
+  port = str(port)
+  if port in PORT_USAGE: return PORT_USAGE[port]
+  elif not PORT_RANGES or not port.isdigit(): return None
+  
+  rangeTable = PORT_RANGE_TABLE
+  if not rangeTable:
+    rangeTable = _buildPortRangeTable(PORT_RANGES)
+    PORT_RANGE_TABLE[:] = rangeTable
+  
+  # the last interval starting at or before the port
+  port = int(port)
+  tableIndex = bisect.bisect_right(rangeTable, (port, PORT_MAX + 1)) - 1
+  
+  if tableIndex >= 0 and port <= rangeTable[tableIndex][1]:
+    return rangeTable[tableIndex][2]
+  else: return None
+
+def _buildPortRangeTable(portRanges):
+  """
+  Flattens port ranges into sorted, non-overlapping (start, end, label)
+  intervals. Where ranges overlap the later one's label is used.
+  
+  Arguments:
+    portRanges - (min port, max port, label) tuples
+  """
+  
+  # boundaries between the intervals, with each starting at one of these
+  boundaries = set()
+  for minPort, maxPort, _ in portRanges:
+    boundaries.add(minPort)
+    boundaries.add(maxPort + 1)
+  
+  boundaries = sorted(boundaries)
+  rangeTable = []
+  
+  for i in range(len(boundaries) - 1):
+    start, end = boundaries[i], boundaries[i + 1] - 1
+    label = None
+    
+    for minPort, maxPort, rangeLabel in portRanges:
+      if minPort <= start and end <= maxPort: label = rangeLabel
+    
+    if label == None: continue
+    elif rangeTable and rangeTable[-1][1] == start - 1 and rangeTable[-1][2] == label:
+      rangeTable[-1] = (rangeTable[-1][0], end, label) # extends the last interval
+    else: rangeTable.append((start, end, label))
+  
+  return rangeTable
 
 def getResolverCommand(resolutionCmd, processName, processPid = ""):
   """
-  Provides the command and line filter that would be processed for the given
-  resolver type. This raises a ValueError if either the resolutionCmd isn't
-  recognized or a pid was requited but not provided.
+  Provides a tuple of the form (command, literal, matcher) for the given
+  resolver type. Lines of the command's output belong to our process if they
+  contain the literal and the matcher provides a match for them. These matches
+  have the local address, local port, foreign address, and foreign port as
+  their groups. This raises a ValueError if either the
+  resolutionCmd isn't recognized or a pid was requited but not provided.
   
   Arguments:
     resolutionCmd - command to use in resolving the address
@@ -193,40 +341,16 @@ def getResolverCommand(resolutionCmd, processName, processPid = ""):
     # if the pid was undefined then match any in that field
     processPid = "[0-9]*"
   
-  no_op_filter = lambda line: True
-  
-  if resolutionCmd == Resolver.PROC: return ("", no_op_filter)
-  elif resolutionCmd == Resolver.NETSTAT:
-    return (
-      RUN_NETSTAT,
-      lambda line: "ESTABLISHED %s/%s" % (processPid, processName) in line
-    )
-  elif resolutionCmd == Resolver.SS:
-    return (
-      RUN_SS,
-      lambda line: ("ESTAB" in line) and ("\"%s\",%s" % (processName, processPid) in line)
-    )
-  elif resolutionCmd == Resolver.LSOF:
-    return (
-      RUN_LSOF,
-      lambda line: re.match("^%s *%s.*((UDP.*)|(\(ESTABLISHED\)))" % (processName, processPid))
-    )
-  elif resolutionCmd == Resolver.SOCKSTAT:
-    return (
-      RUN_SOCKSTAT,
-      lambda line: re.match("%s *%s.*ESTABLISHED" % (processName, processPid))
-    )
-  elif resolutionCmd == Resolver.BSD_SOCKSTAT:
-    return (
-      RUN_BSD_SOCKSTAT,
-      lambda line: re.match("%s *%s" % (processName, processPid))
-    )
+  if resolutionCmd in (Resolver.PROC, Resolver.NETLINK):
+    return ("", "", lambda line: True)
   elif resolutionCmd == Resolver.BSD_PROCSTAT:
-    return (
-      RUN_BSD_PROCSTAT % processPid,
-      lambda line: "TCP" in line and "0.0.0.0:0" not in line
-    )
+    cmd = RUN_BSD_PROCSTAT % processPid
+  elif resolutionCmd in RESOLVER_COMMANDS:
+    cmd = RESOLVER_COMMANDS[resolutionCmd]
   else: raise ValueError("Unrecognized resolution type: %s" % resolutionCmd)
+  
+  cmdLiteral = RESOLVER_LITERALS[resolutionCmd] % {"name": processName}
+  return (cmd, cmdLiteral, _getResolverRegex(resolutionCmd, processName, processPid).match)
 
 def getConnections(resolutionCmd, processName, processPid = ""):
   """
@@ -246,57 +370,383 @@ def getConnections(resolutionCmd, processName, processPid = ""):
   """
   
   if resolutionCmd == Resolver.PROC:
-    # Attempts resolution via checking the proc contents.
+    # Attempts resolution via checking the proc contents. This is the same
+    # parsing used by our resolver's index so the results of both agree.
     if not processPid:
       raise ValueError("proc resolution requires a pid")
     
-    try:
-      return proc.get_connections(processPid)
-    except Exception, exc:
-      raise IOError(str(exc))
+    inodes = set(map(str, getSocketInodes(processPid)))
+    return _readProcNet(inodes, {})[0]
+  elif resolutionCmd == Resolver.NETLINK:
+    # Asks the kernel for the established tcp sockets belonging to the
+    # process' user, then narrows those to the ones the process has open.
+    if not processPid:
+      raise ValueError("netlink resolution requires a pid")
+    
+    processInfo = sysTools.getProcessInfo(processPid)
+    
+    if not processInfo or processInfo.uid == None:
+      raise IOError("unable to determine the uid of process %s" % processPid)
+    
+    processUid = int(processInfo.uid)
+    
+    return getNetlinkConnections(getSocketInodes(processPid), processUid)
   else:
     # Queries a resolution utility (netstat, lsof, etc). This raises an
     # IOError if the command fails or isn't available.
-    cmd, cmd_filter = getResolverCommand(resolutionCmd, processName, processPid)
-    results = system.call(cmd)
-    results = filter(cmd_filter, results)
-    
-    if not results: raise IOError("No results found using: %s" % cmd)
-    
-    # parses results for the resolution command
-    conn = []
-    for line in results:
-      if resolutionCmd == Resolver.LSOF:
-        # Different versions of lsof have different numbers of columns, so
-        # stripping off the optional 'established' entry so we can just use
-        # the last one.
-        comp = line.replace("(ESTABLISHED)", "").strip().split()
-      else: comp = line.split()
-      
-      if resolutionCmd == Resolver.NETSTAT:
-        localIp, localPort = comp[3].split(":")
-        foreignIp, foreignPort = comp[4].split(":")
-      elif resolutionCmd == Resolver.SS:
-        localIp, localPort = comp[4].split(":")
-        foreignIp, foreignPort = comp[5].split(":")
-      elif resolutionCmd == Resolver.LSOF:
-        local, foreign = comp[-1].split("->")
-        localIp, localPort = local.split(":")
-        foreignIp, foreignPort = foreign.split(":")
-      elif resolutionCmd == Resolver.SOCKSTAT:
-        localIp, localPort = comp[4].split(":")
-        foreignIp, foreignPort = comp[5].split(":")
-      elif resolutionCmd == Resolver.BSD_SOCKSTAT:
-        localIp, localPort = comp[5].split(":")
-        foreignIp, foreignPort = comp[6].split(":")
-      elif resolutionCmd == Resolver.BSD_PROCSTAT:
-        localIp, localPort = comp[9].split(":")
-        foreignIp, foreignPort = comp[10].split(":")
-      
-      conn.append((localIp, localPort, foreignIp, foreignPort))
+    cmd, cmdLiteral, cmdMatcher = getResolverCommand(resolutionCmd, processName, processPid)
+    conn = list(_streamConnections(cmd, cmdLiteral, cmdMatcher))
     
+    if not conn: raise IOError("No results found using: %s" % cmd)
     return conn
 
+def _getResolverRegex(resolutionCmd, processName, processPid):
+  """
+  Provides the compiled regex that both selects the lines of a resolution
+  command's output that belong to our process and captures their local and
+  foreign addresses. These are cached so each is only compiled once.
+  
+  Arguments:
+    resolutionCmd - command to use in resolving the address
+    processName   - name of the process for which connections are fetched
+    processPid    - process ID, or a regex matching any pid
+  """
+  
+  cacheKey = (resolutionCmd, processName, processPid)
+  
+  if not cacheKey in RESOLVER_REGEX_CACHE:
+    if processPid != "[0-9]*": processPid = re.escape(str(processPid))
+    
+    pattern = RESOLVER_PATTERNS[resolutionCmd] % {"name": re.escape(processName), "pid": processPid, "addr": ADDRESS_PATTERN}
+    RESOLVER_REGEX_CACHE[cacheKey] = re.compile(pattern)
+  
+  return RESOLVER_REGEX_CACHE[cacheKey]
+
+def _streamConnections(cmd, cmdLiteral, cmdMatcher):
+  """
+  Generator for the connections listed by a resolution command. This reads
+  the command's output as it's produced, parsing the lines selected by the
+  literal and matcher (as provided by getResolverCommand) in the same pass. This raises an
+  IOError if the command can't be ran.
+  
+  Arguments:
+    cmd        - resolution command to be ran
+    cmdLiteral - text that lines belonging to our process contain
+    cmdMatcher - function providing a match with the local address, local
+                 port, foreign address, and foreign port for lines belonging
+                 to our process
+  """
+  
+  startTime, startCpuTime = time.time(), sysTools.getChildCpuTime()
+  bytesRead = 0
+  
+  try:
+    devnull = open(os.devnull, "w")
+    process = subprocess.Popen(cmd.split(" "), bufsize = -1, stdout = subprocess.PIPE, stderr = devnull)
+  except (OSError, IOError), exc:
+    raise IOError("Unable to run '%s': %s" % (cmd, exc))
+  
+  try:
+    # The pipe is buffered and read in blocks as the command produces them. An
+    # unbuffered pipe would make a read for every byte.
+    for line in process.stdout:
+      bytesRead += len(line)
+      
+      if cmdLiteral in line:
+        match = cmdMatcher(line)
+        if match: yield match.groups()
+  finally:
+    process.stdout.close()
+    process.wait()
+    devnull.close()
+    
+    runtime = time.time() - startTime
+    sysTools.recordCall("connections", runtime, sysTools.getChildCpuTime() - startCpuTime, bytesRead)
+    log.debug("System call: %s (runtime: %0.2f)" % (cmd, runtime))
+
+def isNetlinkAvailable():
+  """
+  Checks if sock_diag queries can be made on this platform. This only checks
+  that netlink sockets are supported, the query itself can still fail (for
+  instance on kernels older than 3.3).
+  """
+  
+  if os.uname()[0] != "Linux" or not hasattr(socket, "AF_NETLINK"):
+    return False
+  
+  try:
+    diagSocket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+    diagSocket.close()
+    return True
+  except socket.error:
+    return False
+
+def getSocketInodes(processPid):
+  """
+  Provides the set of socket inodes the given process has open. This raises
+  an IOError if the process' file descriptors can't be read (usually due to
+  insufficient permissions).
+  
+  Arguments:
+    processPid - process ID of the process to be checked
+  """
+  
+  fdDir = "/proc/%s/fd" % processPid
+  inodes = set()
+  
+  try:
+    fdEntries = os.listdir(fdDir)
+  except OSError, exc:
+    raise IOError("unable to list %s: %s" % (fdDir, exc))
+  
+  for fd in fdEntries:
+    # file descriptor links look like 'socket:[30899]'
+    try: fdTarget = os.readlink("%s/%s" % (fdDir, fd))
+    except OSError: continue # descriptor was closed while we were reading
+    
+    if fdTarget.startswith("socket:["):
+      inodes.add(int(fdTarget[8:-1]))
+  
+  return inodes
+
+def _refreshFdInodes(processPid, oldFdInodes, knownConnections):
+  """
+  Provides an updated file descriptor => socket inode (None if not a socket)
+  mapping for the given process. Descriptors are only read again if they're
+  new or their inode isn't in knownConnections. This raises an IOError if the
+  process' descriptors can't be listed.
+  
+  Arguments:
+    processPid       - process ID of the process to be checked
+    oldFdInodes      - mapping from our last check of the process
+    knownConnections - inode => connection mapping from our last scan
+  """
+  
+  fdDir = "/proc/%s/fd" % processPid
+  
+  try:
+    fdEntries = os.listdir(fdDir)
+  except OSError, exc:
+    raise IOError("unable to list %s: %s" % (fdDir, exc))
+  
+  # Descriptor numbers are reused, so entries that didn't match a connection
+  # last time might now be sockets. If a descriptor is closed and reused
+  # between scans then its old socket will be gone from the tables, so it
+  # gets read again (and picked up) on the following scan.
+  
+  fdInodes = {}
+  
+  for fd in fdEntries:
+    inode = oldFdInodes.get(fd)
+    
+    if not inode in knownConnections:
+      try: fdTarget = os.readlink("%s/%s" % (fdDir, fd))
+      except OSError: continue # descriptor was closed while we were reading
+      
+      if fdTarget.startswith("socket:["): inode = fdTarget[8:-1]
+      else: inode = None
+    
+    fdInodes[fd] = inode
+  
+  return fdInodes
+
+def getNetlinkConnections(inodes, processUid = None, includeInodes = False):
+  """
+  Queries the kernel for established tcp sockets via netlink (INET_DIAG),
+  providing the connections that belong to the given socket inodes. This is
+  in the same form as getConnections, and raises an IOError if the query
+  fails.
+  
+  Filtering by socket state happens in the kernel, and the uid and inode are
+  checked before the rest of the entry is decoded so only the matching
+  sockets are ever parsed.
+  
+  Arguments:
+    inodes        - socket inodes belonging to the process
+    processUid    - uid of the process, this skips the uid check if undefined
+    includeInodes - provides (inode, connection) tuples rather than just the
+                    connections if true
+  """
+  
+  conn = []
+  if not inodes: return conn
+  
+  try:
+    diagSocket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+  except (AttributeError, socket.error), exc:
+    raise IOError("unable to make a netlink socket: %s" % exc)
+  
+  try:
+    for family in (socket.AF_INET, socket.AF_INET6):
+      request = INET_DIAG_REQ.pack(family, socket.IPPROTO_TCP, 0, 1 << TCP_ESTABLISHED)
+      header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request), SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, family, 0)
+      diagSocket.sendall(header + request)
+      
+      addrLen = 4 if family == socket.AF_INET else 16
+      isDone = False
+      
+      while not isDone:
+        response = diagSocket.recv(65536)
+        if not response: break
+        
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(response):
+          msgLen, msgType, _, _, _ = NLMSG_HEADER.unpack_from(response, offset)
+          if msgLen < NLMSG_HEADER.size: break
+          
+          if msgType == NLMSG_DONE:
+            isDone = True
+            break
+          elif msgType == NLMSG_ERROR:
+            errno = -struct.unpack_from("=i", response, offset + NLMSG_HEADER.size)[0]
+            raise IOError("netlink query failed: %s" % os.strerror(errno))
+          elif msgType == SOCK_DIAG_BY_FAMILY:
+            entry = INET_DIAG_MSG.unpack_from(response, offset + NLMSG_HEADER.size)
+            uid, inode = entry[-2:]
+            
+            if inode in inodes and (processUid == None or uid == processUid):
+              lPort, fPort, lAddr, fAddr = entry[4:8]
+              connEntry = (socket.inet_ntop(family, lAddr[:addrLen]),
+                           str(struct.unpack("!H", lPort)[0]),
+                           socket.inet_ntop(family, fAddr[:addrLen]),
+                           str(struct.unpack("!H", fPort)[0]))
+              
+              if includeInodes: conn.append((inode, connEntry))
+              else: conn.append(connEntry)
+          
+          # messages are aligned to four byte boundaries
+          offset += (msgLen + 3) & ~3
+  except (socket.error, struct.error), exc:
+    raise IOError("netlink query failed: %s" % exc)
+  finally:
+    diagSocket.close()
+  
+  return conn
+
+def _decodeProcAddress(entry):
+  """
+  Translates an address from the /proc/net contents into an (ip, port) tuple
+  of strings. Addresses are hex encoded 32-bit words in the host's byte
+  order, for instance "0500000A:0016" -> ("10.0.0.5", "22") on a little endian
+  system.
+  
+  Arguments:
+    entry - address entry to be decoded
+  """
+  
+  addr, port = entry.split(":")
+  
+  if len(addr) == 8:
+    ipAddr = socket.inet_ntop(socket.AF_INET, struct.pack("=I", int(addr, 16)))
+  else:
+    words = [int(addr[i:i + 8], 16) for i in (0, 8, 16, 24)]
+    ipAddr = socket.inet_ntop(socket.AF_INET6, struct.pack("=IIII", *words))
+  
+  return (ipAddr, str(int(port, 16)))
+
+def _readProcNet(inodes, knownConnections):
+  """
+  Reads the /proc/net socket tables for the given inodes, providing a tuple of
+  the form (connections, inode => connection mapping). Lines are checked for
+  their state and inode before the rest of the line is split so unrelated
+  sockets are cheap to skip, and inodes present in knownConnections are
+  reused rather than decoded again. Like proc.get_connections this includes
+  established tcp connections and all udp entries.
+  
+  Arguments:
+    inodes           - set of socket inodes (strings) we're interested in
+    knownConnections - inode => connection mapping from a prior read
+  """
+  
+  conn, inodeConnections = [], {}
+  
+  for procFilePath, addrWidth in PROC_NET_FILES:
+    isTcp = "/tcp" in procFilePath
+    
+    try:
+      procFile = open(procFilePath)
+    except IOError, exc:
+      if procFilePath.endswith("6"): continue # ipv6 is disabled
+      raise exc
+    
+    try:
+      procFile.readline() # skip the header
+      
+      for line in procFile:
+        divIndex = line.find(":")
+        stateStart = divIndex + 4 + 2 * addrWidth
+        
+        if isTcp and line[stateStart:stateStart + 2] != "01":
+          continue # tcp connection that isn't established
+        
+        # the uid is the first variable width field, followed by the timeout
+        # and inode
+        inode = line[stateStart + 42:].split(None, 3)[2]
+        if not inode in inodes: continue
+        
+        connEntry = knownConnections.get(inode)
+        
+        if not connEntry:
+          localEntry = line[divIndex + 2:divIndex + 2 + addrWidth]
+          foreignEntry = line[divIndex + 3 + addrWidth:divIndex + 3 + 2 * addrWidth]
+          connEntry = _decodeProcAddress(localEntry) + _decodeProcAddress(foreignEntry)
+        
+        conn.append(connEntry)
+        inodeConnections[inode] = connEntry
+    except (IndexError, ValueError, socket.error), exc:
+      raise IOError("unable to parse %s: %s" % (procFilePath, exc))
+    finally:
+      procFile.close()
+  
+  return (conn, inodeConnections)
+
+def _readProcNetPorts(ports):
+  """
+  Provides the established tcp sockets using any of the given ports, as a
+  mapping of their inode to a (local port, foreign port) tuple. This raises an
+  IOError if the tables can't be read.
+  
+  Arguments:
+    ports - set of ports (strings) we're interested in
+  """
+  
+  portInodes = {}
+  
+  for procFilePath, addrWidth in PROC_NET_FILES:
+    if not "/tcp" in procFilePath: continue
+    
+    try:
+      procFile = open(procFilePath)
+    except IOError, exc:
+      if procFilePath.endswith("6"): continue # ipv6 is disabled
+      raise exc
+    
+    try:
+      procFile.readline() # skip the header
+      
+      for line in procFile:
+        divIndex = line.find(":")
+        stateStart = divIndex + 4 + 2 * addrWidth
+        
+        if line[stateStart:stateStart + 2] != "01":
+          continue # connection that isn't established
+        
+        localPortEnd = divIndex + 2 + addrWidth
+        foreignPortEnd = localPortEnd + 1 + addrWidth
+        
+        localPort = str(int(line[localPortEnd - 4:localPortEnd], 16))
+        foreignPort = str(int(line[foreignPortEnd - 4:foreignPortEnd], 16))
+        
+        if localPort in ports or foreignPort in ports:
+          inode = line[stateStart + 42:].split(None, 3)[2]
+          portInodes[inode] = (localPort, foreignPort)
+    except (IndexError, ValueError), exc:
+      raise IOError("unable to parse %s: %s" % (procFilePath, exc))
+    finally:
+      procFile.close()
+  
+  return portInodes
+
 def isResolverAlive(processName, processPid = ""):
   """
   This provides true if a singleton resolver instance exists for the given
@@ -366,8 +816,160 @@ def getSystemResolvers(osType = None):
   if proc.is_available():
     resolvers = [Resolver.PROC] + resolvers
   
+  # netlink is cheaper still since the kernel filters the sockets for us
+  if osType == "Linux" and isNetlinkAvailable():
+    resolvers = [Resolver.NETLINK] + resolvers
+  
   return resolvers
 
+class SocketScanner:
+  """
+  Resolves proc and netlink connections for any number of processes with a
+  single read of the system's socket tables. Each scan refreshes the file
+  descriptor index of every process that's asked for its connections
+  recently, reads the tables once for the union of their socket inodes, and
+  splits the results back out by process. Requests made within
+  SHARED_SCAN_MAX_AGE of a scan are answered from it, so resolvers for
+  several tor instances share the work.
+  
+  Each process' index maps file descriptor numbers to socket inodes (None if
+  not a socket). Descriptors are only read again if they're new or didn't
+  match an established socket, so after the first scan this scales with the
+  number of changes rather than total connections.
+  """
+  
+  def __init__(self):
+    self._lock = threading.RLock()
+    self._scanResolver = None     # resolver used for the last scan
+    self._scanTime = -1           # time of the last scan
+    self._fdInodes = {}           # pid => {fd => inode}
+    self._lastRequest = {}        # pid => time its connections were last requested
+    self._pidConnections = {}     # pid => connections from the last scan
+    self._inodeConnections = {}   # inode => connection from the last scan
+  
+  def getConnections(self, processPid, resolver, maxAge = SHARED_SCAN_MAX_AGE):
+    """
+    Provides the connections of the given process, scanning the socket tables
+    unless this can be answered by a recent scan. This raises an IOError if the
+    lookup fails.
+    
+    Arguments:
+      processPid - pid of the process to provide the connections of
+      resolver   - either Resolver.PROC or Resolver.NETLINK
+      maxAge     - seconds a prior scan can be reused for
+    """
+    
+    processPid = str(processPid)
+    
+    self._lock.acquire()
+    
+    try:
+      self._lastRequest[processPid] = time.time()
+      
+      isCurrent = resolver == self._scanResolver and time.time() - self._scanTime <= maxAge
+      if not isCurrent or not processPid in self._pidConnections:
+        errors = self._scan(resolver)
+        if processPid in errors: raise errors[processPid]
+      
+      return list(self._pidConnections[processPid])
+    finally:
+      self._lock.release()
+  
+  def _scan(self, resolver):
+    """
+    Refreshes the file descriptor index for each of our processes, then reads
+    the socket tables for all of them. This provides a mapping of pids to the
+    IOErrors of processes we were unable to resolve.
+    
+    Arguments:
+      resolver - either Resolver.PROC or Resolver.NETLINK
+    """
+    
+    # drops processes whose resolvers have stopped asking about them
+    expiryTime = time.time() - SHARED_SCAN_EXPIRY
+    for pid, requestTime in self._lastRequest.items():
+      if requestTime < expiryTime: self._removePid(pid)
+    
+    if resolver != self._scanResolver: self._inodeConnections = {}
+    
+    errors, pidInodes = {}, {}
+    
+    for pid in self._lastRequest:
+      try:
+        fdInodes = _refreshFdInodes(pid, self._fdInodes.get(pid, {}), self._inodeConnections)
+        self._fdInodes[pid] = fdInodes
+        pidInodes[pid] = set(fdInodes.values())
+        pidInodes[pid].discard(None)
+      except IOError, exc:
+        errors[pid] = exc
+    
+    for pid in errors: self._removePid(pid)
+    
+    inodes = set()
+    for pidInodeSet in pidInodes.values(): inodes.update(pidInodeSet)
+    
+    try:
+      if resolver == Resolver.NETLINK:
+        # The kernel dumps everyone's sockets, which getNetlinkConnections then
+        # checks against the uid. That check only applies if our processes
+        # share a uid.
+        processInfo = [sysTools.getProcessInfo(pid) for pid in pidInodes]
+        uids = set([info.uid if info else None for info in processInfo])
+        processUid = int(uids.pop()) if len(uids) == 1 and not None in uids else None
+        
+        inodeConnections = {}
+        for inode, connEntry in getNetlinkConnections(set(map(int, inodes)), processUid, True):
+          inodeConnections[str(inode)] = connEntry
+      else:
+        inodeConnections = _readProcNet(inodes, self._inodeConnections)[1]
+    except Exception, exc:
+      # the tables couldn't be read, so this fails for everyone
+      self._scanResolver, self._pidConnections = None, {}
+      if not isinstance(exc, IOError): exc = IOError(str(exc))
+      for pid in pidInodes: errors[pid] = exc
+      return errors
+    
+    pidConnections = {}
+    for pid, pidInodeSet in pidInodes.items():
+      pidConnections[pid] = [inodeConnections[inode] for inode in pidInodeSet if inode in inodeConnections]
+    
+    self._scanResolver = resolver
+    self._scanTime = time.time()
+    self._pidConnections = pidConnections
+    self._inodeConnections = inodeConnections
+    
+    return errors
+  
+  def _removePid(self, processPid):
+    """
+    Drops our index for the given process.
+    
+    Arguments:
+      processPid - pid of the process to be dropped
+    """
+    
+    for pidMapping in (self._fdInodes, self._lastRequest, self._pidConnections):
+      if processPid in pidMapping: del pidMapping[processPid]
+
+def _packConnections(connResults):
+  """
+  Provides a frozenset with the packed form of the given connections,
+  skipping any with a malformed address or port.
+  
+  Arguments:
+    connResults - (local ip, local port, foreign ip, foreign port) tuples
+  """
+  
+  packed = []
+  
+  for connEntry in connResults:
+    try: packed.append(connTable.packConnection(*connEntry))
+    except ValueError: pass
+  
+  return frozenset(packed)
+
+SOCKET_SCANNER = SocketScanner()    # scanner shared by the resolvers for proc and netlink lookups
+
 class ConnectionResolver(threading.Thread):
   """
   Service that periodically queries for a process' current connections. This
@@ -382,7 +984,14 @@ class ConnectionResolver(threading.Thread):
   
   - Checks the current PATH to determine which resolvers are available. This
     uses the first of the following that's available:
-      netstat, ss, lsof (picks netstat if none are found)
+      netlink, proc, netstat, ss, lsof (picks netstat if none are found)
+  
+  - After the first successful resolution, and periodically thereafter,
+    compares its cost with a single query by each of the other available
+    resolvers. Cpu costs are for this thread and the commands it runs. This
+    switches to the resolver with the lowest cpu cost whose results agree with
+    the others. Those that were far more costly are only measured again every
+    few benchmarks.
   
   - Attempts to resolve using the selection. Single failures are logged at the
     INFO level, and a series of failures at NOTICE. In the later case this
@@ -394,6 +1003,13 @@ class ConnectionResolver(threading.Thread):
   larger). This is to prevent systems either strapped for resources or with a
   vast number of connections from being burdened too heavily by this daemon.
   
+  If we're told about tor's ORCONN events (via handleOrConnStatus) then closed
+  relay connections are dropped as they happen and new ones we don't yet have
+  prompt an early lookup. These early lookups are no more frequent than a
+  hundred times the runtime of the last. While events are arriving our
+  periodic resolutions slow to the queries.connections.reconcileRate, which
+  catches anything the events missed and connections that aren't to relays.
+  
   Parameters:
     processName       - name of the process being resolved
     processPid        - pid of the process being resolved
@@ -441,18 +1057,40 @@ class ConnectionResolver(threading.Thread):
     
     log.info("Operating System: %s, Connection Resolvers: %s" % (osType, ", ".join(self.resolverOptions)))
     
-    # sets the default resolver to be the first found in the system's PATH
-    # (left as netstat if none are found)
+    # resolvers that can be used, either being proc based or in the PATH
+    self._availableResolvers = []
+    
     for resolver in self.resolverOptions:
       # Resolver strings correspond to their command with the exception of bsd
       # resolvers.
       resolverCmd = resolver.replace(" (bsd)", "")
       
-      if resolver == Resolver.PROC or system.is_available(resolverCmd):
-        self.defaultResolver = resolver
-        break
+      if resolver in (Resolver.PROC, Resolver.NETLINK) or system.is_available(resolverCmd):
+        self._availableResolvers.append(resolver)
     
-    self._connections = []        # connection cache (latest results)
+    # sets the default resolver to be the first found in the system's PATH
+    # (left as netstat if none are found)
+    if self._availableResolvers:
+      self.defaultResolver = self._availableResolvers[0]
+    
+    # Measured costs for the available resolvers, mapping them to a tuple of
+    # the form (wall time, cpu time, agrees with others), or None if they
+    # failed. These are seconds per resolution.
+    self._resolverCosts = {}
+    self._lastBenchmark = 0       # time we last benchmarked the resolvers
+    self._benchmarkCount = 0      # number of times we've benchmarked the resolvers
+    self._lastOrConnEvent = 0     # time we were last notified of an ORCONN event
+    self._refreshRequestTime = None # time of the first ORCONN event asking for an early lookup
+    self._lastLookupTime = 0      # runtime of our last successful lookup
+    
+    # Totals for resolutions made with the default since we last benchmarked,
+    # mapping it to a list of the form [count, wall time, cpu time]. Thread cpu
+    # time is counted in clock ticks so single resolutions are imprecise.
+    self._pendingCosts = {}
+    
+    self._connections = frozenset() # connection cache (latest results)
+    self._changes = []            # (generation, added, removed) for recent resolutions
+    self._changesLock = threading.RLock()
     self._resolutionCounter = 0   # number of successful connection resolutions
     self._isPaused = False
     self._halt = False            # terminates thread if true
@@ -486,10 +1124,39 @@ class ConnectionResolver(threading.Thread):
   def run(self):
     while not self._halt:
       minWait = self.resolveRate if self.resolveRate else self.defaultRate
-      timeSinceReset = time.time() - self.lastLookup
+      isDefault = self.overwriteResolver == None
+      resolver = self.defaultResolver if isDefault else self.overwriteResolver
+      isIndexed = resolver in (Resolver.PROC, Resolver.NETLINK) and self.processPid
+      
+      # while ORCONN events are keeping us current we only need to reconcile
+      reconcileRate = CONFIG["queries.connections.reconcileRate"]
+      
+      if time.time() - self._lastOrConnEvent < reconcileRate:
+        periodicWait = max(minWait, reconcileRate)
+      else: periodicWait = minWait
       
-      if self._isPaused or timeSinceReset < minWait:
-        sleepTime = max(0.2, minWait - timeSinceReset)
+      # Lookups are aligned to multiples of our rate so resolvers for other
+      # processes make theirs at the same time, letting them share a scan.
+      if periodicWait > 0:
+        timeUntilLookup = (int(self.lastLookup / periodicWait) + 1) * periodicWait - time.time()
+      else: timeUntilLookup = 0
+      
+      # New relay connections prompt an earlier lookup, though only proc and
+      # netlink are cheap enough to do this more often than our usual rate.
+      # Like our periodic rate this backs off when lookups are costly.
+      isEventRefresh = False
+      
+      if self._refreshRequestTime and timeUntilLookup > 0:
+        if isIndexed: refreshWait = max(ORCONN_REFRESH_RATE, 100 * self._lastLookupTime)
+        else: refreshWait = minWait
+        
+        timeUntilRefresh = self.lastLookup + refreshWait - time.time()
+        
+        if timeUntilRefresh < timeUntilLookup:
+          timeUntilLookup, isEventRefresh = timeUntilRefresh, True
+      
+      if self._isPaused or timeUntilLookup > 0:
+        sleepTime = max(0.2, timeUntilLookup)
         
         self._cond.acquire()
         if not self._halt: self._cond.wait(sleepTime)
@@ -497,8 +1164,7 @@ class ConnectionResolver(threading.Thread):
         
         continue # done waiting, try again
       
-      isDefault = self.overwriteResolver == None
-      resolver = self.defaultResolver if isDefault else self.overwriteResolver
+      refreshRequestTime, self._refreshRequestTime = self._refreshRequestTime, None
       
       # checks if there's nothing to resolve with
       if not resolver:
@@ -506,12 +1172,14 @@ class ConnectionResolver(threading.Thread):
         continue
       
       try:
-        resolveStart = time.time()
-        connResults = getConnections(resolver, self.processName, self.processPid)
-        lookupTime = time.time() - resolveStart
+        # shared scans predating the event won't have its connection
+        maxAge = SHARED_SCAN_MAX_AGE
+        if isEventRefresh: maxAge = min(maxAge, time.time() - refreshRequestTime)
+        
+        connResults, lookupTime, cpuTime = self._resolve(resolver, maxAge)
+        self._lastLookupTime = lookupTime
         
-        self._connections = connResults
-        self._resolutionCounter += 1
+        self._setConnections(_packConnections(connResults))
         
         newMinDefaultRate = 100 * lookupTime
         if self.defaultRate < newMinDefaultRate:
@@ -523,7 +1191,17 @@ class ConnectionResolver(threading.Thread):
           else: self._rateThresholdBroken += 1
         else: self._rateThresholdBroken = 0
         
-        if isDefault: self._subsiquentFailures = 0
+        if isDefault:
+          self._subsiquentFailures = 0
+          
+          pendingCost = self._pendingCosts.setdefault(resolver, [0, 0.0, 0.0])
+          pendingCost[0] += 1
+          pendingCost[1] += lookupTime
+          pendingCost[2] += cpuTime
+          
+          benchmarkRate = CONFIG["queries.connections.benchmarkRate"]
+          if benchmarkRate > 0 and time.time() - self._lastBenchmark >= benchmarkRate:
+            self._benchmarkResolvers()
       except (ValueError, IOError), exc:
         # this logs in a couple of cases:
         # - special failures noted by getConnections (most cases are already
@@ -558,6 +1236,237 @@ class ConnectionResolver(threading.Thread):
       finally:
         self.lastLookup = time.time()
   
+  def _resolve(self, resolver, maxAge = SHARED_SCAN_MAX_AGE):
+    """
+    Queries our process' connections, providing a tuple of the form...
+    (connections, wall time, cpu time)
+    
+    Proc and netlink queries are made through the SOCKET_SCANNER when we have
+    a pid, the same as our periodic resolutions. The cpu time is this thread's
+    plus, for resolution commands, that of the command. Thread cpu time is
+    counted in clock ticks, so if it's unavailable or a proc or netlink query
+    took less than a tick then this is the wall time (which bounds it).
+    
+    Arguments:
+      resolver - method of resolution to be used
+      maxAge   - seconds a shared socket table scan can be reused for
+    """
+    
+    isCommand = not resolver in (Resolver.PROC, Resolver.NETLINK)
+    startTime, startCpuTime = time.time(), sysTools.getThreadCpuTime()
+    startChildCpuTime = sysTools.getChildCpuTime()
+    
+    if not isCommand and self.processPid:
+      connResults = SOCKET_SCANNER.getConnections(self.processPid, resolver, maxAge)
+    else:
+      connResults = getConnections(resolver, self.processName, self.processPid)
+    
+    wallTime, endCpuTime = time.time() - startTime, sysTools.getThreadCpuTime()
+    
+    isUnmeasured = not isCommand and wallTime < 1.0 / sysTools.CLOCK_TICKS
+    
+    if startCpuTime is None or endCpuTime is None or isUnmeasured: cpuTime = wallTime
+    else:
+      cpuTime = endCpuTime - startCpuTime
+      if isCommand: cpuTime += sysTools.getChildCpuTime() - startChildCpuTime
+    
+    return (connResults, wallTime, cpuTime)
+  
+  def _benchmarkResolvers(self):
+    """
+    Compares the cost of the available resolvers against our process, then
+    switches the default to the one with the lowest cpu cost whose results
+    agree with the others. Resolvers agree if most of their results match
+    connections that at least half of the resolvers found.
+    
+    The default's cost is averaged over its resolutions since we last
+    benchmarked, and its results are from the latest of them. The others are
+    each queried once, averaging with their prior measurement. Resolvers that
+    failed or were far more costly than the cheapest last time keep that
+    measurement, and are only queried again every BENCHMARK_RECHECK
+    benchmarks.
+    """
+    
+    count, wallTime, cpuTime = self._pendingCosts.get(self.defaultResolver, (1, 0.0, 0.0))
+    self._pendingCosts = {}
+    
+    costs = {self.defaultResolver: (wallTime / count, cpuTime / count)}
+    results = {self.defaultResolver: self._connections}
+    
+    lastCosts = self._resolverCosts
+    lastCpuTimes = [cost[1] for cost in lastCosts.values() if cost]
+    lastBestCpu = min(lastCpuTimes) if lastCpuTimes else 0
+    
+    isRecheck = self._benchmarkCount % BENCHMARK_RECHECK == 0
+    self._benchmarkCount += 1
+    skippedCosts = {}
+    
+    for resolver in self._availableResolvers:
+      if resolver in self._resolverBlacklist or resolver == self.defaultResolver: continue
+      
+      if not isRecheck and resolver in lastCosts:
+        lastCost = lastCosts[resolver]
+        
+        if lastCost is None or (lastCost[1] > BENCHMARK_LOSS_MARGIN * lastBestCpu and lastCost[1] - lastBestCpu > BENCHMARK_LOSS_MIN):
+          skippedCosts[resolver] = lastCost
+          continue
+      
+      try:
+        connResults, wallTime, cpuTime = self._resolve(resolver, 0)
+        
+        if lastCosts.get(resolver):
+          wallTime = (wallTime + lastCosts[resolver][0]) / 2
+          cpuTime = (cpuTime + lastCosts[resolver][1]) / 2
+        
+        costs[resolver] = (wallTime, cpuTime)
+        results[resolver] = _packConnections(connResults)
+      except (ValueError, IOError):
+        costs[resolver] = None
+    
+    # connections that at least half of the successful resolvers found
+    connCounts = {}
+    for connResults in results.values():
+      for connEntry in connResults:
+        connCounts[connEntry] = connCounts.get(connEntry, 0) + 1
+    
+    consensus = set([connEntry for connEntry, count in connCounts.items() if 2 * count >= len(results)])
+    
+    resolverCosts, bestResolver, bestCost = dict(skippedCosts), None, None
+    
+    for resolver, cost in costs.items():
+      if cost is None:
+        resolverCosts[resolver] = None
+        continue
+      
+      connResults = results[resolver]
+      matches = len(connResults & consensus)
+      isAgreeing = matches >= BENCHMARK_AGREEMENT * len(connResults | consensus)
+      resolverCosts[resolver] = cost + (isAgreeing,)
+      
+      # prefers the lowest cpu time, using wall time to break ties
+      if isAgreeing and (bestCost is None or (cost[1], cost[0]) < bestCost):
+        bestResolver, bestCost = resolver, (cost[1], cost[0])
+    
+    self._resolverCosts = resolverCosts
+    self._lastBenchmark = time.time()
+    
+    if bestResolver and bestResolver != self.defaultResolver:
+      if self.defaultResolver in resolverCosts and resolverCosts[self.defaultResolver]:
+        currentCpu = resolverCosts[self.defaultResolver][1]
+      else: currentCpu = 0
+      
+      log.info(RESOLVER_BENCHMARK_MSG % (self.defaultResolver, bestResolver, currentCpu * 1000, resolverCosts[bestResolver][1] * 1000))
+      self.defaultResolver = bestResolver
+  
+  def getResolverCosts(self):
+    """
+    Provides the costs measured when we last benchmarked the resolvers. This
+    maps each to a tuple of the form...
+    (wall time, cpu time, agrees with others)
+    
+    ... with the times being seconds per resolution, or None if the resolver
+    failed. This is empty if we haven't benchmarked them yet.
+    """
+    
+    return dict(self._resolverCosts)
+  
+  def getResolverLabel(self, resolver):
+    """
+    Provides a description of a resolver with its measured cost, for instance
+    "proc (2.1 ms, 1.8 ms cpu)". If the resolver is None then this describes
+    automatic selection.
+    
+    Arguments:
+      resolver - resolver to be described, None for automatic selection
+    """
+    
+    if resolver is None:
+      return "auto (%s)" % self.defaultResolver if self.defaultResolver else "auto"
+    
+    costs = self._resolverCosts
+    if not resolver in costs: return resolver
+    elif costs[resolver] is None: return "%s (failed)" % resolver
+    
+    wallTime, cpuTime, isAgreeing = costs[resolver]
+    label = "%s (%0.1f ms, %0.1f ms cpu" % (resolver, wallTime * 1000, cpuTime * 1000)
+    
+    if not isAgreeing: label += ", disagrees"
+    return label + ")"
+  
+  def _setConnections(self, newConnections):
+    """
+    Replaces our cached connections with a new resolution, recording what was
+    added and removed under a new generation.
+    
+    Arguments:
+      newConnections - frozenset of packed connections from the latest
+                       resolution
+    """
+    
+    self._changesLock.acquire()
+    added = newConnections - self._connections
+    removed = self._connections - newConnections
+    
+    self._connections = newConnections
+    self._resolutionCounter += 1
+    self._changes.append((self._resolutionCounter, added, removed))
+    del self._changes[:-CHANGE_HISTORY_SIZE]
+    self._changesLock.release()
+  
+  def handleOrConnStatus(self, status, ipAddr = None, port = None):
+    """
+    Applies an ORCONN event from tor. Closed and failed connections are
+    dropped from our results, and new ones that we don't yet have prompt an
+    early lookup (we don't know their local address until then). Launched
+    connections are still being established so these are left for later.
+    
+    Arguments:
+      status - status of the ORCONN event (NEW, LAUNCHED, CONNECTED, FAILED,
+               or CLOSED)
+      ipAddr - address of the relay connection's other end
+      port   - port of the relay connection's other end, if known
+    """
+    
+    self._lastOrConnEvent = time.time()
+    
+    if status == "CONNECTED":
+      # skips connections a prior lookup already found
+      try:
+        if ipAddr and port:
+          packedAddr = connTable.packAddress(ipAddr)
+          
+          for connKey in self._connections:
+            if connTable.isForeignEndpoint(connKey, packedAddr, port): return
+      except (ValueError, struct.error):
+        pass # malformed address or port from the event
+      
+      self._cond.acquire()
+      if not self._refreshRequestTime: self._refreshRequestTime = time.time()
+      self._cond.notifyAll()
+      self._cond.release()
+    elif status in ("CLOSED", "FAILED") and ipAddr:
+      self._changesLock.acquire()
+      
+      try:
+        packedAddr = connTable.packAddress(ipAddr)
+        matches = [connKey for connKey in self._connections if connTable.isForeignEndpoint(connKey, packedAddr)]
+        portMatches = [connKey for connKey in matches if port and connTable.isForeignEndpoint(connKey, packedAddr, port)]
+        
+        # The port might be an ORPort from the consensus rather than the one
+        # the connection's using (as with inbound relay connections). If so
+        # then we can only tell which connection this was if there's one for
+        # the address.
+        
+        if portMatches: matches = portMatches
+        elif len(matches) > 1: matches = []
+        
+        if matches and not self._halt:
+          self._setConnections(self._connections.difference(matches))
+      except ValueError:
+        pass # malformed address or port from the event
+      finally:
+        self._changesLock.release()
+  
   def getConnections(self):
     """
     Provides the last queried connection results, an empty list if resolver
@@ -565,7 +1474,58 @@ class ConnectionResolver(threading.Thread):
     """
     
     if self._halt: return []
-    else: return list(self._connections)
+    else: return [connTable.unpackConnection(connKey) for connKey in self._connections]
+  
+  def getChanges(self, sinceGeneration):
+    """
+    Provides the connections that have been added and removed since the given
+    generation, as a tuple of the form...
+    (generation, added, removed)
+    
+    Connections are in the packed form from connTable.packConnection, which
+    connTable.unpackConnection converts to a (local ip, local port, foreign ip,
+    foreign port) tuple.
+    
+    Callers should hold onto the generation and provide it on their next call.
+    If the changes aren't available (sinceGeneration is -1 or too old) then
+    removed is None and added has all of the current connections, in which
+    case callers should discard anything they have that isn't in it.
+    
+    Arguments:
+      sinceGeneration - generation from the last call, -1 if this is the first
+    """
+    
+    self._changesLock.acquire()
+    
+    try:
+      generation = self._resolutionCounter
+      
+      if self._halt:
+        return (generation, frozenset(), None)
+      elif sinceGeneration == generation:
+        return (generation, frozenset(), frozenset())
+      elif sinceGeneration == -1 or not self._changes or self._changes[0][0] > sinceGeneration + 1:
+        return (generation, self._connections, None)
+      
+      # Combines the changes for each generation. Connections that were both
+      # added and removed in this window cancel out.
+      
+      added, removed = set(), set()
+      
+      for changeGeneration, changeAdded, changeRemoved in self._changes:
+        if changeGeneration <= sinceGeneration: continue
+        
+        for connEntry in changeAdded:
+          if connEntry in removed: removed.remove(connEntry)
+          else: added.add(connEntry)
+        
+        for connEntry in changeRemoved:
+          if connEntry in added: added.remove(connEntry)
+          else: removed.add(connEntry)
+      
+      return (generation, added, removed)
+    finally:
+      self._changesLock.release()
   
   def getResolutionCount(self):
     """
@@ -618,9 +1578,13 @@ class ConnectionResolver(threading.Thread):
 
 class AppResolver:
   """
-  Provides the names and pids of appliations attached to the given ports. This
-  stops attempting to query if it fails three times without successfully
-  getting lsof results.
+  Provides the names and pids of appliations attached to the given ports.
+  Queries are made by a single daemon thread. Where proc is available this
+  finds the sockets using the ports in /proc/net/tcp and attributes their
+  inodes to processes via /proc/<pid>/fd. Attributions are kept in a least
+  recently used cache, so only new sockets require a walk of the process
+  table. Otherwise this falls back to lsof, and stops attempting to query if
+  it fails three times without successfully getting lsof results.
   """
   
   def __init__(self, scriptName = "python"):
@@ -637,6 +1601,18 @@ class AppResolver:
     self._cond = threading.Condition()  # used for pausing when waiting for results
     self.isResolving = False  # flag set if we're in the process of making a query
     self.failureCount = 0     # -1 if we've made a successful query
+    
+    self._useProc = proc.is_available()
+    self._pendingPorts = None # ports for the query our thread should make next
+    self._thread = None       # daemon making our queries, started when first needed
+    self._halt = False
+    
+    # Socket inode => [command, pid, fd, last used] for sockets we've
+    # attributed to a process, with the command and pid being None if we
+    # couldn't find an owner. This is trimmed to APP_CACHE_TRIM_SIZE entries
+    # when it exceeds APP_CACHE_SIZE, dropping the least recently used.
+    self._inodeOwners = {}
+    self._useCounter = 0
   
   def getResults(self, maxWait=0):
     """
@@ -668,15 +1644,179 @@ class AppResolver:
       ports - list of ports to be resolved to applications
     """
     
-    if self.failureCount < 3:
+    if self.failureCount < 3 and not self._halt:
+      self._cond.acquire()
       self.isResolving = True
-      t = threading.Thread(target = self._queryApplications, kwargs = {"ports": ports})
-      t.setDaemon(True)
-      t.start()
+      self._pendingPorts = list(ports)
+      
+      if not self._thread:
+        self._thread = threading.Thread(target = self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+      
+      self._cond.notifyAll()
+      self._cond.release()
+  
+  def stop(self):
+    """
+    Halts further queries and terminates our thread.
+    """
+    
+    self._cond.acquire()
+    self._halt = True
+    self._cond.notifyAll()
+    self._cond.release()
+  
+  def _run(self):
+    """
+    Makes queries as they're requested until we're stopped.
+    """
+    
+    while True:
+      self._cond.acquire()
+      while self._pendingPorts == None and not self._halt: self._cond.wait()
+      ports, self._pendingPorts = self._pendingPorts, None
+      self._cond.release()
+      
+      if self._halt: break
+      
+      results = None
+      
+      # a lookup that fails unexpectedly counts against us, but mustn't end
+      # our thread (leaving callers to think we're still resolving)
+      try:
+        if self._useProc:
+          try:
+            results = self._queryProc(ports)
+          except IOError, exc:
+            log.info("Unable to query applications from proc, falling back to lsof: %s" % exc)
+            self._useProc = False
+        
+        if results == None: results = self._queryLsof(ports)
+      except Exception, exc:
+        log.info("Unable to query applications: %s" % exc)
+      
+      self.resultsLock.acquire()
+      
+      if results != None:
+        self.failureCount = -1
+        self.queryResults = results
+      elif self.failureCount != -1:
+        # lsof query failed and we aren't yet sure if it's possible to
+        # successfully get results on this platform
+        self.failureCount += 1
+      
+      self.resultsLock.release()
+      
+      # wakes threads waiting on results
+      self._cond.acquire()
+      self.isResolving = self._pendingPorts != None
+      self._cond.notifyAll()
+      self._cond.release()
+  
+  def _queryProc(self, ports):
+    """
+    Provides the command/pid tuples for the given ports via proc. This raises
+    an IOError if the tcp tables can't be read.
+    
+    Arguments:
+      ports - list of ports to be resolved to applications
+    """
+    
+    ports = set(ports)
+    portInodes = _readProcNetPorts(ports)
+    
+    # Checks that the sockets we've attributed before are still open by the
+    # same descriptor. Inodes are eventually reused, so entries can go stale.
+    unknownInodes = set()
+    
+    for inode in portInodes:
+      owner = self._inodeOwners.get(inode)
+      
+      if owner and owner[1]:
+        try:
+          fdTarget = os.readlink("/proc/%s/fd/%s" % (owner[1], owner[2]))
+        except OSError:
+          fdTarget = None
+        
+        if fdTarget != "socket:[%s]" % inode: owner = None
+      
+      if not owner: unknownInodes.add(inode)
+    
+    if unknownInodes: self._findOwners(unknownInodes)
+    
+    results = {}
+    
+    for inode, (localPort, foreignPort) in portInodes.items():
+      owner = self._inodeOwners[inode]
+      self._useCounter += 1
+      owner[3] = self._useCounter
+      
+      if not owner[1]: continue # unable to determine the owner
+      
+      newEntry = (localPort, foreignPort, owner[0], owner[1])
+      
+      # adds the entry under the key of whatever we queried it with
+      # (this might be both the inbound _and_ outbound ports)
+      for portMatch in set((localPort, foreignPort)):
+        if portMatch in ports:
+          results.setdefault(portMatch, []).append(newEntry)
+    
+    if len(self._inodeOwners) > APP_CACHE_SIZE:
+      lastUsed = sorted([owner[3] for owner in self._inodeOwners.values()])
+      threshold = lastUsed[-APP_CACHE_TRIM_SIZE]
+      
+      for inode, owner in self._inodeOwners.items():
+        if owner[3] < threshold: del self._inodeOwners[inode]
+    
+    return results
   
-  def _queryApplications(self, ports=[]):
+  def _findOwners(self, inodes):
+    """
+    Walks the file descriptors of our processes to find the owners of the
+    given sockets, caching the results (including those we couldn't find).
+    Processes that recently owned a socket of interest are checked first since
+    they're likely to have opened the new ones.
+    
+    Arguments:
+      inodes - set of socket inodes to be attributed
+    """
+    
+    inodes = set(inodes)
+    recentPids = set([owner[1] for owner in self._inodeOwners.values() if owner[1]])
+    otherPids = [pid for pid in os.listdir("/proc") if pid.isdigit() and not pid in recentPids]
+    
+    for pid in list(recentPids) + otherPids:
+      if not inodes: break
+      
+      fdDir = "/proc/%s/fd" % pid
+      
+      try: fdEntries = os.listdir(fdDir)
+      except OSError: continue # process is gone or we lack permission
+      
+      for fd in fdEntries:
+        try: fdTarget = os.readlink("%s/%s" % (fdDir, fd))
+        except OSError: continue # descriptor was closed while we were reading
+        
+        if fdTarget.startswith("socket:[") and fdTarget[8:-1] in inodes:
+          inode = fdTarget[8:-1]
+          inodes.remove(inode)
+          
+          if pid == str(os.getpid()): cmd = self.scriptName
+          else:
+            processInfo = sysTools.getProcessInfo(pid)
+            cmd = processInfo.name if processInfo else None
+          
+          self._inodeOwners[inode] = [cmd, pid, fd, 0]
+    
+    # sockets of processes we can't read, or that have since closed
+    for inode in inodes:
+      self._inodeOwners[inode] = [None, None, None, 0]
+  
+  def _queryLsof(self, ports):
     """
     Performs an lsof lookup on the given ports to get the command/pid tuples.
+    This provides None if the query fails.
     
     Arguments:
       ports - list of ports to be resolved to applications
@@ -689,19 +1829,6 @@ class AppResolver:
     # python  2462 atagar    3u  IPv4  14047      0t0  TCP localhost:37277->localhost:9051 (ESTABLISHED)
     # python  3444 atagar    3u  IPv4  22023      0t0  TCP localhost:51849->localhost:9051 (ESTABLISHED)
     
-    if not ports:
-      self.resultsLock.acquire()
-      self.queryResults = {}
-      self.isResolving = False
-      self.resultsLock.release()
-      
-      # wakes threads waiting on results
-      self._cond.acquire()
-      self._cond.notifyAll()
-      self._cond.release()
-      
-      return
-    
     results = {}
     lsofArgs = []
     
@@ -716,15 +1843,11 @@ class AppResolver:
       else: lsofArgs.append("-i tcp:%s" % port)
     
     if lsofArgs:
-      lsofResults = system.call("lsof -nP " + " ".join(lsofArgs))
+      lsofResults = sysTools.call("lsof -nP " + " ".join(lsofArgs), None, caller = "AppResolver")
     else: lsofResults = None
     
-    if not lsofResults and self.failureCount != -1:
-      # lsof query failed and we aren't yet sure if it's possible to
-      # successfully get results on this platform
-      self.failureCount += 1
-      self.isResolving = False
-      return
+    if not lsofResults and lsofArgs:
+      return None
     elif lsofResults:
       # (iPort, oPort) tuple for our own process, if it was fetched
       ourConnection = None
@@ -770,14 +1893,5 @@ class AppResolver:
             if shIndex != None:
               del results[ourPort][shIndex]
     
-    self.resultsLock.acquire()
-    self.failureCount = -1
-    self.queryResults = results
-    self.isResolving = False
-    self.resultsLock.release()
-    
-    # wakes threads waiting on results
-    self._cond.acquire()
-    self._cond.notifyAll()
-    self._cond.release()
+    return results
 
@@ -0,0 +1,355 @@
+"""
+Minimal DNS client for reverse (PTR) lookups. This builds and parses its own
+packets, multiplexing any number of outstanding queries over a UDP socket so
+lookups aren't limited by a thread or process per address. Queries that go
+unanswered are retransmitted, rotating through the nameservers listed in
+resolv.conf.
+"""
+
+import time
+import errno
+import random
+import select
+import socket
+import struct
+
+RESOLV_CONF_PATH = "/etc/resolv.conf"
+DNS_PORT = 53
+
+# query type and class for PTR records, and the flag requesting recursion
+TYPE_PTR = 12
+CLASS_IN = 1
+FLAG_RECURSION_DESIRED = 0x0100
+FLAG_RESPONSE = 0x8000
+
+# response codes, with the labels used by the host command
+RESPONSE_CODES = {1: "1(FORMERR)", 2: "2(SERVFAIL)", 3: "3(NXDOMAIN)", 4: "4(NOTIMP)", 5: "5(REFUSED)"}
+
+HEADER = struct.Struct("!HHHHHH")     # id, flags, question, answer, authority, and additional counts
+RECORD_HEADER = struct.Struct("!HHIH") # type, class, ttl, and data length
+MAX_PACKET_SIZE = 512                  # largest response over udp without extensions
+
+def getNameservers(resolvConfPath = RESOLV_CONF_PATH):
+  """
+  Provides the nameserver addresses from resolv.conf, or an empty list if it
+  can't be read.
+  
+  Arguments:
+    resolvConfPath - location of the resolver configuration
+  """
+  
+  nameservers = []
+  
+  try:
+    resolvConf = open(resolvConfPath)
+    
+    for line in resolvConf:
+      lineComp = line.split()
+      
+      if len(lineComp) >= 2 and lineComp[0] == "nameserver":
+        # drops any scope from link-local ipv6 addresses (fe80::1%eth0)
+        nameservers.append(lineComp[1].split("%")[0])
+    
+    resolvConf.close()
+  except IOError: pass
+  
+  return nameservers
+
+def getReverseName(ipAddr):
+  """
+  Provides the name queried for an address' PTR record (for instance,
+  '4.3.2.1.in-addr.arpa' for 1.2.3.4). This raises a ValueError if the
+  address is malformed.
+  
+  Arguments:
+    ipAddr - ip address to be converted
+  """
+  
+  try:
+    if ":" in ipAddr:
+      nibbles = socket.inet_pton(socket.AF_INET6, ipAddr).encode("hex")
+      return ".".join(reversed(nibbles)) + ".ip6.arpa"
+    else:
+      octets = [str(ord(octet)) for octet in socket.inet_aton(ipAddr)]
+      return ".".join(reversed(octets)) + ".in-addr.arpa"
+  except socket.error:
+    raise ValueError("'%s' isn't a valid ip address" % ipAddr)
+
+def buildQuery(queryId, name):
+  """
+  Provides the packet for a recursive PTR query.
+  
+  Arguments:
+    queryId - sixteen bit identifier for the query
+    name    - name to be queried
+  """
+  
+  question = "".join([chr(len(label)) + label for label in name.split(".")])
+  return HEADER.pack(queryId, FLAG_RECURSION_DESIRED, 1, 0, 0, 0) + question + "\x00" + struct.pack("!HH", TYPE_PTR, CLASS_IN)
+
+def parseResponse(packet):
+  """
+  Parses a response, providing a tuple of the form...
+  (query id, response code, queried name, [(ptr name, ttl)...])
+  
+  This raises a ValueError if the packet is malformed or isn't a response.
+  
+  Arguments:
+    packet - response received from the nameserver
+  """
+  
+  try:
+    queryId, flags, questionCount, answerCount, _, _ = HEADER.unpack_from(packet)
+    if not flags & FLAG_RESPONSE: raise ValueError("packet isn't a response")
+    
+    offset, queriedName = HEADER.size, None
+    
+    for _ in range(questionCount):
+      queriedName, offset = _readName(packet, offset)
+      offset += 4 # query type and class
+    
+    ptrRecords = []
+    
+    for _ in range(answerCount):
+      _, offset = _readName(packet, offset)
+      recordType, recordClass, ttl, dataLength = RECORD_HEADER.unpack_from(packet, offset)
+      offset += RECORD_HEADER.size
+      
+      if recordType == TYPE_PTR and recordClass == CLASS_IN:
+        ptrRecords.append((_readName(packet, offset)[0], ttl))
+      
+      offset += dataLength
+    
+    return (queryId, flags & 0xf, queriedName, ptrRecords)
+  except (struct.error, IndexError), exc:
+    raise ValueError("malformed response: %s" % exc)
+
+def _readName(packet, offset):
+  """
+  Reads a possibly compressed name from a packet, providing a tuple of the
+  form (name, offset after the name).
+  
+  Arguments:
+    packet - packet to be read from
+    offset - position where the name starts
+  """
+  
+  labels, endOffset, jumps = [], None, 0
+  
+  while True:
+    length = ord(packet[offset])
+    
+    if length & 0xc0 == 0xc0:
+      # pointer to a name elsewhere in the packet
+      if endOffset == None: endOffset = offset + 2
+      
+      jumps += 1
+      if jumps > 20: raise ValueError("name compression loop")
+      
+      offset = struct.unpack_from("!H", packet, offset)[0] & 0x3fff
+    elif length == 0:
+      if endOffset == None: endOffset = offset + 1
+      return (".".join(labels), endOffset)
+    else:
+      labels.append(packet[offset + 1:offset + 1 + length])
+      if len(labels[-1]) != length: raise IndexError("name runs past the packet")
+      offset += 1 + length
+
+class PtrClient:
+  """
+  Makes reverse lookups for any number of addresses at once. Queries are
+  added with query() and resolved by calls to process(), which sends what's
+  pending, retransmits anything that's timed out, and collects replies.
+  This isn't thread safe, so a single thread should make these calls.
+  """
+  
+  def __init__(self, nameservers = None, timeout = 2, retries = 3, maxOutstanding = 500):
+    """
+    Creates a client for the given nameservers. This raises an IOError if
+    there aren't any.
+    
+    Arguments:
+      nameservers    - addresses of the nameservers to query, read from
+                       resolv.conf if None
+      timeout        - seconds to wait on a reply before retransmitting
+      retries        - number of retransmissions before the lookup fails
+      maxOutstanding - maximum number of queries that are awaiting replies
+    """
+    
+    if nameservers == None: nameservers = getNameservers()
+    if not nameservers: raise IOError("no nameservers are available")
+    
+    self.nameservers = [(nameserver, socket.AF_INET6 if ":" in nameserver else socket.AF_INET) for nameserver in nameservers]
+    self.timeout = timeout
+    self.retries = retries
+    self.maxOutstanding = maxOutstanding
+    
+    self._sockets = {}      # address family => udp socket
+    self._pending = []      # addresses waiting for a query to be sent
+    self._outstanding = {}  # query id => [ip address, reverse name, attempts, send time]
+    self._results = []      # (ip address, hostname or exception, ttl) tuples for finished lookups
+  
+  def query(self, ipAddr):
+    """
+    Queues an address to be resolved.
+    
+    Arguments:
+      ipAddr - ip address to be resolved
+    """
+    
+    self._pending.append(ipAddr)
+  
+  def getOutstandingCount(self):
+    """
+    Provides the number of lookups that haven't yet finished.
+    """
+    
+    return len(self._pending) + len(self._outstanding)
+  
+  def getPendingCount(self):
+    """
+    Provides the number of lookups that are waiting for their query to be
+    sent.
+    """
+    
+    return len(self._pending)
+  
+  def process(self, waitTime = 0):
+    """
+    Sends pending queries, retransmits those that have timed out, and reads
+    any replies. This provides a list of (ip address, result, ttl) tuples for
+    the lookups that finished, where the ttl is the seconds that the record
+    can be cached (None if unknown) and the result is a hostname or...
+      
+      ValueError - address is unresolvable (includes the DNS error response)
+      IOError - lookup failed due to os or network issues
+    
+    Arguments:
+      waitTime - maximum seconds to block waiting for replies
+    """
+    
+    currentTime = time.time()
+    
+    # retransmits queries that haven't been answered in time
+    for queryId, query in self._outstanding.items():
+      if currentTime - query[3] >= self.timeout * query[2]:
+        if query[2] > self.retries:
+          del self._outstanding[queryId]
+          self._results.append((query[0], IOError("lookup timed out"), None))
+        else: self._send(queryId)
+    
+    while self._pending and len(self._outstanding) < self.maxOutstanding:
+      ipAddr = self._pending.pop(0)
+      
+      try:
+        reverseName = getReverseName(ipAddr)
+      except ValueError, exc:
+        self._results.append((ipAddr, exc, None))
+        continue
+      
+      queryId = random.randint(0, 0xffff)
+      while queryId in self._outstanding: queryId = random.randint(0, 0xffff)
+      
+      self._outstanding[queryId] = [ipAddr, reverseName, 0, 0]
+      self._send(queryId)
+    
+    if self._outstanding and self._sockets:
+      try:
+        readable = select.select(self._sockets.values(), [], [], waitTime)[0]
+      except select.error, exc:
+        if exc[0] != errno.EINTR: raise
+        readable = []
+      
+      for udpSocket in readable: self._receive(udpSocket)
+    elif waitTime > 0 and not self._results:
+      time.sleep(waitTime)
+    
+    results, self._results = self._results, []
+    return results
+  
+  def close(self):
+    """
+    Closes our sockets. Outstanding lookups are abandoned.
+    """
+    
+    for udpSocket in self._sockets.values(): udpSocket.close()
+    
+    self._sockets = {}
+    self._pending = []
+    self._outstanding = {}
+  
+  def _send(self, queryId):
+    """
+    Sends (or resends) a query, rotating through the nameservers on each
+    attempt.
+    
+    Arguments:
+      queryId - identifier of the outstanding query
+    """
+    
+    query = self._outstanding[queryId]
+    nameserver, family = self.nameservers[query[2] % len(self.nameservers)]
+    query[2] += 1
+    query[3] = time.time()
+    
+    try:
+      udpSocket = self._getSocket(family)
+      udpSocket.sendto(buildQuery(queryId, query[1]), (nameserver, DNS_PORT))
+    except socket.error:
+      pass # treated like a lost packet, so this is retried after the timeout
+  
+  def _receive(self, udpSocket):
+    """
+    Reads the replies available on a socket.
+    
+    Arguments:
+      udpSocket - socket with replies to be read
+    """
+    
+    while True:
+      try:
+        packet, sender = udpSocket.recvfrom(MAX_PACKET_SIZE)
+      except socket.error, exc:
+        if exc[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+        continue # for instance, an icmp unreachable response from a nameserver
+      
+      try:
+        queryId, responseCode, queriedName, ptrRecords = parseResponse(packet)
+      except ValueError:
+        continue
+      
+      query = self._outstanding.get(queryId)
+      
+      # ignores replies that don't match the query, which might be spoofed or
+      # for a lookup that's already been retransmitted and answered
+      if not query or queriedName == None or queriedName.lower() != query[1]: continue
+      elif not sender[0] in [nameserver for nameserver, _ in self.nameservers]: continue
+      
+      del self._outstanding[queryId]
+      
+      ttl = None
+      
+      if responseCode in RESPONSE_CODES:
+        result = ValueError("address is unresolvable: %s" % RESPONSE_CODES[responseCode])
+      elif responseCode != 0:
+        result = ValueError("address is unresolvable: %i" % responseCode)
+      elif not ptrRecords:
+        result = ValueError("address is unresolvable: no PTR record")
+      else: result, ttl = ptrRecords[0]
+      
+      self._results.append((query[0], result, ttl))
+  
+  def _getSocket(self, family):
+    """
+    Provides our non-blocking udp socket for the given address family.
+    
+    Arguments:
+      family - socket.AF_INET or socket.AF_INET6
+    """
+    
+    if not family in self._sockets:
+      udpSocket = socket.socket(family, socket.SOCK_DGRAM)
+      udpSocket.setblocking(0)
+      self._sockets[family] = udpSocket
+    
+    return self._sockets[family]
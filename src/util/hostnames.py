@@ -4,8 +4,12 @@ both resolution via a thread pool (looking up several addresses at a time) and
 caching of the results. If used, it's advisable that this service is stopped
 when it's no longer needed. All calls are both non-blocking and thread safe.
 
-Be aware that this relies on querying the system's DNS servers, possibly
-leaking the requested addresses to third parties.
+By default lookups are made through tor, which keeps the addresses we're
+connected to from being revealed to the system's nameservers. Otherwise they're
+made with our own DNS client (which multiplexes them over a single socket), or
+the pool makes host or gethostbyaddr calls. Be aware that these latter methods
+query the system's DNS servers, leaking the requested addresses to third
+parties.
 """
 
 # The only points of concern in terms of concurrent calls are the RESOLVER and
@@ -13,8 +17,9 @@ leaking the requested addresses to third parties.
 # safety via the following invariants:
 # - Resolver and cache instances are non-destructible
 #     Nothing can be removed or invalidated. Rather, halting resolvers and
-#     trimming the cache are done via reassignment (pointing the RESOLVER or
-#     RESOLVER.resolvedCache to another copy).
+#     trimming the cache are done via reassignment (pointing the RESOLVER to
+#     another copy, or the cache to a new list of its generations, leaving the
+#     old list intact for anyone reading it).
 # - Functions create and use local references to the resolver and its cache
 #     This is for consistency (ie, all operations are done on the same resolver
 #     or cache instance regardless of concurrent assignments). Usually it's
@@ -22,27 +27,48 @@ leaking the requested addresses to third parties.
 # - Locks aren't necessary, but used to help in the following cases:
 #     - When assigning to the RESOLVER (to avoid orphaned instances with
 #       running thread pools).
-#     - When adding/removing from the cache (prevents workers from updating
-#       an outdated cache reference).
+#     - When adding to the cache (so a new generation is only started once
+#       when the newest fills up).
+#     - When adding/removing pending lookups, so requests for an address that's
+#       being resolved wait on the same lookup rather than queuing another.
 
+import os
 import time
+import heapq
 import socket
 import threading
 import itertools
 import Queue
 import distutils.sysconfig
 
-from stem.util import conf, log, system
+from stem.util import conf, log
+
+from util import dnsClient, sysTools, torTools
 
 RESOLVER = None                       # hostname resolver (service is stopped if None)
 RESOLVER_LOCK = threading.RLock()     # regulates assignment to the RESOLVER
-RESOLVER_COUNTER = itertools.count()  # atomic counter, providing the age for new entries (for trimming)
 DNS_ERROR_CODES = ("1(FORMERR)", "2(SERVFAIL)", "3(NXDOMAIN)", "4(NOTIMP)", "5(REFUSED)", "6(YXDOMAIN)",
                    "7(YXRRSET)", "8(NXRRSET)", "9(NOTAUTH)", "10(NOTZONE)", "16(BADVERS)")
+CLIENT_WAIT = 0.1                     # seconds lookup clients block on replies before checking for new requests
+TOR_REQUEST_RATE = 1                  # minimum seconds between RESOLVE requests to tor
+TOR_LOOKUP_TIMEOUT = 60               # seconds before giving up on tor's reply to a lookup
+PERSIST_PATH = "cache/hostnames"      # location of the persisted cache within our data directory
+PERSIST_BATCH_SIZE = 100              # number of new results that are appended to the persisted cache at a time
+
+# Lookup priorities, lower values being resolved first. Addresses that are
+# being displayed are visible, and others (such as those being sorted) are in
+# the background.
+PRIORITY_VISIBLE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_STOP = 0 # tells workers to stop, ahead of anything else
 
 def conf_handler(key, value):
   if key == "queries.hostnames.poolSize":
     return max(1, value)
+  elif key in ("queries.hostnames.torBatchSize", "queries.hostnames.torMaxPending"):
+    return max(1, value)
+  elif key in ("cache.hostnames.ttl", "cache.hostnames.minTtl", "cache.hostnames.failureTtl"):
+    return max(0, value)
   elif key == "cache.hostnames.size":
     return max(100, value)
   elif key == "cache.hostnames.trimSize":
@@ -53,8 +79,17 @@ def conf_handler(key, value):
 CONFIG = conf.config_dict("arm", {
   "queries.hostnames.poolSize": 5,
   "queries.hostnames.useSocketModule": False,
+  "queries.hostnames.useDnsClient": True,
+  "queries.hostnames.useTor": True,
+  "queries.hostnames.torBatchSize": 25,
+  "queries.hostnames.torMaxPending": 100,
   "cache.hostnames.size": 700000,
   "cache.hostnames.trimSize": 200000,
+  "cache.hostnames.persist": False,
+  "cache.hostnames.ttl": 604800,
+  "cache.hostnames.minTtl": 3600,
+  "cache.hostnames.failureTtl": 3600,
+  "startup.dataDirectory": "~/.arm",
 }, conf_handler)
 
 def start():
@@ -103,7 +138,7 @@ def setPaused(isPause):
   # makes sure a running resolver is set with the pausing setting
   RESOLVER_LOCK.acquire()
   start()
-  RESOLVER.isPaused = isPause
+  RESOLVER.setPaused(isPause)
   RESOLVER_LOCK.release()
 
 def isRunning():
@@ -122,6 +157,16 @@ def isPaused():
   if resolverRef: return resolverRef.isPaused
   else: return False
 
+def isPrivate():
+  """
+  Returns True if lookups are made through tor, so the addresses we resolve
+  aren't revealed to the system's nameservers, False otherwise.
+  """
+  
+  resolverRef = RESOLVER
+  if resolverRef: return isinstance(resolverRef.lookupClient, _TorClient)
+  else: return CONFIG["queries.hostnames.useTor"]
+
 def isResolving():
   """
   Returns True if addresses are currently waiting to be resolved, False
@@ -129,10 +174,10 @@ def isResolving():
   """
   
   resolverRef = RESOLVER
-  if resolverRef: return not resolverRef.unresolvedQueue.empty()
+  if resolverRef: return bool(resolverRef.pendingLookups)
   else: return False
 
-def resolve(ipAddr, timeout = 0, suppressIOExc = True):
+def resolve(ipAddr, timeout = 0, suppressIOExc = True, priority = PRIORITY_BACKGROUND):
   """
   Provides the hostname associated with a given IP address. By default this is
   a non-blocking call, fetching cached results if available and queuing the
@@ -153,36 +198,54 @@ def resolve(ipAddr, timeout = 0, suppressIOExc = True):
                     completion if None)
     suppressIOExc - suppresses lookup errors and re-runs failed calls if true,
                     raises otherwise
+    priority      - PRIORITY_VISIBLE or PRIORITY_BACKGROUND, addresses with
+                    the former are resolved first
   """
   
-  # starts the service if it isn't already running (making sure we have an
-  # instance in a thread safe fashion before continuing)
-  resolverRef = RESOLVER
-  if resolverRef == None:
-    RESOLVER_LOCK.acquire()
-    start()
-    resolverRef = RESOLVER
-    RESOLVER_LOCK.release()
+  resolverRef = _getResolver()
   
   if resolverRef.isPaused:
     # get cache entry, raising if an exception and returning if a hostname
-    cacheRef = resolverRef.resolvedCache
-    
-    if ipAddr in cacheRef:
-      entry = cacheRef[ipAddr][0]
-      if suppressIOExc and type(entry) == IOError: return None
-      elif isinstance(entry, Exception): raise entry
-      else: return entry
-    else: return None
+    entry = resolverRef.resolvedCache.get(ipAddr)
+    
+    if suppressIOExc and type(entry) == IOError: return None
+    elif isinstance(entry, Exception): raise entry
+    else: return entry
   elif suppressIOExc:
     # if resolver has cached an IOError then flush the entry (this defaults to
     # suppression since these error may be transient)
-    cacheRef = resolverRef.resolvedCache
-    flush = ipAddr in cacheRef and type(cacheRef[ipAddr]) == IOError
+    flush = type(resolverRef.resolvedCache.get(ipAddr)) == IOError
     
-    try: return resolverRef.getHostname(ipAddr, timeout, flush)
+    try: return resolverRef.getHostname(ipAddr, timeout, flush, priority)
     except IOError: return None
-  else: return resolverRef.getHostname(ipAddr, timeout)
+  else: return resolverRef.getHostname(ipAddr, timeout, False, priority)
+
+def resolveMany(ipAddrs, timeout = 0, priority = PRIORITY_BACKGROUND):
+  """
+  Provides the hostnames for several addresses at once, as a dictionary of
+  ip addresses to their hostname. Like resolve(), this fetches cached results
+  and queues lookups for the rest, providing None for any addresses that are
+  unresolved when the timeout is reached or that couldn't be resolved.
+  
+  Arguments:
+    ipAddrs  - ip addresses to be resolved
+    timeout  - maximum duration to wait for all of the resolutions (blocks to
+               completion if None)
+    priority - PRIORITY_VISIBLE or PRIORITY_BACKGROUND, addresses with the
+               former are resolved first
+  """
+  
+  resolverRef = _getResolver()
+  
+  if resolverRef.isPaused:
+    results = dict([(ipAddr, resolverRef.resolvedCache.get(ipAddr)) for ipAddr in ipAddrs])
+  else:
+    results = resolverRef.getHostnames(ipAddrs, timeout, priority)
+  
+  for ipAddr, result in results.items():
+    if isinstance(result, Exception): results[ipAddr] = None
+  
+  return results
 
 def getPendingCount():
   """
@@ -191,7 +254,7 @@ def getPendingCount():
   """
   
   resolverRef = RESOLVER
-  if resolverRef: return resolverRef.unresolvedQueue.qsize()
+  if resolverRef: return len(resolverRef.pendingLookups)
   else: return 0
 
 def getRequestCount():
@@ -203,6 +266,39 @@ def getRequestCount():
   if resolverRef: return resolverRef.totalResolves
   else: return 0
 
+def _getResolver():
+  """
+  Provides the running resolver, starting the service if it isn't already
+  running (making sure we have an instance in a thread safe fashion).
+  """
+  
+  resolverRef = RESOLVER
+  
+  if resolverRef == None:
+    RESOLVER_LOCK.acquire()
+    start()
+    resolverRef = RESOLVER
+    RESOLVER_LOCK.release()
+  
+  return resolverRef
+
+def handleAddrMap(address, destination, error = None, ttl = None):
+  """
+  Provides the results of lookups made through tor, which are reported by its
+  ADDRMAP events.
+  
+  Arguments:
+    address     - address that was resolved
+    destination - hostname it resolved to, None if the lookup failed
+    error       - reason the lookup failed, if provided
+    ttl         - seconds until tor's mapping expires, if provided
+  """
+  
+  resolverRef = RESOLVER
+  
+  if resolverRef and isinstance(resolverRef.lookupClient, _TorClient):
+    resolverRef.lookupClient.handleAddrMap(address, destination, error, ttl)
+
 def _resolveViaSocket(ipAddr):
   """
   Performs hostname lookup via the socket module's gethostbyaddr function. This
@@ -231,7 +327,7 @@ def _resolveViaHost(ipAddr):
     ipAddr - ip address to be resolved
   """
   
-  hostname = system.call("host %s" % ipAddr)[0].split()[-1:][0]
+  hostname = sysTools.call("host %s" % ipAddr, caller = "hostnames")[0].split()[-1:][0]
   
   if hostname == "reached":
     # got message: ";; connection timed out; no servers could be reached"
@@ -246,22 +342,27 @@ def _resolveViaHost(ipAddr):
 class _Resolver():
   """
   Performs reverse DNS resolutions. Lookups are a network bound operation so
-  this spawns a pool of worker threads to do several at a time in parallel.
+  this either makes them all at once with a lookup client (through tor or our
+  dns client) or spawns a pool of worker threads to do several at a time in
+  parallel.
   """
   
   def __init__(self):
-    # IP Address => (hostname/error, age), resolution failures result in a
-    # ValueError with the lookup's status
-    self.resolvedCache = {}
+    # IP Address => (hostname/error, expiration), resolution failures result
+    # in a ValueError with the lookup's status
+    self.resolvedCache = _HostnameCache(CONFIG["cache.hostnames.size"], CONFIG["cache.hostnames.trimSize"])
     
-    self.resolvedLock = threading.RLock() # governs concurrent access when modifying resolvedCache
-    self.unresolvedQueue = Queue.Queue()  # unprocessed lookup requests
-    self.recentQueries = []               # recent resolution requests to prevent duplicate requests
+    self.resolvedLock = threading.RLock() # governs concurrent access when modifying pendingLookups
+    self.unresolvedQueue = _PriorityQueue() # unprocessed lookup requests (None tells a worker to stop)
+    self.pendingLookups = {}              # IP Address => Event set when its queued lookup is done
+    self.queuedPriority = {}              # IP Address => priority, for pending lookups no worker's taken yet
     self.threadPool = []                  # worker threads that process requests
     self.totalResolves = 0                # counter for the total number of addresses queried to be resolved
     self.isPaused = False                 # prevents further resolutions if true
     self.halt = False                     # if true, tells workers to stop
     self.cond = threading.Condition()     # used for pausing threads
+    self.unsavedEntries = []              # persisted cache lines for results that haven't yet been written
+    self.persistCond = threading.Condition() # governs unsavedEntries, notified when there's a batch to write
     
     # Determines if resolutions are made using os 'host' calls or python's
     # 'socket.gethostbyaddr'. The following checks if the system has the
@@ -270,13 +371,42 @@ class _Resolver():
     isSocketResolutionParallel = distutils.sysconfig.get_config_var("HAVE_GETHOSTBYNAME_R")
     self.useSocketResolution = CONFIG["queries.hostnames.useSocketModule"] and isSocketResolutionParallel
     
-    for _ in range(CONFIG["queries.hostnames.poolSize"]):
-      t = threading.Thread(target = self._workerLoop)
+    # Lookup clients need only a single thread, since their lookups are all in
+    # flight at once. Our dns client falls back to the pool if there aren't any
+    # nameservers we can use.
+    self.lookupClient = None
+    
+    if CONFIG["queries.hostnames.useTor"]:
+      self.lookupClient = _TorClient()
+    elif CONFIG["queries.hostnames.useDnsClient"]:
+      try:
+        self.lookupClient = dnsClient.PtrClient()
+      except IOError, exc:
+        log.info("Unable to resolve hostnames with our dns client, falling back to a thread pool: %s" % exc)
+    
+    if self.lookupClient: workerLoop, poolSize = self._clientLoop, 1
+    else: workerLoop, poolSize = self._workerLoop, CONFIG["queries.hostnames.poolSize"]
+    
+    # The persisted cache is loaded and saved by a thread of its own so it
+    # doesn't hold up lookups. This is joined along with the pool, so our last
+    # results are written when we're stopped.
+    self.persistPath = None
+    
+    if CONFIG["cache.hostnames.persist"]:
+      dataDir = CONFIG["startup.dataDirectory"]
+      if not dataDir.endswith("/"): dataDir += "/"
+      self.persistPath = os.path.expanduser(dataDir + PERSIST_PATH)
+    
+    threadTargets = [workerLoop] * poolSize
+    if self.persistPath: threadTargets.append(self._persistLoop)
+    
+    for target in threadTargets:
+      t = threading.Thread(target = target)
       t.setDaemon(True)
       t.start()
       self.threadPool.append(t)
   
-  def getHostname(self, ipAddr, timeout, flushCache = False):
+  def getHostname(self, ipAddr, timeout, flushCache = False, priority = PRIORITY_BACKGROUND):
     """
     Provides the hostname, queuing the request and returning None if the
     timeout is reached before resolution. If a problem's encountered then this
@@ -288,41 +418,82 @@ class _Resolver():
       timeout    - maximum duration to wait for a resolution (blocks to
                    completion if None)
       flushCache - if true the cache is skipped and address re-resolved
+      priority   - priority of the lookup if it needs to be queued
     """
     
-    # if outstanding requests are done then clear recentQueries to allow
-    # entries removed from the cache to be re-run
-    if self.unresolvedQueue.empty(): self.recentQueries = []
+    response = None if flushCache else self.resolvedCache.get(ipAddr)
     
-    # copies reference cache (this is important in case the cache is trimmed
-    # during this call)
-    cacheRef = self.resolvedCache
-    
-    if not flushCache and ipAddr in cacheRef:
+    if response != None:
       # cached response is available - raise if an error, return if a hostname
-      response = cacheRef[ipAddr][0]
       if isinstance(response, Exception): raise response
       else: return response
-    elif flushCache or ipAddr not in self.recentQueries:
-      # new request - queue for resolution
-      self.totalResolves += 1
-      self.recentQueries.append(ipAddr)
-      self.unresolvedQueue.put(ipAddr)
     
-    # periodically check cache if requester is willing to wait
+    self.resolvedLock.acquire()
+    lookupDone = self._queueLookup(ipAddr, priority)
+    self.resolvedLock.release()
+    
+    # blocks until the lookup's done if the requester is willing to wait
     if timeout == None or timeout > 0:
-      startTime = time.time()
+      lookupDone.wait(timeout)
+      
+      response = self.resolvedCache.get(ipAddr) if lookupDone.isSet() else None
       
-      while timeout == None or time.time() - startTime < timeout:
-        if ipAddr in cacheRef:
-          # address was resolved - raise if an error, return if a hostname
-          response = cacheRef[ipAddr][0]
-          if isinstance(response, Exception): raise response
-          else: return response
-        else: time.sleep(0.1)
+      if response != None:
+        # address was resolved - raise if an error, return if a hostname
+        if isinstance(response, Exception): raise response
+        else: return response
     
     return None # timeout reached without resolution
   
+  def getHostnames(self, ipAddrs, timeout, priority = PRIORITY_BACKGROUND):
+    """
+    Provides a dictionary of ip addresses to their hostname, the exception
+    from resolving them, or None if they're unresolved when the timeout is
+    reached.
+    
+    Arguments:
+      ipAddrs  - ip addresses to be resolved
+      timeout  - maximum duration to wait for all of the resolutions (blocks
+                 to completion if None)
+      priority - priority of the lookups that need to be queued
+    """
+    
+    results, unresolved = {}, {} # the latter maps addresses to their lookup's Event
+    self.resolvedLock.acquire()
+    
+    for ipAddr in ipAddrs:
+      results[ipAddr] = self.resolvedCache.get(ipAddr)
+      
+      if results[ipAddr] == None and not ipAddr in unresolved:
+        unresolved[ipAddr] = self._queueLookup(ipAddr, priority)
+    
+    self.resolvedLock.release()
+    
+    if unresolved and (timeout == None or timeout > 0):
+      endTime = None if timeout == None else time.time() + timeout
+      
+      for ipAddr, lookupDone in unresolved.items():
+        if endTime == None: lookupDone.wait()
+        else: lookupDone.wait(max(0, endTime - time.time()))
+        
+        if lookupDone.isSet(): results[ipAddr] = self.resolvedCache.get(ipAddr)
+    
+    return results
+  
+  def setPaused(self, isPause):
+    """
+    Allows or prevents further resolutions.
+    
+    Arguments:
+      isPause - puts a freeze on further resolutions if true, allows them to
+                continue otherwise
+    """
+    
+    self.cond.acquire()
+    self.isPaused = isPause
+    self.cond.notifyAll()
+    self.cond.release()
+  
   def stop(self):
     """
     Halts further resolutions and terminates the thread.
@@ -332,6 +503,68 @@ class _Resolver():
     self.halt = True
     self.cond.notifyAll()
     self.cond.release()
+    
+    self.persistCond.acquire()
+    self.persistCond.notifyAll()
+    self.persistCond.release()
+    
+    # wakes workers blocked on the queue
+    for _ in self.threadPool: self.unresolvedQueue.put((PRIORITY_STOP, None))
+    
+    # wakes anyone waiting on a lookup that won't be made
+    self.resolvedLock.acquire()
+    for lookupDone in self.pendingLookups.values(): lookupDone.set()
+    self.pendingLookups = {}
+    self.queuedPriority = {}
+    self.resolvedLock.release()
+  
+  def _queueLookup(self, ipAddr, priority):
+    """
+    Queues a lookup unless there's already one in progress for the address,
+    providing the Event that's set when it's done. If the address is queued
+    with a lower priority then it's queued again so it can jump ahead. The
+    resolvedLock must be held when calling this.
+    
+    Arguments:
+      ipAddr   - ip address to be resolved
+      priority - priority of the lookup
+    """
+    
+    lookupDone = self.pendingLookups.get(ipAddr)
+    
+    if not lookupDone:
+      lookupDone = threading.Event()
+      self.pendingLookups[ipAddr] = lookupDone
+      self.queuedPriority[ipAddr] = priority
+      
+      self.totalResolves += 1
+      self.unresolvedQueue.put((priority, ipAddr))
+    elif priority < self.queuedPriority.get(ipAddr, priority):
+      self.queuedPriority[ipAddr] = priority
+      self.unresolvedQueue.put((priority, ipAddr))
+    
+    return lookupDone
+  
+  def _nextLookup(self, block = True):
+    """
+    Provides the next address to be resolved from the unresolvedQueue, or None
+    if we're being stopped. This raises Queue.Empty if we aren't blocking and
+    nothing is queued.
+    
+    Arguments:
+      block - blocks until there's an address if true
+    """
+    
+    while True:
+      ipAddr = self.unresolvedQueue.get(block)
+      if ipAddr == None: return None
+      
+      # skips the extra queue entries for addresses that were moved ahead
+      self.resolvedLock.acquire()
+      isQueued = self.queuedPriority.pop(ipAddr, None) != None
+      self.resolvedLock.release()
+      
+      if isQueued: return ipAddr
   
   def _workerLoop(self):
     """
@@ -342,23 +575,15 @@ class _Resolver():
     """
     
     while not self.halt:
+      # blocks until there's an address, or None when we're being stopped
+      ipAddr = self._nextLookup()
+      
       # if resolver is paused then put a hold on further resolutions
-      if self.isPaused:
-        self.cond.acquire()
-        if not self.halt: self.cond.wait(1)
-        self.cond.release()
-        continue
-      
-      # snags next available ip, timeout is because queue can't be woken up
-      # when 'halt' is set
-      try: ipAddr = self.unresolvedQueue.get_nowait()
-      except Queue.Empty:
-        # no elements ready, wait a little while and try again
-        self.cond.acquire()
-        if not self.halt: self.cond.wait(1)
-        self.cond.release()
-        continue
-      if self.halt: break
+      self.cond.acquire()
+      while self.isPaused and not self.halt: self.cond.wait()
+      self.cond.release()
+      
+      if self.halt or ipAddr == None: break
       
       try:
         if self.useSocketResolution: result = _resolveViaSocket(ipAddr)
@@ -366,29 +591,470 @@ class _Resolver():
       except IOError, exc: result = exc # lookup failed
       except ValueError, exc: result = exc # dns error
       
-      self.resolvedLock.acquire()
-      self.resolvedCache[ipAddr] = (result, RESOLVER_COUNTER.next())
+      self._storeResult(ipAddr, result)
+  
+  def _clientLoop(self):
+    """
+    Counterpart of the _workerLoop when using a lookup client. This hands
+    addresses from the unresolvedQueue to the client as it has room for them,
+    storing the results as replies come in. The rest of the backlog stays in
+    our queue, so new requests with a higher priority can jump ahead of it.
+    """
+    
+    while not self.halt:
+      # Blocks until there's an address if we're idle, then takes whatever else
+      # is available that the client has room for. Clients only hold enough
+      # unsent lookups for the next batch of tor requests (our dns client
+      # sends its queries right away, so it always has room).
+      newAddresses = []
+      isIdle = not self.lookupClient.getOutstandingCount()
+      backlogSize = CONFIG["queries.hostnames.torBatchSize"]
+      
+      try:
+        while self.lookupClient.getPendingCount() + len(newAddresses) < backlogSize:
+          newAddresses.append(self._nextLookup(isIdle and not newAddresses))
+          if newAddresses[-1] == None: break
+      except Queue.Empty: pass
+      
+      # if resolver is paused then put a hold on further resolutions
+      self.cond.acquire()
+      while self.isPaused and not self.halt: self.cond.wait()
+      self.cond.release()
+      
+      if self.halt or None in newAddresses: break
+      
+      for ipAddr in newAddresses: self.lookupClient.query(ipAddr)
+      
+      for ipAddr, result, ttl in self.lookupClient.process(CLIENT_WAIT):
+        self._storeResult(ipAddr, result, ttl)
+    
+    self.lookupClient.close()
+  
+  def _storeResult(self, ipAddr, result, ttl = None):
+    """
+    Caches the results of a lookup, notifying anyone waiting on it.
+    Unresolvable addresses are kept for cache.hostnames.failureTtl, and
+    hostnames for their record's ttl (no less than cache.hostnames.minTtl and
+    no more than cache.hostnames.ttl). Hostnames without a known ttl are kept
+    for cache.hostnames.ttl.
+    
+    Arguments:
+      ipAddr - ip address that was resolved
+      result - hostname, or the exception from a failed lookup
+      ttl    - seconds that the result can be cached, if known
+    """
+    
+    if isinstance(result, Exception): ttl = CONFIG["cache.hostnames.failureTtl"]
+    elif ttl is None: ttl = CONFIG["cache.hostnames.ttl"]
+    else: ttl = min(max(ttl, CONFIG["cache.hostnames.minTtl"]), CONFIG["cache.hostnames.ttl"])
+    
+    currentTime = int(time.time())
+    self.resolvedCache.set(ipAddr, result, currentTime + ttl)
+    
+    # Lookup failures (IOErrors) are likely transient, so only hostnames and
+    # unresolvable addresses are persisted. Hostnames with whitespace would
+    # break our format, and aren't really hostnames anyway.
+    if self.persistPath and not isinstance(result, IOError):
+      if isinstance(result, ValueError): value = "!" + " ".join(str(result).split())
+      elif len(result.split()) != 1: value = None
+      else: value = result
+      
+      if value:
+        self.persistCond.acquire()
+        self.unsavedEntries.append("%s %i %i %s\n" % (ipAddr, currentTime, ttl, value))
+        if len(self.unsavedEntries) >= PERSIST_BATCH_SIZE: self.persistCond.notifyAll()
+        self.persistCond.release()
+    
+    # notifies anyone waiting on this address
+    self.resolvedLock.acquire()
+    lookupDone = self.pendingLookups.pop(ipAddr, None)
+    if lookupDone: lookupDone.set()
+    self.resolvedLock.release()
+
+  def _persistLoop(self):
+    """
+    Loads the persisted cache, then appends new results to it in batches until
+    we're stopped. The file has a line for each result of the form...
+    
+      <ip address> <unix timestamp> <ttl> <hostname or '!' with an error>
+    
+    Once appends have left the file more than twice the size it had after it
+    was last loaded or compacted, it's compacted again (see _compactEntries).
+    """
+    
+    lineCount, loadedEntries = self._readEntries()
+    
+    if loadedEntries:
+      # adds the entries from oldest to newest so they fall into the right
+      # generations, skipping any we've resolved since starting
+      sortedEntries = sorted(loadedEntries.items(), key = lambda entry: entry[1][1])
+      
+      for ipAddr, (result, expiration, _) in sortedEntries:
+        if self.resolvedCache.get(ipAddr) == None:
+          self.resolvedCache.set(ipAddr, result, expiration)
+      
+      log.info("Loaded %i cached hostnames from %s" % (len(loadedEntries), self.persistPath))
+    
+    entryCount = len(loadedEntries)
+    loadedEntries = sortedEntries = None
+    
+    while True:
+      if lineCount > 2 * entryCount + PERSIST_BATCH_SIZE:
+        lineCount = entryCount = self._compactEntries()
+      
+      self.persistCond.acquire()
+      
+      while not self.halt and len(self.unsavedEntries) < PERSIST_BATCH_SIZE:
+        self.persistCond.wait()
+      
+      entries, self.unsavedEntries = self.unsavedEntries, []
+      self.persistCond.release()
+      
+      if entries:
+        self._writeEntries(entries, True)
+        lineCount += len(entries)
+      
+      if self.halt: break
+  
+  def _readEntries(self):
+    """
+    Reads the persisted cache, providing a tuple of the form...
+    (line count, {ip address => (result, expiration, line)})
+    
+    ... with the newest unexpired entry for each address. This is empty if the
+    cache doesn't exist or can't be read.
+    """
+    
+    lineCount, entries = 0, {}
+    
+    try:
+      persistFile = open(self.persistPath)
+      currentTime = time.time()
       
-      # trim cache if excessively large (clearing out oldest entries)
-      if len(self.resolvedCache) > CONFIG["cache.hostnames.size"]:
-        # Providing for concurrent, non-blocking calls require that entries are
-        # never removed from the cache, so this creates a new, trimmed version
-        # instead.
+      for line in persistFile:
+        lineCount += 1
+        lineComp = line.split(" ", 3)
         
-        # determines minimum age of entries to be kept
-        currentCount = RESOLVER_COUNTER.next()
-        newCacheSize = CONFIG["cache.hostnames.size"] - CONFIG["cache.hostnames.trimSize"]
-        threshold = currentCount - newCacheSize
-        newCache = {}
+        if len(lineComp) != 4 or not lineComp[1].isdigit() or not lineComp[2].isdigit(): continue
         
-        msg = "trimming hostname cache from %i entries to %i" % (len(self.resolvedCache), newCacheSize)
-        log.info(msg)
+        ipAddr, expiration, value = lineComp[0], int(lineComp[1]) + int(lineComp[2]), lineComp[3].strip()
+        if expiration < currentTime: continue
         
-        # checks age of each entry, adding to toDelete if too old
-        for ipAddr, entry in self.resolvedCache.iteritems():
-          if entry[1] >= threshold: newCache[ipAddr] = entry
+        if value.startswith("!"): result = ValueError(value[1:])
+        else: result = value
         
-        self.resolvedCache = newCache
+        entries[ipAddr] = (result, expiration, line)
       
-      self.resolvedLock.release()
+      persistFile.close()
+    except IOError, exc:
+      if os.path.exists(self.persistPath):
+        log.info("Unable to load cached hostnames from %s: %s" % (self.persistPath, exc))
+    
+    return (lineCount, entries)
+  
+  def _compactEntries(self):
+    """
+    Rewrites the persisted cache without duplicate or expired entries, keeping
+    at most cache.hostnames.size of them. Entries are sorted by expiration
+    rather than when they were resolved, which is close enough for deciding
+    what to drop first. This provides the number of entries that were kept.
+    """
+    
+    entries = self._readEntries()[1].values()
+    entries.sort(key = lambda entry: entry[1])
+    entries = entries[-CONFIG["cache.hostnames.size"]:]
+    
+    self._writeEntries([entry[2] for entry in entries], False)
+    return len(entries)
+  
+  def _writeEntries(self, entries, isAppend):
+    """
+    Writes lines to the persisted cache, logging if unable to. Rewrites are
+    made to a temporary file that then replaces the cache, so it's never left
+    partly written.
+    
+    Arguments:
+      entries  - lines to be written
+      isAppend - appends to the cache if true, replaces it otherwise
+    """
+    
+    path = self.persistPath if isAppend else self.persistPath + ".new"
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if isAppend else os.O_TRUNC)
+    
+    try:
+      baseDir = os.path.dirname(path)
+      if not os.path.exists(baseDir): os.makedirs(baseDir)
+      
+      # these reveal who we've been connected to, so they're only readable by us
+      persistFile = os.fdopen(os.open(path, flags, 0600), "w")
+      persistFile.writelines(entries)
+      persistFile.close()
+      
+      if not isAppend: os.rename(path, self.persistPath)
+    except (IOError, OSError), exc:
+      log.info("Unable to save cached hostnames to %s: %s" % (self.persistPath, exc))
+
+class _HostnameCache:
+  """
+  Segmented cache of lookup results. Entries are added to the newest of
+  several generations, and when it fills up the oldest generation is dropped.
+  Entries read from an older generation are copied into the newest so
+  addresses that are still in use survive. This keeps memory flat at the
+  configured size without ever copying the cache, and reads never lock.
+  Entries also expire, after which they're treated as being absent.
+  """
+  
+  def __init__(self, size, segmentSize):
+    """
+    Creates an empty cache.
+    
+    Arguments:
+      size        - maximum number of entries to be kept
+      segmentSize - number of entries in each generation, and so the number
+                    that are dropped at a time
+    """
+    
+    self.segmentSize = segmentSize
+    self.segmentCount = max(2, size / segmentSize)
+    self._segments = [{}]             # generations of ip => (result, expiration) mappings, newest first
+    self._lock = threading.RLock()    # governs adding entries and generations
+  
+  def get(self, ipAddr, default = None):
+    """
+    Provides the cached result for an address, or the default if there isn't
+    one or it has expired.
+    
+    Arguments:
+      ipAddr  - ip address to be looked up
+      default - value provided if the address isn't cached
+    """
+    
+    segments = self._segments
+    
+    for segment in segments:
+      entry = segment.get(ipAddr)
+      
+      if entry != None:
+        if entry[1] < time.time(): return default
+        
+        # moves the entry to the newest generation, so it won't be dropped
+        # while it's still being used
+        if segment is not segments[0]: segments[0][ipAddr] = entry
+        return entry[0]
+    
+    return default
+  
+  def set(self, ipAddr, result, expiration):
+    """
+    Caches the result of a lookup, starting a new generation if the newest is
+    full.
+    
+    Arguments:
+      ipAddr     - ip address that was resolved
+      result     - hostname, or the exception from a failed lookup
+      expiration - unix time when the entry expires
+    """
+    
+    self._lock.acquire()
+    segments = self._segments
+    segments[0][ipAddr] = (result, expiration)
+    
+    if len(segments[0]) >= self.segmentSize:
+      newSegments = [{}] + segments[:self.segmentCount - 1]
+      
+      if len(segments) == self.segmentCount:
+        log.info("dropping the oldest %i entries from the hostname cache" % len(segments[-1]))
+      
+      self._segments = newSegments
+    
+    self._lock.release()
+    
+    # the dropped generation is freed when our reference goes out of scope,
+    # which is after we've released the lock
+  
+  def __len__(self):
+    """
+    Provides the number of cached entries. Addresses in several generations
+    are counted for each.
+    """
+    
+    return sum([len(segment) for segment in self._segments])
+
+class _PriorityQueue(Queue.Queue):
+  """
+  Queue providing the values with the lowest priority first, and otherwise in
+  the order they were added. Items are put as (priority, value) tuples, and
+  gotten as just the value. This is much like python 2.6's PriorityQueue.
+  """
+  
+  def _init(self, maxsize):
+    self.queue = []
+    self.counter = itertools.count()
+  
+  def _qsize(self, len = len):
+    return len(self.queue)
+  
+  def _put(self, item):
+    heapq.heappush(self.queue, (item[0], self.counter.next(), item[1]))
+  
+  def _get(self):
+    return heapq.heappop(self.queue)[2]
+
+def _getResolvedAddress(address):
+  """
+  Provides the ip address an ADDRMAP event is for. Tor reports reverse lookups
+  either by the address itself or in the forms 'REVERSE[1.2.3.4]' and
+  '4.3.2.1.in-addr.arpa'.
+  
+  Arguments:
+    address - address from the event
+  """
+  
+  if address.startswith("REVERSE[") and address.endswith("]"):
+    address = address[8:-1]
+  
+  if address.endswith(".in-addr.arpa"):
+    address = ".".join(reversed(address[:-13].split(".")))
+  
+  return address
+
+class _TorClient:
+  """
+  Lookup client that has tor resolve addresses, so they aren't revealed to the
+  system's nameservers. This provides the same interface as the dnsClient's
+  PtrClient. Addresses are sent in rate limited batches of RESOLVE requests,
+  with the replies arriving as ADDRMAP events (passed to us via
+  handleAddrMap).
+  """
   
+  def __init__(self):
+    self._pending = []        # addresses waiting to be sent to tor
+    self._outstanding = {}    # address => time that we asked tor to resolve it
+    self._results = []        # (ip address, hostname or exception, ttl) tuples for finished lookups
+    self._lastRequest = 0     # time of our last RESOLVE request
+    self._cond = threading.Condition() # governs the above, notified when replies arrive
+  
+  def query(self, ipAddr):
+    """
+    Queues an address to be resolved.
+    
+    Arguments:
+      ipAddr - ip address to be resolved
+    """
+    
+    self._cond.acquire()
+    
+    # addresses are included in a controller command, so they're checked to be
+    # well formed first
+    try:
+      dnsClient.getReverseName(ipAddr)
+      self._pending.append(ipAddr)
+    except ValueError, exc:
+      self._results.append((ipAddr, exc, None))
+    
+    self._cond.release()
+  
+  def getOutstandingCount(self):
+    """
+    Provides the number of lookups that haven't yet finished.
+    """
+    
+    return len(self._pending) + len(self._outstanding)
+  
+  def getPendingCount(self):
+    """
+    Provides the number of lookups that are waiting to be sent to tor.
+    """
+    
+    return len(self._pending)
+  
+  def process(self, waitTime = 0):
+    """
+    Sends the next batch of pending addresses if we're able, times out lookups
+    tor hasn't answered, and waits for replies. This provides a list of
+    (ip address, result, ttl) tuples for the lookups that finished, where the
+    ttl is how long tor caches the result (None if unknown) and the result is
+    a hostname or...
+      
+      ValueError - address is unresolvable
+      IOError - lookup failed due to tor or network issues
+    
+    Arguments:
+      waitTime - maximum seconds to block waiting for replies
+    """
+    
+    self._cond.acquire()
+    currentTime, batch = time.time(), []
+    
+    for ipAddr, requestTime in self._outstanding.items():
+      if currentTime - requestTime > TOR_LOOKUP_TIMEOUT:
+        del self._outstanding[ipAddr]
+        self._results.append((ipAddr, IOError("lookup timed out"), None))
+    
+    # Takes the next batch if we're under both our request rate and limit on
+    # the lookups tor has in flight. These are marked as outstanding before
+    # being sent so replies can't arrive before we're expecting them.
+    batchSize = min(CONFIG["queries.hostnames.torBatchSize"], CONFIG["queries.hostnames.torMaxPending"] - len(self._outstanding))
+    
+    if self._pending and batchSize > 0 and currentTime - self._lastRequest >= TOR_REQUEST_RATE:
+      batch, self._pending = self._pending[:batchSize], self._pending[batchSize:]
+      self._lastRequest = currentTime
+      for ipAddr in batch: self._outstanding[ipAddr] = currentTime
+    
+    self._cond.release()
+    
+    if batch:
+      try:
+        torTools.getConn().reverseResolve(batch)
+      except IOError, exc:
+        self._cond.acquire()
+        
+        for ipAddr in batch:
+          if ipAddr in self._outstanding:
+            del self._outstanding[ipAddr]
+            self._results.append((ipAddr, exc, None))
+        
+        self._cond.release()
+    
+    self._cond.acquire()
+    if waitTime > 0 and not self._results: self._cond.wait(waitTime)
+    results, self._results = self._results, []
+    self._cond.release()
+    
+    return results
+  
+  def handleAddrMap(self, address, destination, error = None, ttl = None):
+    """
+    Records the result of a lookup from one of tor's ADDRMAP events. Events
+    for addresses we didn't ask about are ignored.
+    
+    Arguments:
+      address     - address that was resolved
+      destination - hostname it resolved to, None if the lookup failed
+      error       - reason the lookup failed, if provided
+      ttl         - seconds until tor's mapping expires, if provided
+    """
+    
+    ipAddr = _getResolvedAddress(address)
+    self._cond.acquire()
+    
+    if ipAddr in self._outstanding:
+      del self._outstanding[ipAddr]
+      
+      if destination: result = destination
+      else: result = ValueError("address is unresolvable: %s" % (error or "tor was unable to resolve it"))
+      
+      self._results.append((ipAddr, result, ttl))
+      self._cond.notifyAll()
+    
+    self._cond.release()
+  
+  def close(self):
+    """
+    Abandons any lookups that haven't yet finished.
+    """
+    
+    self._cond.acquire()
+    self._pending = []
+    self._outstanding = {}
+    self._cond.release()
@@ -0,0 +1,313 @@
+"""
+Compact index of the relays in tor's consensus. Rather than a dictionary (or
+several) per relay this keeps each attribute in a column of packed values,
+with secondary indexes for looking relays up by their fingerprint, address, or
+nickname. For instance...
+  
+  index = RelayIndex(controller.get_network_statuses())
+  row = index.getRow("9695DFC35FFEB861329B9F1AB04C46397020CE31")
+  
+  if row != None:
+    print "%s at %s:%i" % (index.getNickname(row), index.getAddress(row), index.getOrPort(row))
+"""
+
+import array
+import socket
+import struct
+import binascii
+
+FINGERPRINT_SIZE = 20 # bytes in a decoded fingerprint
+
+class RelayIndex:
+  """
+  Columnar storage for router status entries. Rows are numbered in the order
+  relays are added, and each has...
+    fingerprint - twenty byte digest (FINGERPRINT_SIZE bytes of _fingerprints)
+    address     - ipv4 address packed into an unsigned int
+    orport      - unsigned short
+    flags       - bitmask of the relay's flags (bits are assigned as flags are
+                  first seen, see _flagBits)
+    nickname    - offset and length within the _nicknames character array
+  """
+  
+  def __init__(self, entries = None):
+    """
+    Creates an index of the given router status entries.
+    
+    Arguments:
+      entries - iterable of stem RouterStatusEntry instances
+    """
+    
+    self._fingerprints = array.array("c")
+    self._addresses = array.array("I")
+    self._orPorts = array.array("H")
+    self._flags = array.array("I")
+    self._nicknames = array.array("c")
+    self._nicknameOffsets = array.array("I")
+    self._nicknameLengths = array.array("B")
+    
+    self._flagBits = {} # flag => bit used for it in the bitmask
+    
+    # secondary indexes
+    self._fingerprintRows = {} # decoded fingerprint => row
+    self._addressRows = {}     # packed address => [rows...]
+    self._nicknameRows = {}    # nickname => row of the relay that's preferred for it
+    
+    for entry in entries or []: self.add(entry)
+  
+  def __len__(self):
+    return len(self._orPorts)
+  
+  def copy(self):
+    """
+    Provides a copy of this index that can be modified without affecting it.
+    """
+    
+    result = RelayIndex()
+    
+    for attr in ("_fingerprints", "_addresses", "_orPorts", "_flags", "_nicknames", "_nicknameOffsets", "_nicknameLengths"):
+      setattr(result, attr, getattr(self, attr)[:])
+    
+    result._flagBits = dict(self._flagBits)
+    result._fingerprintRows = dict(self._fingerprintRows)
+    result._nicknameRows = dict(self._nicknameRows)
+    
+    for address, rows in self._addressRows.iteritems():
+      result._addressRows[address] = list(rows)
+    
+    return result
+  
+  def add(self, entry):
+    """
+    Includes a router status entry in the index. If we already have the relay
+    then its row is updated instead.
+    
+    Arguments:
+      entry - stem RouterStatusEntry to be added
+    """
+    
+    try:
+      fingerprint = binascii.unhexlify(entry.fingerprint)
+      address = _packAddress(entry.address)
+    except (TypeError, ValueError, socket.error):
+      return # malformed entry
+    
+    flags = 0
+    for flag in entry.flags:
+      if not flag in self._flagBits: self._flagBits[flag] = 1 << len(self._flagBits)
+      flags |= self._flagBits[flag]
+    
+    nickname = entry.nickname[:255]
+    row = self._fingerprintRows.get(fingerprint)
+    
+    if row == None:
+      row = len(self._orPorts)
+      self._fingerprints.fromstring(fingerprint)
+      self._addresses.append(address)
+      self._orPorts.append(entry.or_port)
+      self._flags.append(flags)
+      self._nicknameOffsets.append(len(self._nicknames))
+      self._nicknameLengths.append(len(nickname))
+      self._nicknames.fromstring(nickname)
+      self._fingerprintRows[fingerprint] = row
+    else:
+      oldRows = self._addressRows[self._addresses[row]]
+      oldRows.remove(row)
+      if not oldRows: del self._addressRows[self._addresses[row]]
+      
+      if self._nicknameRows.get(self.getNickname(row)) == row:
+        del self._nicknameRows[self.getNickname(row)]
+      
+      self._addresses[row] = address
+      self._orPorts[row] = entry.or_port
+      self._flags[row] = flags
+      
+      if nickname != self.getNickname(row):
+        self._nicknameOffsets[row] = len(self._nicknames)
+        self._nicknameLengths[row] = len(nickname)
+        self._nicknames.fromstring(nickname)
+    
+    self._addressRows.setdefault(address, []).append(row)
+    
+    # Nicknames aren't unique. Like tor, this prefers the relay with the Named
+    # flag and otherwise uses the first that was seen.
+    currentRow = self._nicknameRows.get(nickname)
+    if currentRow == None or (self.hasFlag(row, "Named") and not self.hasFlag(currentRow, "Named")):
+      self._nicknameRows[nickname] = row
+  
+  def getRow(self, fingerprint):
+    """
+    Provides the row for the relay with the given fingerprint, or None if we
+    don't have it.
+    
+    Arguments:
+      fingerprint - hex encoded fingerprint of the relay
+    """
+    
+    try:
+      return self._fingerprintRows.get(binascii.unhexlify(fingerprint))
+    except TypeError:
+      return None # malformed fingerprint
+  
+  def getRowsByAddress(self, address):
+    """
+    Provides the rows for relays with the given ip address.
+    
+    Arguments:
+      address - ipv4 address of the relays
+    """
+    
+    try:
+      return list(self._addressRows.get(_packAddress(address), []))
+    except (ValueError, socket.error):
+      return []
+  
+  def getRowByNickname(self, nickname):
+    """
+    Provides the row of the relay with the given nickname, or None if we don't
+    have one.
+    
+    Arguments:
+      nickname - nickname of the relay
+    """
+    
+    return self._nicknameRows.get(nickname)
+  
+  def getFingerprint(self, row):
+    """
+    Provides the upper case hex encoded fingerprint of a relay.
+    
+    Arguments:
+      row - row of the relay
+    """
+    
+    start = row * FINGERPRINT_SIZE
+    return binascii.hexlify(self._fingerprints[start:start + FINGERPRINT_SIZE].tostring()).upper()
+  
+  def getNickname(self, row):
+    """
+    Provides the nickname of a relay.
+    
+    Arguments:
+      row - row of the relay
+    """
+    
+    start = self._nicknameOffsets[row]
+    return self._nicknames[start:start + self._nicknameLengths[row]].tostring()
+  
+  def getAddress(self, row):
+    """
+    Provides the ip address of a relay.
+    
+    Arguments:
+      row - row of the relay
+    """
+    
+    return socket.inet_ntoa(struct.pack("!L", self._addresses[row]))
+  
+  def getOrPort(self, row):
+    """
+    Provides the orport of a relay.
+    
+    Arguments:
+      row - row of the relay
+    """
+    
+    return self._orPorts[row]
+  
+  def hasFlag(self, row, flag):
+    """
+    True if the relay has the given flag, false otherwise.
+    
+    Arguments:
+      row  - row of the relay
+      flag - flag to be checked for
+    """
+    
+    return bool(self._flags[row] & self._flagBits.get(flag, 0))
+  
+  def getFlags(self, row):
+    """
+    Provides the flags of a relay.
+    
+    Arguments:
+      row - row of the relay
+    """
+    
+    return [flag for flag, bit in self._flagBits.items() if self._flags[row] & bit]
+  
+  def getAddressMappings(self):
+    """
+    Provides a mapping of...
+    Relay IP Address -> [(ORPort, Fingerprint)...]
+    
+    for all of the relays.
+    """
+    
+    results = {}
+    
+    for packedAddress, rows in self._addressRows.items():
+      address = socket.inet_ntoa(struct.pack("!L", packedAddress))
+      results[address] = [(self._orPorts[row], self.getFingerprint(row)) for row in rows]
+    
+    return results
+  
+  def getChanges(self, newIndex):
+    """
+    Compares this with the index of a newer consensus, providing a tuple of
+    the form...
+    (added fingerprints, removed fingerprints, changed fingerprints)
+    
+    where changed relays are those with a different address, orport, nickname,
+    or flags.
+    
+    Arguments:
+      newIndex - RelayIndex to compare against
+    """
+    
+    added, removed, changed = set(), set(), set()
+    
+    # Translates our flag bits into the new index' so bitmasks can be compared.
+    # Flags that no relay in the new index has get bits beyond any it uses.
+    bitTranslation, unusedBit = {}, 1 << len(newIndex._flagBits)
+    
+    for flag, bit in self._flagBits.items():
+      if flag in newIndex._flagBits:
+        bitTranslation[bit] = newIndex._flagBits[flag]
+      else:
+        bitTranslation[bit] = unusedBit
+        unusedBit <<= 1
+    
+    for fingerprint, row in self._fingerprintRows.iteritems():
+      newRow = newIndex._fingerprintRows.get(fingerprint)
+      
+      if newRow == None:
+        removed.add(fingerprint)
+        continue
+      
+      flags = 0
+      for bit, newBit in bitTranslation.iteritems():
+        if self._flags[row] & bit: flags |= newBit
+      
+      if self._addresses[row] != newIndex._addresses[newRow] or \
+        self._orPorts[row] != newIndex._orPorts[newRow] or \
+        flags != newIndex._flags[newRow] or \
+        self.getNickname(row) != newIndex.getNickname(newRow):
+        changed.add(fingerprint)
+    
+    for fingerprint in newIndex._fingerprintRows:
+      if not fingerprint in self._fingerprintRows: added.add(fingerprint)
+    
+    toHex = lambda fingerprints: set([binascii.hexlify(fp).upper() for fp in fingerprints])
+    return (toHex(added), toHex(removed), toHex(changed))
+
+def _packAddress(address):
+  """
+  Provides an ipv4 address as an unsigned int. This raises a socket.error if
+  the address is malformed.
+  
+  Arguments:
+    address - ipv4 address to be converted
+  """
+  
+  return struct.unpack("!L", socket.inet_aton(address))[0]
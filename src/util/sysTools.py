@@ -4,43 +4,160 @@ Helper functions for working with the underlying system.
 
 import os
 import time
+import resource
 import threading
 
 from stem.util import conf, log, proc, str_tools, system
 
-PROCESS_NAME_CACHE = {} # mapping of pids to their process names
+# Processes we've read from proc, keyed by their (pid, start time) so reused
+# pids aren't mistaken for the process that held them before. Entries are
+# lists of the form [ProcessInfo, last used], and this is trimmed to the
+# PROCESS_CACHE_TRIM_SIZE most recently used when it exceeds PROCESS_CACHE_SIZE.
+PROCESS_CACHE = {}
+PROCESS_CACHE_LOCK = threading.RLock()
+PROCESS_CACHE_SIZE = 2000
+PROCESS_CACHE_TRIM_SIZE = 1500
+PROCESS_CACHE_COUNTER = 0 # incremented each time an entry is used
+
+UNDEFINED = "<Undefined_ >" # default for call() if the failure should raise
 RESOURCE_TRACKERS = {}  # mapping of pids to their resource tracker instances
+RESOURCE_SAMPLER = None # thread that samples the RESOURCE_TRACKERS
+RESOURCE_LOCK = threading.RLock() # governs the creation of trackers and the sampler
+
+# units of the cpu times and memory sizes in proc
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
 
-# Runtimes for system calls, used to estimate cpu usage. Entries are tuples of
-# the form:
-# (time called, runtime)
+# Child cpu time of system calls, used to estimate cpu usage. Entries are
+# tuples of the form:
+# (time called, cpu time)
 RUNTIMES = []
 SAMPLING_PERIOD = 5 # time of the sampling period
 
+# Totals for the system calls made by each caller, as a mapping of its label
+# to a list of the form:
+# [call count, runtime, cpu time, bytes read]
+CALL_STATS = {}
+CALL_LOCK = threading.RLock()
+
 CONFIG = conf.config_dict("arm", {
   "queries.resourceUsage.rate": 5,
+  "queries.resourceUsage.historySize": 360,
 })
 
-# TODO: This was a bit of a hack, and one that won't work now that we lack our
-# call() method to populate RUNTIMES.
+def call(command, default = UNDEFINED, caller = "other"):
+  """
+  Issues a command via stem's system.call, recording its cost under the given
+  caller. This provides the lines of output, and if the call fails then this
+  either provides the default or raises an OSError if one wasn't given.
+  
+  Arguments:
+    command - command to be issued
+    default - response if the call fails
+    caller  - label the cost is attributed to
+  """
+  
+  startTime, startCpuTime = time.time(), getChildCpuTime()
+  results = None
+  
+  try:
+    results = system.call(command)
+    return results
+  except OSError:
+    if default == UNDEFINED: raise
+    return default
+  finally:
+    bytesRead = sum([len(line) + 1 for line in results or []])
+    recordCall(caller, time.time() - startTime, getChildCpuTime() - startCpuTime, bytesRead)
+
+def recordCall(caller, runtime, cpuTime, bytesRead = 0):
+  """
+  Records the cost of a system call. This is for commands that aren't issued
+  via our call() function, such as those with output that's read as it's
+  produced.
+  
+  Arguments:
+    caller    - label the cost is attributed to
+    runtime   - wall clock time the call took
+    cpuTime   - cpu time used by the child process
+    bytesRead - bytes of output from the command
+  """
+  
+  CALL_LOCK.acquire()
+  
+  try:
+    RUNTIMES.append((time.time(), cpuTime))
+    
+    if not caller in CALL_STATS: CALL_STATS[caller] = [0, 0.0, 0.0, 0]
+    callerStats = CALL_STATS[caller]
+    callerStats[0] += 1
+    callerStats[1] += runtime
+    callerStats[2] += cpuTime
+    callerStats[3] += bytesRead
+  finally:
+    CALL_LOCK.release()
+
+def getCallStats():
+  """
+  Provides the totals for the system calls we've made, as a list of tuples of
+  the form (caller, call count, runtime, cpu time, bytes read), most costly
+  first.
+  """
+  
+  CALL_LOCK.acquire()
+  callStats = [tuple([caller] + stats) for caller, stats in CALL_STATS.items()]
+  CALL_LOCK.release()
+  
+  callStats.sort(key = lambda entry: entry[3], reverse = True)
+  return callStats
 
 def getSysCpuUsage():
   """
   Provides an estimate of the cpu usage for system calls made through this
   module, based on a sampling period of five seconds. The os.times() function,
-  unfortunately, doesn't seem to take popen calls into account. This returns a
-  float representing the percentage used.
+  unfortunately, doesn't seem to take popen calls into account until they're
+  reaped. This returns a float representing the percentage used.
   """
   
   currentTime = time.time()
   
+  CALL_LOCK.acquire()
+  
   # removes any runtimes outside of our sampling period
   while RUNTIMES and currentTime - RUNTIMES[0][0] > SAMPLING_PERIOD:
     RUNTIMES.pop(0)
   
   runtimeSum = sum([entry[1] for entry in RUNTIMES])
+  CALL_LOCK.release()
+  
   return runtimeSum / SAMPLING_PERIOD
 
+def getChildCpuTime():
+  """
+  Provides the user and system cpu time used by the child processes that
+  we've waited on. Calls from other threads can be included if they finish
+  at the same time, so this is an estimate.
+  """
+  
+  childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return childUsage.ru_utime + childUsage.ru_stime
+
+def getThreadCpuTime():
+  """
+  Provides the user and system cpu time used by the calling thread, or None
+  if it can't be determined. This is read from proc so it's only available on
+  Linux (3.17 and later). The kernel counts this in clock ticks, so short
+  measurements are only accurate when averaged over several of them.
+  """
+  
+  statContents = _readProcFile("thread-self", "stat")
+  if not statContents: return None
+  
+  statComp = statContents[statContents.rfind(")") + 2:].split()
+  if len(statComp) < 13: return None
+  
+  return (float(statComp[11]) + float(statComp[12])) / CLOCK_TICKS
+
 def getFileErrorMsg(exc):
   """
   Strips off the error number prefix for file related IOError messages. For
@@ -61,37 +178,133 @@ def getFileErrorMsg(exc):
   
   return excStr
 
-def getProcessName(pid, default = None, cacheFailure = True):
+class ProcessInfo:
+  """
+  Identity of a process, as read from proc. Attributes are...
+    pid       - process id (string)
+    startTime - clock ticks after boot when the process started
+    name      - command name
+    uid       - real user id, None if it couldn't be read
+    cmdline   - list with the process' command and arguments, empty for
+                kernel threads and processes that have exited
+  """
+  
+  def __init__(self, pid, startTime, name, uid, cmdline):
+    self.pid = pid
+    self.startTime = startTime
+    self.name = name
+    self.uid = uid
+    self.cmdline = cmdline
+
+def getProcessInfo(pid):
+  """
+  Provides the ProcessInfo for the given process id, or None if it isn't
+  running or proc is unavailable. This reads the process' stat contents to
+  check its start time, then the rest is cached.
+  
+  Arguments:
+    pid - process id for the process being returned
+  """
+  
+  global PROCESS_CACHE_COUNTER
+  
+  if not proc.is_available(): return None
+  
+  pid = str(pid)
+  statContents = _readProcFile(pid, "stat")
+  if not statContents: return None
+  
+  # the command is parenthesized, and can itself contain parentheses
+  statComp = statContents[statContents.rfind(")") + 2:].split()
+  if len(statComp) < 20: return None
+  cacheKey = (pid, statComp[19])
+  
+  PROCESS_CACHE_LOCK.acquire()
+  
+  try:
+    PROCESS_CACHE_COUNTER += 1
+    
+    if cacheKey in PROCESS_CACHE:
+      cacheEntry = PROCESS_CACHE[cacheKey]
+      cacheEntry[1] = PROCESS_CACHE_COUNTER
+      return cacheEntry[0]
+    
+    name = statContents[statContents.find("(") + 1:statContents.rfind(")")]
+    uid, cmdline = None, []
+    
+    for line in (_readProcFile(pid, "status") or "").splitlines():
+      if line.startswith("Uid:") and len(line.split()) >= 2:
+        uid = line.split()[1]
+        break
+    
+    cmdlineContents = _readProcFile(pid, "cmdline")
+    if cmdlineContents: cmdline = cmdlineContents.rstrip("\0").split("\0")
+    
+    processInfo = ProcessInfo(pid, int(statComp[19]), name, uid, cmdline)
+    PROCESS_CACHE[cacheKey] = [processInfo, PROCESS_CACHE_COUNTER]
+    
+    if len(PROCESS_CACHE) > PROCESS_CACHE_SIZE:
+      lastUsed = sorted([entry[1] for entry in PROCESS_CACHE.values()])
+      threshold = lastUsed[-PROCESS_CACHE_TRIM_SIZE]
+      
+      for key, entry in PROCESS_CACHE.items():
+        if entry[1] < threshold: del PROCESS_CACHE[key]
+    
+    return processInfo
+  finally:
+    PROCESS_CACHE_LOCK.release()
+
+def getProcessTable():
+  """
+  Provides a mapping of pids to the ProcessInfo of everything running, from a
+  single scan of proc. This is empty if proc is unavailable.
+  """
+  
+  processTable = {}
+  
+  if proc.is_available():
+    for pid in os.listdir("/proc"):
+      if not pid.isdigit(): continue
+      
+      processInfo = getProcessInfo(pid)
+      if processInfo: processTable[pid] = processInfo
+  
+  return processTable
+
+def findProcesses(name):
+  """
+  Provides the ProcessInfo for all processes with the given command name. This
+  is empty if there aren't any or proc is unavailable.
+  
+  Arguments:
+    name - command name to be matched
+  """
+  
+  return [processInfo for processInfo in getProcessTable().values() if processInfo.name == name]
+
+def getProcessName(pid, default = None):
   """
   Provides the name associated with the given process id. This isn't available
   on all platforms.
   
   Arguments:
-    pid          - process id for the process being returned
-    default      - result if the process name can't be retrieved (raises an
-                   IOError on failure instead if undefined)
-    cacheFailure - if the lookup fails and there's a default then caches the
-                   default value to prevent further lookups
+    pid     - process id for the process being returned
+    default - result if the process name can't be retrieved (raises an
+              IOError on failure instead if undefined)
   """
   
-  if pid in PROCESS_NAME_CACHE:
-    return PROCESS_NAME_CACHE[pid]
-  
   processName, raisedExc = "", None
   
   # fetch it from proc contents if available
-  if proc.is_available():
-    try:
-      processName = proc.get_stats(pid, proc.Stat.COMMAND)[0]
-    except IOError, exc:
-      raisedExc = exc
+  processInfo = getProcessInfo(pid)
+  if processInfo: processName = processInfo.name
   
   # fall back to querying via ps
   if not processName:
     # the ps call formats results as:
     # COMMAND
     # tor
-    psCall = system.call("ps -p %s -o command" % pid)
+    psCall = call("ps -p %s -o command" % pid, None, "process name")
     
     if psCall and len(psCall) >= 2 and not " " in psCall[1]:
       processName, raisedExc = psCall[1].strip(), None
@@ -100,46 +313,120 @@ def getProcessName(pid, default = None, cacheFailure = True):
   
   if raisedExc:
     if default == None: raise raisedExc
-    else:
-      if cacheFailure:
-        PROCESS_NAME_CACHE[pid] = default
-      
-      return default
+    else: return default
   else:
-    processName = os.path.basename(processName)
-    PROCESS_NAME_CACHE[pid] = processName
-    return processName
+    return os.path.basename(processName)
+
+def _readProcFile(pid, filename):
+  """
+  Provides the contents of a process' proc file, or None if it can't be read
+  (for instance, if the process has exited).
+  
+  Arguments:
+    pid      - process id for the process being read
+    filename - file in the process' proc directory
+  """
+  
+  try:
+    procFile = open("/proc/%s/%s" % (pid, filename))
+    contents = procFile.read()
+    procFile.close()
+    return contents
+  except IOError:
+    return None
 
 def getResourceTracker(pid, noSpawn = False):
   """
-  Provides a running singleton ResourceTracker instance for the given pid.
+  Provides the singleton ResourceTracker instance for the given pid, starting
+  the RESOURCE_SAMPLER if it isn't already running.
   
   Arguments:
     pid     - pid of the process being tracked
     noSpawn - returns None rather than generating a singleton instance if True
   """
   
-  if pid in RESOURCE_TRACKERS:
-    tracker = RESOURCE_TRACKERS[pid]
-    if tracker.isAlive(): return tracker
-    else: del RESOURCE_TRACKERS[pid]
+  global RESOURCE_SAMPLER
+  
+  RESOURCE_LOCK.acquire()
+  
+  try:
+    tracker = RESOURCE_TRACKERS.get(pid)
+    if noSpawn and (not tracker or not RESOURCE_SAMPLER or not RESOURCE_SAMPLER.isAlive()): return None
+    
+    if not tracker:
+      tracker = ResourceTracker(pid, CONFIG["queries.resourceUsage.rate"])
+      RESOURCE_TRACKERS[pid] = tracker
+    
+    if not RESOURCE_SAMPLER or not RESOURCE_SAMPLER.isAlive():
+      RESOURCE_SAMPLER = ResourceSampler()
+      RESOURCE_SAMPLER.start()
+    else: RESOURCE_SAMPLER.wake()
+    
+    return tracker
+  finally:
+    RESOURCE_LOCK.release()
+
+class RingBuffer:
+  """
+  Fixed size buffer that retains the most recent entries added to it.
+  """
+  
+  def __init__(self, size):
+    """
+    Creates an empty buffer.
+    
+    Arguments:
+      size - maximum number of entries that are retained
+    """
+    
+    self.size = max(1, size)
+    self._entries = []
+    self._index = 0 # position the next entry is written to once we're full
+  
+  def append(self, entry):
+    """
+    Adds an entry, replacing the oldest if we're full.
+    
+    Arguments:
+      entry - value to be added
+    """
+    
+    if len(self._entries) < self.size:
+      self._entries.append(entry)
+    else:
+      self._entries[self._index] = entry
+      self._index = (self._index + 1) % self.size
+  
+  def getLatest(self):
+    """
+    Provides the most recently added entry, or None if we're empty.
+    """
+    
+    if not self._entries: return None
+    return self._entries[self._index - 1]
   
-  if noSpawn: return None
-  tracker = ResourceTracker(pid, CONFIG["queries.resourceUsage.rate"])
-  RESOURCE_TRACKERS[pid] = tracker
-  tracker.start()
-  return tracker
+  def getContents(self):
+    """
+    Provides a list with our entries, oldest first.
+    """
+    
+    return self._entries[self._index:] + self._entries[:self._index]
+  
+  def __len__(self):
+    return len(self._entries)
 
-class ResourceTracker(threading.Thread):
+class ResourceTracker:
   """
-  Periodically fetches the resource usage (cpu and memory usage) for a given
-  process.
+  Resource usage (cpu and memory usage) of a given process. This is
+  periodically sampled by the RESOURCE_SAMPLER. When proc is available then
+  this also samples the cpu usage of each thread, io throughput, and context
+  switches, retaining a history of these in a RingBuffer.
   """
   
   def __init__(self, processPid, resolveRate):
     """
-    Initializes a new resolver daemon. When no longer needed it's suggested
-    that this is stopped.
+    Initializes a new tracker. This is sampled once it's in the
+    RESOURCE_TRACKERS.
     
     Arguments:
       processPid  - pid of the process being tracked
@@ -147,9 +434,6 @@ class ResourceTracker(threading.Thread):
                     disabled if zero
     """
     
-    threading.Thread.__init__(self)
-    self.setDaemon(True)
-    
     self.processPid = processPid
     self.resolveRate = resolveRate
     
@@ -161,13 +445,25 @@ class ResourceTracker(threading.Thread):
     # resolves usage via proc results if true, ps otherwise
     self._useProc = proc.is_available()
     
+    # file descriptors for our process' stat and statm proc contents, kept
+    # open between samplings
+    self._statFd = None
+    self._statmFd = None
+    self._statusFd = None
+    self._ioFd = None
+    self._isIoReadable = True # false if we lack permission to read its io stats
+    
     # used to get the deltas when querying cpu time
     self._lastCpuTotal = 0
     
-    self.lastLookup = -1
-    self._halt = False      # terminates thread if true
+    # Extended usage samplings, as (sampler clock time, usage) tuples, along
+    # with the counters from the last reading (used for their deltas).
+    self._history = RingBuffer(CONFIG["queries.resourceUsage.historySize"])
+    self._lastExtendedStats = None
+    
+    self.lastLookup = -1    # sampler clock time when we were last sampled
+    self.nextLookup = 0     # sampler clock time when we're next due
     self._valLock = threading.RLock()
-    self._cond = threading.Condition()  # used for pausing the thread
     
     # number of successful calls we've made
     self._runCount = 0
@@ -187,6 +483,39 @@ class ResourceTracker(threading.Thread):
     
     return results
   
+  def getExtendedUsage(self):
+    """
+    Provides the last cached extended resource usage, or None if it's
+    unavailable. This is a dictionary with...
+      threads        - mapping of thread ids to (name, cpu usage) tuples
+      mainThreadCpu  - cpu usage of the process' main thread
+      otherThreadCpu - cpu usage of all its other threads
+      ioRead         - bytes per second read from storage (None if unknown)
+      ioWrite        - bytes per second written to storage (None if unknown)
+      ctxVoluntary   - voluntary context switches per second
+      ctxInvoluntary - involuntary context switches per second
+    """
+    
+    self._valLock.acquire()
+    latestEntry = self._history.getLatest()
+    self._valLock.release()
+    
+    if latestEntry: return latestEntry[1]
+    else: return None
+  
+  def getHistory(self):
+    """
+    Provides the extended resource usage we've retained, oldest first, as a
+    list of (sampling time, usage) tuples. Sampling times are in seconds since
+    boot when proc is available.
+    """
+    
+    self._valLock.acquire()
+    history = self._history.getContents()
+    self._valLock.release()
+    
+    return history
+  
   def getRunCount(self):
     """
     Provides the number of times we've successfully fetched the resource
@@ -203,116 +532,276 @@ class ResourceTracker(threading.Thread):
     
     return self._failureCount != 0
   
-  def run(self):
-    while not self._halt:
-      timeSinceReset = time.time() - self.lastLookup
+  def isUsingProc(self):
+    """
+    True if we're sampled from proc, False if we're sampled with ps.
+    """
+    
+    return self._useProc
+  
+  def readProcStats(self):
+    """
+    Reads our process' usage from proc, providing a tuple of the form...
+    (total cpu time, start time, rss bytes)
+    
+    Times are in seconds since boot. This raises an IOError if the files can't
+    be read.
+    """
+    
+    try:
+      if self._statFd == None:
+        self._statFd = os.open("/proc/%s/stat" % self.processPid, os.O_RDONLY)
+        self._statmFd = os.open("/proc/%s/statm" % self.processPid, os.O_RDONLY)
       
-      if self.resolveRate == 0:
-        self._cond.acquire()
-        if not self._halt: self._cond.wait(0.2)
-        self._cond.release()
-        
-        continue
-      elif timeSinceReset < self.resolveRate:
-        sleepTime = max(0.2, self.resolveRate - timeSinceReset)
+      statContents = _readFd(self._statFd)
+      statmContents = _readFd(self._statmFd)
+    except OSError, exc:
+      self.closeFiles()
+      raise IOError(exc)
+    
+    # stat fields after the command (which could include spaces), starting with
+    # the process state
+    statComp = statContents[statContents.rfind(")") + 2:].split()
+    statmComp = statmContents.split()
+    
+    if len(statComp) < 20 or len(statmComp) < 2:
+      self.closeFiles()
+      raise IOError("unexpected proc contents for pid %s" % self.processPid)
+    
+    totalCpuTime = (float(statComp[11]) + float(statComp[12])) / CLOCK_TICKS
+    startTime = float(statComp[19]) / CLOCK_TICKS
+    return (totalCpuTime, startTime, int(statmComp[1]) * PAGE_SIZE)
+  
+  def readExtendedStats(self):
+    """
+    Reads counters for our process' threads, io, and context switches from
+    proc. This provides a dictionary with...
+      threads        - mapping of thread ids to (name, total cpu time) tuples
+      ioRead         - total bytes read from storage (None if unknown)
+      ioWrite        - total bytes written to storage (None if unknown)
+      ctxVoluntary   - total voluntary context switches
+      ctxInvoluntary - total involuntary context switches
+    
+    This raises an IOError if the status or thread contents can't be read.
+    """
+    
+    stats = {"threads": {}, "ioRead": None, "ioWrite": None}
+    
+    try:
+      taskDir = "/proc/%s/task" % self.processPid
+      
+      for threadId in os.listdir(taskDir):
+        # threads can exit while we're reading them, so this skips those we
+        # can't read
+        try:
+          threadFile = open("%s/%s/stat" % (taskDir, threadId))
+          threadContents = threadFile.read()
+          threadFile.close()
+        except IOError: continue
         
-        self._cond.acquire()
-        if not self._halt: self._cond.wait(sleepTime)
-        self._cond.release()
+        threadName = threadContents[threadContents.find("(") + 1:threadContents.rfind(")")]
+        threadComp = threadContents[threadContents.rfind(")") + 2:].split()
         
-        continue # done waiting, try again
+        if len(threadComp) >= 13:
+          threadCpuTime = (float(threadComp[11]) + float(threadComp[12])) / CLOCK_TICKS
+          stats["threads"][threadId] = (threadName, threadCpuTime)
       
-      newValues = {}
+      if self._statusFd == None:
+        self._statusFd = os.open("/proc/%s/status" % self.processPid, os.O_RDONLY)
+      
+      for line in _readFd(self._statusFd).splitlines():
+        if line.startswith("voluntary_ctxt_switches:"):
+          stats["ctxVoluntary"] = int(line.split()[1])
+        elif line.startswith("nonvoluntary_ctxt_switches:"):
+          stats["ctxInvoluntary"] = int(line.split()[1])
+    except (OSError, ValueError, IndexError), exc:
+      raise IOError(exc)
+    
+    if not "ctxVoluntary" in stats or not "ctxInvoluntary" in stats:
+      raise IOError("context switches are missing from /proc/%s/status" % self.processPid)
+    
+    # io stats are only readable by the process' owner (or root)
+    if self._isIoReadable:
       try:
-        if self._useProc:
-          utime, stime, startTime = proc.get_stats(self.processPid, proc.Stat.CPU_UTIME, proc.Stat.CPU_STIME, proc.Stat.START_TIME)
-          totalCpuTime = float(utime) + float(stime)
-          cpuDelta = totalCpuTime - self._lastCpuTotal
-          newValues["cpuSampling"] = cpuDelta / timeSinceReset
-          newValues["cpuAvg"] = totalCpuTime / (time.time() - float(startTime))
-          newValues["_lastCpuTotal"] = totalCpuTime
-          
-          memUsage = int(proc.get_memory_usage(self.processPid)[0])
-          totalMemory = proc.get_physical_memory()
-          newValues["memUsage"] = memUsage
-          newValues["memUsagePercentage"] = float(memUsage) / totalMemory
-        else:
-          # the ps call formats results as:
-          # 
-          #     TIME     ELAPSED   RSS %MEM
-          # 3-08:06:32 21-00:00:12 121844 23.5
-          # 
-          # or if Tor has only recently been started:
-          # 
-          #     TIME      ELAPSED    RSS %MEM
-          #  0:04.40        37:57  18772  0.9
-          
-          psCall = system.call("ps -p %s -o cputime,etime,rss,%%mem" % self.processPid)
-          
-          isSuccessful = False
-          if psCall and len(psCall) >= 2:
-            stats = psCall[1].strip().split()
-            
-            if len(stats) == 4:
-              try:
-                totalCpuTime = str_tools.parse_short_time_label(stats[0])
-                uptime = str_tools.parse_short_time_label(stats[1])
-                cpuDelta = totalCpuTime - self._lastCpuTotal
-                newValues["cpuSampling"] = cpuDelta / timeSinceReset
-                newValues["cpuAvg"] = totalCpuTime / uptime
-                newValues["_lastCpuTotal"] = totalCpuTime
-                
-                newValues["memUsage"] = int(stats[2]) * 1024 # ps size is in kb
-                newValues["memUsagePercentage"] = float(stats[3]) / 100.0
-                isSuccessful = True
-              except ValueError, exc: pass
-          
-          if not isSuccessful:
-            raise IOError("unrecognized output from ps: %s" % psCall)
-      except IOError, exc:
-        newValues = {}
-        self._failureCount += 1
+        if self._ioFd == None:
+          self._ioFd = os.open("/proc/%s/io" % self.processPid, os.O_RDONLY)
         
-        if self._useProc:
-          if self._failureCount >= 3:
-            # We've failed three times resolving via proc. Warn, and fall back
-            # to ps resolutions.
-            log.info("Failed three attempts to get process resource usage from proc, falling back to ps (%s)" % exc)
-            
-            self._useProc = False
-            self._failureCount = 1 # prevents lastQueryFailed() from thinking that we succeeded
-          else:
-            # wait a bit and try again
-            log.debug("Unable to query process resource usage from proc (%s)" % exc)
-            self._cond.acquire()
-            if not self._halt: self._cond.wait(0.5)
-            self._cond.release()
-        else:
-          # exponential backoff on making failed ps calls
-          sleepTime = 0.01 * (2 ** self._failureCount) + self._failureCount
-          log.debug("Unable to query process resource usage from ps, waiting %0.2f seconds (%s)" % (sleepTime, exc))
-          self._cond.acquire()
-          if not self._halt: self._cond.wait(sleepTime)
-          self._cond.release()
+        for line in _readFd(self._ioFd).splitlines():
+          if line.startswith("read_bytes:"): stats["ioRead"] = int(line.split()[1])
+          elif line.startswith("write_bytes:"): stats["ioWrite"] = int(line.split()[1])
+      except (OSError, ValueError, IndexError), exc:
+        log.info("Unable to read io usage of process %s (%s)" % (self.processPid, exc))
+        self._isIoReadable = False
+    
+    return stats
+  
+  def updateExtended(self, stats, sampleTime):
+    """
+    Adds a sampling of the extended usage to our history, based on the change
+    in counters since the last reading.
+    
+    Arguments:
+      stats      - counters, as provided by readExtendedStats()
+      sampleTime - sampler clock time when the sampling was made
+    """
+    
+    lastReading = self._lastExtendedStats
+    self._lastExtendedStats = (sampleTime, stats)
+    
+    # rates need a prior reading
+    if not lastReading or sampleTime <= lastReading[0]: return
+    
+    lastTime, lastStats = lastReading
+    elapsed = sampleTime - lastTime
+    usage = {"threads": {}, "mainThreadCpu": 0.0, "otherThreadCpu": 0.0}
+    
+    for threadId, (threadName, threadCpuTime) in stats["threads"].items():
+      # new threads are counted from their start
+      lastCpuTime = lastStats["threads"].get(threadId, (None, 0.0))[1]
+      threadCpu = max(0.0, threadCpuTime - lastCpuTime) / elapsed
+      usage["threads"][threadId] = (threadName, threadCpu)
       
-      # sets the new values
-      if newValues:
-        # If this is the first run then the cpuSampling stat is meaningless
-        # (there isn't a previous tick to sample from so it's zero at this
-        # point). Setting it to the average, which is a fairer estimate.
-        if self.lastLookup == -1:
-          newValues["cpuSampling"] = newValues["cpuAvg"]
+      if threadId == str(self.processPid): usage["mainThreadCpu"] = threadCpu
+      else: usage["otherThreadCpu"] += threadCpu
+    
+    for key in ("ioRead", "ioWrite", "ctxVoluntary", "ctxInvoluntary"):
+      if stats[key] == None or lastStats[key] == None: usage[key] = None
+      else: usage[key] = max(0, stats[key] - lastStats[key]) / elapsed
+    
+    self._valLock.acquire()
+    self._history.append((sampleTime, usage))
+    self._valLock.release()
+  
+  def closeFiles(self):
+    """
+    Closes our proc file descriptors, if they're open.
+    """
+    
+    for fd in (self._statFd, self._statmFd, self._statusFd, self._ioFd):
+      if fd != None:
+        try: os.close(fd)
+        except OSError: pass
+    
+    self._statFd, self._statmFd = None, None
+    self._statusFd, self._ioFd = None, None
+  
+  def update(self, newValues, sampleTime):
+    """
+    Sets the results of a successful sampling.
+    
+    Arguments:
+      newValues  - mapping of our attributes to their new values
+      sampleTime - sampler clock time when the sampling was made
+    """
+    
+    # If this is the first run then the cpuSampling stat is meaningless
+    # (there isn't a previous tick to sample from so it's zero at this
+    # point). Setting it to the average, which is a fairer estimate.
+    if self.lastLookup == -1:
+      newValues["cpuSampling"] = newValues["cpuAvg"]
+    
+    self._valLock.acquire()
+    self.cpuSampling = newValues["cpuSampling"]
+    self.cpuAvg = newValues["cpuAvg"]
+    self.memUsage = newValues["memUsage"]
+    self.memUsagePercentage = newValues["memUsagePercentage"]
+    self._lastCpuTotal = newValues["_lastCpuTotal"]
+    self.lastLookup = sampleTime
+    self.nextLookup = sampleTime + self.resolveRate
+    self._runCount += 1
+    self._failureCount = 0
+    self._valLock.release()
+  
+  def failed(self, exc, sampleTime):
+    """
+    Notes a failed sampling, falling back from proc to ps if it keeps failing
+    and otherwise retrying after a delay.
+    
+    Arguments:
+      exc        - exception raised by the sampling
+      sampleTime - sampler clock time when the sampling was made
+    """
+    
+    self._failureCount += 1
+    
+    if self._useProc:
+      if self._failureCount >= 3:
+        # We've failed three times resolving via proc. Warn, and fall back
+        # to ps resolutions.
+        log.info("Failed three attempts to get process resource usage from proc, falling back to ps (%s)" % exc)
         
-        self._valLock.acquire()
-        self.cpuSampling = newValues["cpuSampling"]
-        self.cpuAvg = newValues["cpuAvg"]
-        self.memUsage = newValues["memUsage"]
-        self.memUsagePercentage = newValues["memUsagePercentage"]
-        self._lastCpuTotal = newValues["_lastCpuTotal"]
-        self.lastLookup = time.time()
-        self._runCount += 1
-        self._failureCount = 0
-        self._valLock.release()
+        self.closeFiles()
+        self._useProc = False
+        self._failureCount = 1 # prevents lastQueryFailed() from thinking that we succeeded
+        self.nextLookup = sampleTime
+      else:
+        # wait a bit and try again
+        log.debug("Unable to query process resource usage from proc (%s)" % exc)
+        self.nextLookup = sampleTime + 0.5
+    else:
+      # exponential backoff on making failed ps calls
+      sleepTime = 0.01 * (2 ** self._failureCount) + self._failureCount
+      log.debug("Unable to query process resource usage from ps, waiting %0.2f seconds (%s)" % (sleepTime, exc))
+      self.nextLookup = sampleTime + sleepTime
+
+class ResourceSampler(threading.Thread):
+  """
+  Periodically fetches the resource usage for all of the RESOURCE_TRACKERS.
+  This is a single thread regardless of how many processes we're tracking,
+  and those that are due at the same time are sampled together (sharing one
+  clock reading, and with proc files that are kept open or a single ps call).
+  """
+  
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    
+    self._halt = False      # terminates thread if true
+    self._cond = threading.Condition()  # used for pausing the thread
+    self._totalMemory = None # physical memory in bytes, read when first needed
+    
+    # Seconds since boot from proc, which unlike the system time can't jump
+    # around. The file is kept open between readings.
+    self._uptimeFd = None
+  
+  def run(self):
+    while not self._halt:
+      currentTime = self._getClock()
+      trackers = RESOURCE_TRACKERS.values()
+      dueTrackers = [tracker for tracker in trackers if tracker.resolveRate and tracker.nextLookup <= currentTime]
+      
+      procTrackers = [tracker for tracker in dueTrackers if tracker.isUsingProc()]
+      psTrackers = [tracker for tracker in dueTrackers if not tracker.isUsingProc()]
+      
+      for tracker in procTrackers: self._sampleProc(tracker, currentTime)
+      if psTrackers: self._samplePs(psTrackers, currentTime)
+      
+      # waits until the next tracker is due (or we're woken because a new one
+      # is added)
+      nextLookups = [tracker.nextLookup for tracker in trackers if tracker.resolveRate]
+      
+      self._cond.acquire()
+      
+      if not self._halt:
+        if nextLookups: self._cond.wait(max(0.2, min(nextLookups) - self._getClock()))
+        else: self._cond.wait()
+      
+      self._cond.release()
+    
+    for tracker in RESOURCE_TRACKERS.values(): tracker.closeFiles()
+    
+    if self._uptimeFd != None:
+      os.close(self._uptimeFd)
+      self._uptimeFd = None
+  
+  def wake(self):
+    """
+    Prompts the sampler to check for trackers that are due.
+    """
+    
+    self._cond.acquire()
+    self._cond.notifyAll()
+    self._cond.release()
   
   def stop(self):
     """
@@ -323,4 +812,114 @@ class ResourceTracker(threading.Thread):
     self._halt = True
     self._cond.notifyAll()
     self._cond.release()
+  
+  def _getClock(self):
+    """
+    Provides the seconds since boot if proc is available, and the system time
+    otherwise.
+    """
+    
+    if proc.is_available():
+      try:
+        if self._uptimeFd == None:
+          self._uptimeFd = os.open("/proc/uptime", os.O_RDONLY)
+        
+        return float(_readFd(self._uptimeFd).split()[0])
+      except (OSError, ValueError, IndexError):
+        pass
+    
+    return time.time()
+  
+  def _sampleProc(self, tracker, currentTime):
+    """
+    Samples a tracker's usage from proc.
+    
+    Arguments:
+      tracker     - tracker to be sampled
+      currentTime - clock time of this sampling
+    """
+    
+    try:
+      totalCpuTime, startTime, memUsage = tracker.readProcStats()
+      
+      if self._totalMemory == None:
+        self._totalMemory = proc.get_physical_memory()
+      
+      timeSinceReset = currentTime - tracker.lastLookup
+      
+      tracker.update({
+        "cpuSampling": (totalCpuTime - tracker._lastCpuTotal) / timeSinceReset,
+        "cpuAvg": totalCpuTime / max(1, currentTime - startTime),
+        "_lastCpuTotal": totalCpuTime,
+        "memUsage": memUsage,
+        "memUsagePercentage": float(memUsage) / self._totalMemory,
+      }, currentTime)
+    except IOError, exc:
+      tracker.failed(exc, currentTime)
+      return
+    
+    # extended usage is supplementary, so failures are only logged
+    try:
+      tracker.updateExtended(tracker.readExtendedStats(), currentTime)
+    except IOError, exc:
+      log.debug("Unable to query extended resource usage from proc (%s)" % exc)
+  
+  def _samplePs(self, trackers, currentTime):
+    """
+    Samples the usage of several trackers with a single ps call.
+    
+    Arguments:
+      trackers    - trackers to be sampled
+      currentTime - clock time of this sampling
+    """
+    
+    # the ps call formats results as:
+    # 
+    #   PID     TIME     ELAPSED   RSS %MEM
+    #  3001 3-08:06:32 21-00:00:12 121844 23.5
+    # 
+    # or if Tor has only recently been started:
+    # 
+    #   PID     TIME      ELAPSED    RSS %MEM
+    #  3001  0:04.40        37:57  18772  0.9
+    
+    pids = ",".join([str(tracker.processPid) for tracker in trackers])
+    psCall = call("ps -p %s -o pid,cputime,etime,rss,%%mem" % pids, None, "resource usage")
+    
+    psStats = {} # pid => stats
+    
+    for line in (psCall or [])[1:]:
+      stats = line.strip().split()
+      if len(stats) == 5: psStats[stats[0]] = stats[1:]
+    
+    for tracker in trackers:
+      stats = psStats.get(str(tracker.processPid))
+      
+      try:
+        if not stats:
+          raise IOError("unrecognized output from ps: %s" % psCall)
+        
+        totalCpuTime = str_tools.parse_short_time_label(stats[0])
+        uptime = str_tools.parse_short_time_label(stats[1])
+        timeSinceReset = currentTime - tracker.lastLookup
+        
+        tracker.update({
+          "cpuSampling": (totalCpuTime - tracker._lastCpuTotal) / timeSinceReset,
+          "cpuAvg": float(totalCpuTime) / max(1, uptime),
+          "_lastCpuTotal": totalCpuTime,
+          "memUsage": int(stats[2]) * 1024, # ps size is in kb
+          "memUsagePercentage": float(stats[3]) / 100.0,
+        }, currentTime)
+      except (IOError, ValueError), exc:
+        tracker.failed(exc, currentTime)
 
+def _readFd(fd):
+  """
+  Reads the contents of a proc file that's kept open, from its start.
+  
+  Arguments:
+    fd - file descriptor to be read
+  """
+  
+  os.lseek(fd, 0, os.SEEK_SET)
+  return os.read(fd, 4096)
@@ -15,7 +15,7 @@ import stem
 import stem.control
 import stem.descriptor
 
-from util import connections
+from util import connections, relayIndex, sysTools
 
 from stem.util import conf, enum, log, proc, str_tools, system
 
@@ -44,6 +44,22 @@ CONFIG = conf.config_dict("arm", {
   "features.pathPrefix": "",
 })
 
+# Parameters included in our snapshot of tor's state, which provides the
+# rendering path with values that don't require the connection lock.
+SNAPSHOT_INFO = ("fingerprint", "address")
+SNAPSHOT_OPTIONS = ("Nickname", "ORPort", "DirPort", "SocksPort", "ControlPort", "ORListenAddress", "BridgeRelay")
+
+# Options fetched with a single GETCONF when we connect, seeding our option
+# cache. Others are cached as they're first requested.
+PREFETCH_OPTIONS = SNAPSHOT_OPTIONS + ("ControlSocket", "HashedControlPassword", "CookieAuthentication", "ExitPolicy", "DataDirectory", "BandwidthRate", "BandwidthBurst", "RelayBandwidthRate", "RelayBandwidthBurst", "MaxAdvertisedBandwidth")
+
+# Cached relay attributes (see _getRelayAttr) derived from configuration
+# options, mapped to the lowercase options they depend on.
+OPTION_DEPENDENT_ATTR = {"bwRate": ("bandwidthrate", "relaybandwidthrate", "maxadvertisedbandwidth"),
+                         "bwBurst": ("bandwidthburst", "relaybandwidthburst"),
+                         "authorities": ("dirserver", "alternatedirauthority"),
+                         "hsPorts": tuple(stem.control.MAPPED_CONFIG_KEYS.keys())}
+
 # events used for controller functionality:
 # NEWDESC, NS, and NEWCONSENSUS - used for cache invalidation
 REQ_EVENTS = {"NEWDESC": "information related to descriptors will grow stale",
@@ -55,13 +71,14 @@ def getPid(controlPort=9051, pidFilePath=None):
   Attempts to determine the process id for a running tor process, using the
   following:
   1. GETCONF PidFile
-  2. "pgrep -x tor"
-  3. "pidof tor"
-  4. "netstat -npl | grep 127.0.0.1:%s" % <tor control port>
-  5. "ps -o pid -C tor"
-  6. "sockstat -4l -P tcp -p %i | grep tor" % <tor control port>
-  7. "ps axc | egrep \" tor$\""
-  8. "lsof -wnPi | egrep \"^tor.*:%i\"" % <tor control port>
+  2. processes named 'tor' in proc
+  3. "pgrep -x tor"
+  4. "pidof tor"
+  5. "netstat -npl | grep 127.0.0.1:%s" % <tor control port>
+  6. "ps -o pid -C tor"
+  7. "sockstat -4l -P tcp -p %i | grep tor" % <tor control port>
+  8. "ps axc | egrep \" tor$\""
+  9. "lsof -wnPi | egrep \"^tor.*:%i\"" % <tor control port>
   
   If pidof or ps provide multiple tor instances then their results are
   discarded (since only netstat can differentiate using the control port). This
@@ -85,47 +102,54 @@ def getPid(controlPort=9051, pidFilePath=None):
       if pidEntry.isdigit(): return pidEntry
     except: pass
   
+  # attempts to resolve from a scan of the process table in proc, failing if:
+  # - proc is unavailable
+  # - tor is running under a different name
+  # - there are multiple instances of tor
+  torProcesses = sysTools.findProcesses("tor")
+  if len(torProcesses) == 1: return torProcesses[0].pid
+  
   # attempts to resolve using pgrep, failing if:
   # - tor is running under a different name
   # - there are multiple instances of tor
   try:
-    results = system.call("pgrep -x tor")
+    results = sysTools.call("pgrep -x tor", caller = "getPid")
     if len(results) == 1 and len(results[0].split()) == 1:
       pid = results[0].strip()
       if pid.isdigit(): return pid
-  except IOError: pass
+  except (IOError, OSError): pass
   
   # attempts to resolve using pidof, failing if:
   # - tor's running under a different name
   # - there's multiple instances of tor
   try:
-    results = system.call("pidof tor")
+    results = sysTools.call("pidof tor", caller = "getPid")
     if len(results) == 1 and len(results[0].split()) == 1:
       pid = results[0].strip()
       if pid.isdigit(): return pid
-  except IOError: pass
+  except (IOError, OSError): pass
   
   # attempts to resolve using netstat, failing if:
   # - tor's being run as a different user due to permissions
   try:
-    results = system.call("netstat -npl")
+    results = sysTools.call("netstat -npl", caller = "getPid")
     results = filter(lambda line: "127.0.0.1:%i" % controlPort in line, results)
     
     if len(results) == 1:
       results = results[0].split()[6] # process field (ex. "7184/tor")
       pid = results[:results.find("/")]
       if pid.isdigit(): return pid
-  except IOError: pass
+  except (IOError, OSError): pass
   
   # attempts to resolve using ps, failing if:
   # - tor's running under a different name
   # - there's multiple instances of tor
   try:
-    results = system.call("ps -o pid -C tor")
+    results = sysTools.call("ps -o pid -C tor", caller = "getPid")
     if len(results) == 2:
       pid = results[1].strip()
       if pid.isdigit(): return pid
-  except IOError: pass
+  except (IOError, OSError): pass
   
   # attempts to resolve using sockstat, failing if:
   # - sockstat doesn't accept the -4 flag (BSD only)
@@ -136,13 +160,13 @@ def getPid(controlPort=9051, pidFilePath=None):
   # TODO: the later two issues could be solved by filtering for the control
   # port IP address instead of the process name.
   try:
-    results = system.call("sockstat -4l -P tcp -p %i" % controlPort)
+    results = sysTools.call("sockstat -4l -P tcp -p %i" % controlPort, caller = "getPid")
     results = filter(lambda line: "tor" in line, results)
     
     if len(results) == 1 and len(results[0].split()) == 7:
       pid = results[0].split()[2]
       if pid.isdigit(): return pid
-  except IOError: pass
+  except (IOError, OSError): pass
   
   # attempts to resolve via a ps command that works on the mac (this and lsof
   # are the only resolvers to work on that platform). This fails if:
@@ -150,13 +174,13 @@ def getPid(controlPort=9051, pidFilePath=None):
   # - there's multiple instances of tor
   
   try:
-    results = system.call("ps axc")
+    results = sysTools.call("ps axc", caller = "getPid")
     results = filter(lambda line: line.endswith(" tor"), results)
     
     if len(results) == 1 and len(results[0].split()) > 0:
       pid = results[0].split()[0]
       if pid.isdigit(): return pid
-  except IOError: pass
+  except (IOError, OSError): pass
   
   # attempts to resolve via lsof - this should work on linux, mac, and bsd -
   # this fails if:
@@ -166,7 +190,7 @@ def getPid(controlPort=9051, pidFilePath=None):
   #   same control port on different addresses.
   
   try:
-    results = system.call("lsof -wnPi")
+    results = sysTools.call("lsof -wnPi", caller = "getPid")
     results = filter(lambda line: line.startswith("tor.*:%i" % controlPort), results)
     
     # This can result in multiple entries with the same pid (from the query
@@ -183,7 +207,7 @@ def getPid(controlPort=9051, pidFilePath=None):
         else: raise IOError
       
       if pid.isdigit(): return pid
-  except IOError: pass
+  except (IOError, OSError): pass
   
   return None
 
@@ -211,9 +235,9 @@ def isTorRunning():
   if os.uname()[0] in ("Darwin", "FreeBSD", "OpenBSD"):
     primaryResolver, secondaryResolver = secondaryResolver, primaryResolver
   
-  commandResults = system.call(primaryResolver)
+  commandResults = sysTools.call(primaryResolver, caller = "isTorRunning")
   if not commandResults:
-    commandResults = system.call(secondaryResolver)
+    commandResults = sysTools.call(secondaryResolver, caller = "isTorRunning")
   
   if commandResults:
     for cmd in commandResults:
@@ -221,6 +245,24 @@ def isTorRunning():
   
   return False
 
+def _getOptionValue(values, default, multiple):
+  """
+  Provides the result of getOption() for a cached option.
+  
+  Arguments:
+    values   - list of values for the option (empty if it's unset)
+    default  - result if the option is unset
+    multiple - provides a list with all of the values if true, otherwise the
+               first value
+  """
+  
+  if not values:
+    if default != UNDEFINED: return default
+    elif multiple: return []
+    else: return None
+  elif multiple: return list(values)
+  else: return values[0]
+
 def getConn():
   """
   Singleton constructor for a Controller. Be aware that this starts as being
@@ -242,12 +284,9 @@ class Controller:
     self.controller = None
     self.connLock = threading.RLock()
     self.controllerEvents = []          # list of successfully set controller events
-    self._fingerprintMappings = None    # mappings of ip -> [(port, fingerprint), ...]
+    self._relayIndex = None             # RelayIndex of the consensus, built when first needed
     self._fingerprintLookupCache = {}   # lookup cache with (ip, port) -> fingerprint mappings
     self._fingerprintsAttachedCache = None # cache of relays we're connected to
-    self._nicknameLookupCache = {}      # lookup cache with fingerprint -> nickname mappings
-    self._nicknameToFpLookupCache = {}  # lookup cache with nickname -> fingerprint mappings
-    self._addressLookupCache = {}       # lookup cache with fingerprint -> (ip address, or port) mappings
     self._consensusLookupCache = {}     # lookup cache with network status entries
     self._descriptorLookupCache = {}    # lookup cache with relay descriptors
     self._isReset = False               # internal flag for tracking resets
@@ -260,6 +299,16 @@ class Controller:
     
     # cached parameters for custom getters (None if unset or possibly changed)
     self._cachedParam = {}
+    
+    # Lowercase configuration options mapped to a list of their values (empty
+    # if unset). This is only used if we can listen for CONF_CHANGED events,
+    # which are how entries are invalidated.
+    self._optionCache = {}
+    self._isOptionCaching = False
+    
+    # Snapshot of tor's state for lock free reads. This is never modified once
+    # published, instead being replaced with a new one (see _refreshSnapshot).
+    self._snapshot = None
   
   def init(self, controller):
     """
@@ -285,19 +334,28 @@ class Controller:
       self.controller.add_event_listener(self.new_desc_event, stem.control.EventType.NEWDESC)
       self.controller.add_event_listener(self.circ_status_event, stem.control.EventType.CIRC)
       
+      # CONF_CHANGED events were introduced in tor 0.2.3.3-alpha, and without
+      # them we can't tell when cached options are stale
+      try:
+        self.controller.add_event_listener(self.conf_changed_event, stem.control.EventType.CONF_CHANGED)
+        self._isOptionCaching = True
+      except (stem.ProtocolError, stem.ControllerError):
+        self._isOptionCaching = False
+      
       # reset caches for ip -> fingerprint lookups
-      self._fingerprintMappings = None
+      self._relayIndex = None
       self._fingerprintLookupCache = {}
       self._fingerprintsAttachedCache = None
-      self._nicknameLookupCache = {}
-      self._nicknameToFpLookupCache = {}
-      self._addressLookupCache = {}
       self._consensusLookupCache = {}
       self._descriptorLookupCache = {}
       
       # time that we sent our last newnym signal
       self._lastNewnym = 0
       
+      self._optionCache = {}
+      if self._isOptionCaching: self._fillOptionCache(PREFETCH_OPTIONS)
+      self._refreshSnapshot()
+      
       self.connLock.release()
   
   def close(self):
@@ -309,6 +367,8 @@ class Controller:
     if self.controller:
       self.controller.close()
       self.controller = None
+      self._optionCache = {}
+      self._snapshot = None
       self.connLock.release()
     else: self.connLock.release()
   
@@ -376,7 +436,8 @@ class Controller:
     Queries the control port for the given configuration option, providing the
     default if the response is undefined or fails for any reason. If multiple
     values exist then this arbitrarily returns the first unless the multiple
-    flag is set.
+    flag is set. Options are cached until CONF_CHANGED events or our own
+    changes invalidate them.
     
     Arguments:
       param     - configuration option to be queried
@@ -385,6 +446,10 @@ class Controller:
                   this just provides the first result
     """
     
+    # cache hits are answered without the connection lock
+    cachedValues = self._optionCache.get(param.lower())
+    if cachedValues != None: return _getOptionValue(cachedValues, default, multiple)
+    
     self.connLock.acquire()
     
     try:
@@ -394,6 +459,12 @@ class Controller:
         else:
           raise stem.SocketClosed()
       
+      if self._isOptionCaching:
+        self._fillOptionCache((param,))
+        
+        cachedValues = self._optionCache.get(param.lower())
+        if cachedValues != None: return _getOptionValue(cachedValues, default, multiple)
+      
       if default != UNDEFINED:
         return self.controller.get_conf(param, default, multiple)
       else:
@@ -404,6 +475,130 @@ class Controller:
     finally:
       self.connLock.release()
   
+  def getInfoMany(self, params, defaults = None):
+    """
+    Queries the control port for several GETINFO options with a single
+    request, providing a dictionary of the params to their values. If the
+    query fails (for instance, if one of the options is unrecognized) then
+    this falls back to querying each individually.
+    
+    Arguments:
+      params   - GETINFO options to be queried
+      defaults - mapping of params to the result if their query fails (this
+                 raises an exception for those without a default)
+    """
+    
+    if defaults == None: defaults = {}
+    params = list(params)
+    
+    self.connLock.acquire()
+    
+    try:
+      if params and self.isAlive():
+        try:
+          return self.controller.get_info(params)
+        except stem.SocketClosed, exc:
+          self.close()
+          if [param for param in params if not param in defaults]: raise exc
+        except stem.ControllerError:
+          pass
+      
+      results = {}
+      
+      for param in params:
+        results[param] = self.getInfo(param, defaults.get(param, UNDEFINED))
+      
+      return results
+    finally:
+      self.connLock.release()
+  
+  def getOptionMany(self, params, defaults = None, multiple = False):
+    """
+    Queries the control port for several configuration options with a single
+    request, providing a dictionary of the params to their values. Options
+    that are unset are None (an empty list if multiple is set) unless they
+    have a default. Cached options are used when available, and if the query
+    fails then this falls back to querying each individually.
+    
+    Arguments:
+      params   - configuration options to be queried
+      defaults - mapping of params to the result if they're unset or their
+                 query fails (this raises an exception for failed queries
+                 without a default)
+      multiple - provides lists with all returned values if true, otherwise
+                 this just provides the first result
+    """
+    
+    if defaults == None: defaults = {}
+    results, params = {}, list(params)
+    
+    for param in list(params):
+      cachedValues = self._optionCache.get(param.lower())
+      
+      if cachedValues != None:
+        results[param] = _getOptionValue(cachedValues, defaults.get(param, UNDEFINED), multiple)
+        params.remove(param)
+    
+    if not params: return results
+    
+    self.connLock.acquire()
+    
+    try:
+      if params and self.isAlive() and self._isOptionCaching:
+        self._fillOptionCache(params)
+        
+        for param in list(params):
+          cachedValues = self._optionCache.get(param.lower())
+          
+          if cachedValues != None:
+            results[param] = _getOptionValue(cachedValues, defaults.get(param, UNDEFINED), multiple)
+            params.remove(param)
+      
+      if params and self.isAlive():
+        try:
+          configMap = self.controller.get_conf_map(params, multiple = multiple)
+          
+          for param in params:
+            value = configMap.get(param)
+            
+            if value in (None, []) and param in defaults: results[param] = defaults[param]
+            elif value == None and multiple: results[param] = []
+            else: results[param] = value
+          
+          return results
+        except stem.SocketClosed, exc:
+          self.close()
+          if [param for param in params if not param in defaults]: raise exc
+        except stem.ControllerError:
+          pass
+      
+      for param in params:
+        results[param] = self.getOption(param, defaults.get(param, UNDEFINED), multiple)
+      
+      return results
+    finally:
+      self.connLock.release()
+  
+  def getSnapshot(self, param, default = None):
+    """
+    Provides our last fetched value for a GETINFO option or configuration
+    option in SNAPSHOT_INFO or SNAPSHOT_OPTIONS, or "exitPolicy" for our
+    ExitPolicy. This is refreshed when we connect, reload, set options, or
+    publish a new descriptor. Unlike getInfo() or getOption() this doesn't wait
+    on the control connection, so it's safe to use while rendering.
+    
+    Arguments:
+      param   - parameter to be provided
+      default - result if the value is unset or unavailable
+    """
+    
+    snapshot = self._snapshot
+    if snapshot == None: snapshot = self._refreshSnapshot()
+    
+    result = snapshot.get(param)
+    if result == None: return default
+    else: return result
+  
   def setOption(self, param, value = None):
     """
     Issues a SETCONF to set the given option/value pair. An exeptions raised
@@ -440,6 +635,8 @@ class Controller:
         raise stem.SocketClosed()
       
       self.controller.set_options(paramList, isReset)
+      self._dropOptions([param for param, _ in paramList])
+      self._refreshSnapshot()
     except stem.SocketClosed, exc:
       self.close()
       raise exc
@@ -472,6 +669,30 @@ class Controller:
     
     self.connLock.release()
   
+  def reverseResolve(self, ipAddrs):
+    """
+    Asks tor to look up the hostnames of several addresses. This returns right
+    away, with the results arriving later as ADDRMAP events. This raises an
+    IOError if the request can't be made.
+    
+    Arguments:
+      ipAddrs - ip addresses to be resolved
+    """
+    
+    self.connLock.acquire()
+    
+    try:
+      if not self.isAlive(): raise IOError("tor isn't connected")
+      
+      try:
+        response = self.controller.msg("RESOLVE mode=reverse %s" % " ".join(ipAddrs))
+      except stem.ControllerError, exc:
+        raise IOError(str(exc))
+      
+      if not response.is_ok(): raise IOError("RESOLVE request failed: %s" % response)
+    finally:
+      self.connLock.release()
+
   def isNewnymAvailable(self):
     """
     True if Tor will immediately respect a newnym request, false otherwise.
@@ -540,8 +761,7 @@ class Controller:
   
   def getMyBandwidthRate(self, default = None):
     """
-    Provides the effective relaying bandwidth rate of this relay. Currently
-    this doesn't account for SETCONF events.
+    Provides the effective relaying bandwidth rate of this relay.
     
     Arguments:
       default - result if the query fails
@@ -551,8 +771,7 @@ class Controller:
   
   def getMyBandwidthBurst(self, default = None):
     """
-    Provides the effective bandwidth burst rate of this relay. Currently this
-    doesn't account for SETCONF events.
+    Provides the effective bandwidth burst rate of this relay.
     
     Arguments:
       default - result if the query fails
@@ -715,10 +934,8 @@ class Controller:
     True if so and False otherwise.
     """
     
-    self.connLock.acquire()
-    
     result = False
-    if self.isAlive():
+    if self._isConnected():
       # If we allow any exiting then this could be relayed DNS queries,
       # otherwise the policy is checked. Tor still makes DNS connections to
       # test when exiting isn't allowed, but nothing is relayed over them.
@@ -730,8 +947,6 @@ class Controller:
       if our_policy and our_policy.is_exiting_allowed() and port == "53": result = True
       else: result = our_policy and our_policy.can_exit_to(ipAddress, port)
     
-    self.connLock.release()
-    
     return result
   
   def getExitPolicy(self):
@@ -740,18 +955,8 @@ class Controller:
     chain. If there's no active connection then this provides None.
     """
     
-    self.connLock.acquire()
-    
-    result = None
-    if self.isAlive():
-      try:
-        result = self.controller.get_exit_policy(param)
-      except:
-        pass
-    
-    self.connLock.release()
-    
-    return result
+    if self._isConnected(): return self.getSnapshot("exitPolicy")
+    else: return None
   
   def getConsensusEntry(self, relayFingerprint):
     """
@@ -816,25 +1021,28 @@ class Controller:
                       address
     """
     
+    if not self._isConnected(): return None
+    
+    if getAllMatches:
+      index = self._getRelayIndex()
+      return [(index.getOrPort(row), index.getFingerprint(row)) for row in index.getRowsByAddress(relayAddress)]
+    
+    # Cached lookups are answered without the connection lock. Events replace
+    # this cache rather than removing its entries, so this is safe.
+    lookupCache = self._fingerprintLookupCache
+    if (relayAddress, relayPort) in lookupCache:
+      return lookupCache[(relayAddress, relayPort)]
+    
     self.connLock.acquire()
     
     result = None
     if self.isAlive():
-      if getAllMatches:
-        # populates the ip -> fingerprint mappings if not yet available
-        if self._fingerprintMappings == None:
-          self._fingerprintMappings = self._getFingerprintMappings()
-        
-        if relayAddress in self._fingerprintMappings:
-          result = self._fingerprintMappings[relayAddress]
-        else: result = []
-      else:
-        # query the fingerprint if it isn't yet cached
-        if not (relayAddress, relayPort) in self._fingerprintLookupCache:
-          relayFingerprint = self._getRelayFingerprint(relayAddress, relayPort)
-          self._fingerprintLookupCache[(relayAddress, relayPort)] = relayFingerprint
-        
-        result = self._fingerprintLookupCache[(relayAddress, relayPort)]
+      # query the fingerprint if it isn't yet cached
+      if not (relayAddress, relayPort) in self._fingerprintLookupCache:
+        relayFingerprint = self._getRelayFingerprint(relayAddress, relayPort)
+        self._fingerprintLookupCache[(relayAddress, relayPort)] = relayFingerprint
+      
+      result = self._fingerprintLookupCache[(relayAddress, relayPort)]
     
     self.connLock.release()
     
@@ -849,28 +1057,16 @@ class Controller:
       relayFingerprint - fingerprint of the relay
     """
     
-    self.connLock.acquire()
-    
     result = None
-    if self.isAlive():
-      # query the nickname if it isn't yet cached
-      if not relayFingerprint in self._nicknameLookupCache:
-        if relayFingerprint == self.getInfo("fingerprint", None):
-          # this is us, simply check the config
-          myNickname = self.getOption("Nickname", "Unnamed")
-          self._nicknameLookupCache[relayFingerprint] = myNickname
-        else:
-          # check the consensus for the relay
-          nsEntry = self.getConsensusEntry(relayFingerprint)
-          
-          if nsEntry: relayNickname = nsEntry[2:nsEntry.find(" ", 2)]
-          else: relayNickname = None
-          
-          self._nicknameLookupCache[relayFingerprint] = relayNickname
-      
-      result = self._nicknameLookupCache[relayFingerprint]
-    
-    self.connLock.release()
+    if self._isConnected():
+      if relayFingerprint == self.getSnapshot("fingerprint"):
+        # this is us, simply check the config
+        result = self.getSnapshot("Nickname", "Unnamed")
+      else:
+        # check the consensus for the relay
+        index = self._getRelayIndex()
+        row = index.getRow(relayFingerprint)
+        if row != None: result = index.getNickname(row)
     
     return result
   
@@ -909,32 +1105,20 @@ class Controller:
       relayFingerprint - fingerprint of the relay
     """
     
-    self.connLock.acquire()
-    
     result = default
-    if self.isAlive():
-      # query the address if it isn't yet cached
-      if not relayFingerprint in self._addressLookupCache:
-        if relayFingerprint == self.getInfo("fingerprint", None):
-          # this is us, simply check the config
-          myAddress = self.getInfo("address", None)
-          myOrPort = self.getOption("ORPort", None)
-          
-          if myAddress and myOrPort:
-            self._addressLookupCache[relayFingerprint] = (myAddress, myOrPort)
-        else:
-          # check the consensus for the relay
-          nsEntry = self.getConsensusEntry(relayFingerprint)
-          
-          if nsEntry:
-            nsLineComp = nsEntry.split("\n")[0].split(" ")
-            
-            if len(nsLineComp) >= 8:
-              self._addressLookupCache[relayFingerprint] = (nsLineComp[6], nsLineComp[7])
-      
-      result = self._addressLookupCache.get(relayFingerprint, default)
-    
-    self.connLock.release()
+    if self._isConnected():
+      if relayFingerprint == self.getSnapshot("fingerprint"):
+        # this is us, simply check the config
+        myAddress = self.getSnapshot("address")
+        myOrPort = self.getSnapshot("ORPort")
+        
+        if myAddress and myOrPort:
+          result = (myAddress, myOrPort)
+      else:
+        # check the consensus for the relay
+        index = self._getRelayIndex()
+        row = index.getRow(relayFingerprint)
+        if row != None: result = (index.getAddress(row), str(index.getOrPort(row)))
     
     return result
   
@@ -954,15 +1138,12 @@ class Controller:
     result = default
     
     if self.isAlive():
-      # check both if the cached mappings are unset or blank
-      if not self._fingerprintMappings:
-        self._fingerprintMappings = self._getFingerprintMappings()
+      # retries fetching the consensus if we didn't get any relays
+      if self._relayIndex != None and len(self._relayIndex) == 0:
+        self._relayIndex = None
       
-      # Make a shallow copy of the results. This doesn't protect the internal
-      # listings, but good enough for the moment.
-      # TODO: change the [(port, fingerprint)...] lists to tuples?
-      if self._fingerprintMappings != {}:
-        result = dict(self._fingerprintMappings)
+      addressMappings = self._getRelayIndex().getAddressMappings()
+      if addressMappings: result = addressMappings
     
     self.connLock.release()
     
@@ -977,32 +1158,11 @@ class Controller:
       relayNickname - nickname of the relay
     """
     
-    self.connLock.acquire()
-    
     result = None
-    if self.isAlive():
-      # determine the fingerprint if it isn't yet cached
-      if not relayNickname in self._nicknameToFpLookupCache:
-        # Fingerprints are base64 encoded hex with an extra '='. For instance...
-        # GETINFO ns/name/torexp2 ->
-        #   r torexp2 NPfjt8Vjr+drcbbFLQONN3KapNo LxoHteGax7ZNYh/9g/FF8I617fY 2011-04-27 15:20:35 141.161.20.50 9001 0
-        # decode base64 of "NPfjt8Vjr+drcbbFLQONN3KapNo=" ->
-        #   "4\xf7\xe3\xb7\xc5c\xaf\xe7kq\xb6\xc5-\x03\x8d7r\x9a\xa4\xda"
-        # encode hex of the above ->
-        #   "34f7e3b7c563afe76b71b6c52d038d37729aa4da"
-        
-        relayFingerprint = None
-        consensusEntry = self.getInfo("ns/name/%s" % relayNickname, None)
-        if consensusEntry:
-          encodedFp = consensusEntry.split()[2]
-          decodedFp = (encodedFp + "=").decode('base64').encode('hex')
-          relayFingerprint = decodedFp.upper()
-        
-        self._nicknameToFpLookupCache[relayNickname] = relayFingerprint
-      
-      result = self._nicknameToFpLookupCache[relayNickname]
-    
-    self.connLock.release()
+    if self._isConnected():
+      index = self._getRelayIndex()
+      row = index.getRowByNickname(relayNickname)
+      if row != None: result = index.getFingerprint(row)
     
     return result
   
@@ -1070,6 +1230,8 @@ class Controller:
         try:
           self.controller.signal(stem.Signal.RELOAD)
           self._cachedParam = {}
+          self._optionCache = {}
+          self._refreshSnapshot()
         except Exception, exc:
           # new torrc parameters caused an error (tor's likely shut down)
           raisedException = IOError(str(exc))
@@ -1112,6 +1274,8 @@ class Controller:
             else: raise IOError("failed silently")
           
           self._cachedParam = {}
+          self._optionCache = {}
+          self._refreshSnapshot()
         except IOError, exc:
           raisedException = exc
     
@@ -1173,16 +1337,28 @@ class Controller:
     self._cachedParam["flags"] = None
     self._cachedParam["bwMeasured"] = None
     
-    # reconstructs consensus based mappings
-    self._fingerprintLookupCache = {}
     self._fingerprintsAttachedCache = None
-    self._nicknameLookupCache = {}
-    self._nicknameToFpLookupCache = {}
-    self._addressLookupCache = {}
     self._consensusLookupCache = {}
     
-    if self._fingerprintMappings != None:
-      self._fingerprintMappings = self._getFingerprintMappings(event.desc)
+    # Most relays are the same from one consensus to the next, so rather than
+    # flushing our address -> fingerprint lookups this only drops those for
+    # addresses of relays that were added, removed, or changed.
+    if self._relayIndex != None:
+      newIndex = relayIndex.RelayIndex(event.desc)
+      added, removed, changed = self._relayIndex.getChanges(newIndex)
+      affectedAddresses = set()
+      
+      for fingerprint in removed.union(changed):
+        affectedAddresses.add(self._relayIndex.getAddress(self._relayIndex.getRow(fingerprint)))
+      
+      for fingerprint in added.union(changed):
+        affectedAddresses.add(newIndex.getAddress(newIndex.getRow(fingerprint)))
+      
+      self._dropFingerprintLookups(affectedAddresses)
+      self._relayIndex = newIndex
+      log.debug("New consensus has %i relays (%i added, %i removed, %i changed)" % (len(newIndex), len(added), len(removed), len(changed)))
+    else:
+      self._fingerprintLookupCache = {}
     
     self.connLock.release()
   
@@ -1196,36 +1372,43 @@ class Controller:
       self._cachedParam["descEntry"] = None
       self._cachedParam["bwObserved"] = None
     
-    # If we're tracking ip address -> fingerprint mappings then update with
-    # the new relays.
-    self._fingerprintLookupCache = {}
+    # If we've indexed the consensus then update it with the new relays,
+    # dropping the address -> fingerprint lookups they might affect.
     self._fingerprintsAttachedCache = None
     self._descriptorLookupCache = {}
     
-    if self._fingerprintMappings != None:
+    if self._relayIndex != None:
+      newIndex = self._relayIndex.copy()
+      affectedAddresses = set()
+      
       for fingerprint in desc_fingerprints:
         # gets consensus data for the new descriptor
         try: desc = self.controller.get_network_status(fingerprint)
         except stem.ControllerError: continue
         
-        # updates fingerprintMappings with new data
-        if desc.address in self._fingerprintMappings:
-          # if entry already exists with the same orport, remove it
-          orportMatch = None
-          for entryPort, entryFingerprint in self._fingerprintMappings[desc.address]:
-            if entryPort == desc.or_port:
-              orportMatch = (entryPort, entryFingerprint)
-              break
-          
-          if orportMatch: self._fingerprintMappings[desc.address].remove(orportMatch)
-          
-          # add the new entry
-          self._fingerprintMappings[desc.address].append((desc.or_port, desc.fingerprint))
-        else:
-          self._fingerprintMappings[desc.address] = [(desc.or_port, desc.fingerprint)]
+        row = newIndex.getRow(fingerprint)
+        if row != None: affectedAddresses.add(newIndex.getAddress(row))
+        affectedAddresses.add(desc.address)
+        
+        newIndex.add(desc)
+      
+      self._dropFingerprintLookups(affectedAddresses)
+      self._relayIndex = newIndex
+    else:
+      self._fingerprintLookupCache = {}
+    
+    # our address is among the things that might be updated by our descriptor
+    if not myFingerprint or myFingerprint in desc_fingerprints:
+      self._refreshSnapshot()
     
     self.connLock.release()
   
+  def conf_changed_event(self, event):
+    self.connLock.acquire()
+    self._dropOptions(event.config.keys())
+    self._refreshSnapshot()
+    self.connLock.release()
+  
   def circ_status_event(self, event):
     # CIRC events aren't required, but if one's received then flush this cache
     # since it uses circuit-status results.
@@ -1235,27 +1418,123 @@ class Controller:
     
     self._cachedParam["circuits"] = None
   
-  def _getFingerprintMappings(self, descriptors = None):
+  def _isConnected(self):
+    """
+    Lock free counterpart of isAlive(). This doesn't close our connection if
+    it's died, which is left for the next caller that holds the lock.
+    """
+    
+    controller = self.controller
+    return controller != None and controller.is_alive()
+  
+  def _refreshSnapshot(self):
+    """
+    Fetches the parameters included in our snapshot, publishing and providing
+    the new snapshot. This is empty if we aren't connected.
+    """
+    
+    self.connLock.acquire()
+    
+    try:
+      snapshot = {}
+      
+      if self.isAlive():
+        try:
+          infoDefaults = dict([(param, None) for param in SNAPSHOT_INFO])
+          optionDefaults = dict([(param, None) for param in SNAPSHOT_OPTIONS])
+          
+          snapshot.update(self.getInfoMany(SNAPSHOT_INFO, infoDefaults))
+          snapshot.update(self.getOptionMany(SNAPSHOT_OPTIONS, optionDefaults))
+          snapshot["exitPolicy"] = self.controller.get_exit_policy(None)
+        except stem.SocketClosed: pass
+      
+      self._snapshot = snapshot
+      return snapshot
+    finally:
+      self.connLock.release()
+  
+  def _fillOptionCache(self, params):
     """
-    Provides IP address to (port, fingerprint) tuple mappings for all of the
-    currently cached relays.
+    Fetches the given configuration options with a single GETCONF, adding
+    them to our cache. Options that can't be cached (hidden service options,
+    which tor provides under other names) or fail to be fetched are skipped.
+    This should be called with the connection lock.
     
     Arguments:
-      descriptors - router status entries (fetched if not provided)
+      params - configuration options to be cached
     """
     
-    results = {}
-    if self.isAlive():
-      # fetch the current network status if not provided
-      if not descriptors:
+    try:
+      configMap = self.controller.get_conf_map(list(params), multiple = True)
+    except stem.ControllerError:
+      return
+    
+    for param, values in configMap.items():
+      if not param.lower() in stem.control.MAPPED_CONFIG_KEYS:
+        self._optionCache[param.lower()] = list(values)
+  
+  def _dropOptions(self, params):
+    """
+    Invalidates our cached values for the given configuration options, and
+    the cached relay attributes derived from them.
+    
+    Arguments:
+      params - configuration options that have changed
+    """
+    
+    params = [param.lower() for param in params]
+    
+    for param in params:
+      if param in self._optionCache: del self._optionCache[param]
+    
+    for attr, attrOptions in OPTION_DEPENDENT_ATTR.items():
+      for param in params:
+        if param in attrOptions:
+          self._cachedParam[attr] = None
+          break
+  
+  def _dropFingerprintLookups(self, addresses):
+    """
+    Replaces our address -> fingerprint lookup cache with one lacking entries
+    for the given addresses.
+    
+    Arguments:
+      addresses - ip addresses with lookups that might be stale
+    """
+    
+    lookupCache = {}
+    
+    for lookupKey, fingerprint in self._fingerprintLookupCache.items():
+      if not lookupKey[0] in addresses: lookupCache[lookupKey] = fingerprint
+    
+    self._fingerprintLookupCache = lookupCache
+  
+  def _getRelayIndex(self):
+    """
+    Provides the RelayIndex of the current consensus, fetching and parsing it
+    if we haven't yet. This is empty if the consensus is unavailable. The
+    index isn't modified once published, so once it's available this is safe
+    to use without the connection lock.
+    """
+    
+    index = self._relayIndex
+    if index != None: return index
+    
+    self.connLock.acquire()
+    
+    if self._relayIndex == None:
+      descriptors = []
+      
+      if self.isAlive():
         try: descriptors = self.controller.get_network_statuses()
-        except stem.ControllerError: descriptors = []
+        except stem.ControllerError: pass
       
-      # construct mappings of ips to relay data
-      for desc in descriptors:
-        results.setdefault(desc.address, []).append((desc.or_port, desc.fingerprint))
+      self._relayIndex = relayIndex.RelayIndex(descriptors)
     
-    return results
+    index = self._relayIndex
+    self.connLock.release()
+    
+    return index
   
   def _getRelayFingerprint(self, relayAddress, relayPort):
     """
@@ -1275,15 +1554,12 @@ class Controller:
     if isinstance(relayPort, str): relayPort = int(relayPort)
     
     # checks if this matches us
-    if relayAddress == self.getInfo("address", None):
-      if not relayPort or relayPort == self.getOption("ORPort", None):
-        return self.getInfo("fingerprint", None)
-    
-    # if we haven't yet populated the ip -> fingerprint mappings then do so
-    if self._fingerprintMappings == None:
-      self._fingerprintMappings = self._getFingerprintMappings()
+    if relayAddress == self.getSnapshot("address"):
+      if not relayPort or relayPort == self.getSnapshot("ORPort"):
+        return self.getSnapshot("fingerprint")
     
-    potentialMatches = self._fingerprintMappings.get(relayAddress)
+    index = self._getRelayIndex()
+    potentialMatches = [(index.getOrPort(row), index.getFingerprint(row)) for row in index.getRowsByAddress(relayAddress)]
     if not potentialMatches: return None # no relay matches this ip address
     
     if len(potentialMatches) == 1:
@@ -1330,12 +1606,8 @@ class Controller:
       return attachedMatches[0]
     
     for entryPort, entryFingerprint in list(potentialMatches):
-      try:
-        nsEntry = self.controller.get_network_status(entryFingerprint)
-        
-        if not stem.Flag.RUNNING in nsEntry.flags:
-          potentialMatches.remove((entryPort, entryFingerprint))
-      except stem.ControllerError: pass
+      if not index.hasFlag(index.getRow(entryFingerprint), stem.Flag.RUNNING):
+        potentialMatches.remove((entryPort, entryFingerprint))
     
     if len(potentialMatches) == 1:
       return potentialMatches[0][1]
@@ -1382,21 +1654,25 @@ class Controller:
       elif key == "bwRate":
         # effective relayed bandwidth is the minimum of BandwidthRate,
         # MaxAdvertisedBandwidth, and RelayBandwidthRate (if set)
-        effectiveRate = int(self.getOption("BandwidthRate", None))
+        rateOptions = ("BandwidthRate", "RelayBandwidthRate", "MaxAdvertisedBandwidth")
+        rateValues = self.getOptionMany(rateOptions, dict.fromkeys(rateOptions))
+        effectiveRate = int(rateValues["BandwidthRate"])
         
-        relayRate = self.getOption("RelayBandwidthRate", None)
+        relayRate = rateValues["RelayBandwidthRate"]
         if relayRate and relayRate != "0":
           effectiveRate = min(effectiveRate, int(relayRate))
         
-        maxAdvertised = self.getOption("MaxAdvertisedBandwidth", None)
+        maxAdvertised = rateValues["MaxAdvertisedBandwidth"]
         if maxAdvertised: effectiveRate = min(effectiveRate, int(maxAdvertised))
         
         result = effectiveRate
       elif key == "bwBurst":
         # effective burst (same for BandwidthBurst and RelayBandwidthBurst)
-        effectiveBurst = int(self.getOption("BandwidthBurst", None))
+        burstOptions = ("BandwidthBurst", "RelayBandwidthBurst")
+        burstValues = self.getOptionMany(burstOptions, dict.fromkeys(burstOptions))
+        effectiveBurst = int(burstValues["BandwidthBurst"])
         
-        relayBurst = self.getOption("RelayBandwidthBurst", None)
+        relayBurst = burstValues["RelayBandwidthBurst"]
         if relayBurst and relayBurst != "0":
           effectiveBurst = min(effectiveBurst, int(relayBurst))
         
@@ -1429,7 +1705,8 @@ class Controller:
         result = self.getInfo("process/pid", None)
         
         if not result:
-          result = getPid(int(self.getOption("ControlPort", 9051)), self.getOption("PidFile", None))
+          pidOptions = self.getOptionMany(("ControlPort", "PidFile"), {"ControlPort": 9051, "PidFile": None})
+          result = getPid(int(pidOptions["ControlPort"]), pidOptions["PidFile"])
       elif key == "user":
         # provides the empty string if the query fails
         queriedUser = self.getInfo("process/user", None)
@@ -1442,16 +1719,15 @@ class Controller:
           if myPid:
             # if proc contents are available then fetch the pid from there and
             # convert it to the username
-            if proc.is_available():
-              try:
-                myUid = proc.get_uid(myPid)
-                if myUid and myUid.isdigit():
-                  result = pwd.getpwuid(int(myUid)).pw_name
-              except: pass
+            processInfo = sysTools.getProcessInfo(myPid)
+            
+            if processInfo and processInfo.uid and processInfo.uid.isdigit():
+              try: result = pwd.getpwuid(int(processInfo.uid)).pw_name
+              except KeyError: pass
             
             # fall back to querying via ps
             if not result:
-              psResults = system.call("ps -o user %s" % myPid)
+              psResults = sysTools.call("ps -o user %s" % myPid, caller = "tor info")
               if psResults and len(psResults) >= 2: result = psResults[1].strip()
       elif key == "fdLimit":
         # provides -1 if the query fails
@@ -1471,7 +1747,7 @@ class Controller:
             result = (8192, True)
           else:
             # uses ulimit to estimate (-H is for hard limit, which is what tor uses)
-            ulimitResults = system.call("ulimit -Hn")
+            ulimitResults = sysTools.call("ulimit -Hn", caller = "tor info")
             
             if ulimitResults:
               ulimit = ulimitResults[0].strip()
@@ -1489,7 +1765,7 @@ class Controller:
             # Output should be something like:
             #    JID  IP Address      Hostname      Path
             #      1  10.0.0.2        tor-jail      /usr/jails/tor-jail
-            jlsOutput = system.call("jls -j %s" % jid)
+            jlsOutput = sysTools.call("jls -j %s" % jid, caller = "tor info")
             
             if len(jlsOutput) == 2 and len(jlsOutput[1].split()) == 4:
               prefixPath = jlsOutput[1].split()[3]
@@ -1520,7 +1796,7 @@ class Controller:
           if not result:
             # if we're either not using proc or it fails then try using ps
             try:
-              psCall = system.call("ps -p %s -o etime" % myPid)
+              psCall = sysTools.call("ps -p %s -o etime" % myPid, caller = "tor info")
               
               if psCall and len(psCall) >= 2:
                 etimeEntry = psCall[1].strip()
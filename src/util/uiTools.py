@@ -13,6 +13,8 @@ from curses.ascii import isprint
 
 from stem.util import conf, enum, log, system
 
+from util import sysTools
+
 # colors curses can handle
 COLOR_LIST = {"red": curses.COLOR_RED,        "green": curses.COLOR_GREEN,
               "yellow": curses.COLOR_YELLOW,  "blue": curses.COLOR_BLUE,
@@ -484,9 +486,9 @@ def _isWideCharactersAvailable():
     
     libDependencyLines = None
     if system.is_available("ldd"):
-      libDependencyLines = system.call("ldd %s" % cursesLib)
+      libDependencyLines = sysTools.call("ldd %s" % cursesLib, caller = "curses check")
     elif system.is_available("otool"):
-      libDependencyLines = system.call("otool -L %s" % cursesLib)
+      libDependencyLines = sysTools.call("otool -L %s" % cursesLib, caller = "curses check")
     
     if libDependencyLines:
       for line in libDependencyLines: